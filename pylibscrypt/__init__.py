@@ -16,57 +16,142 @@
 
 __version__ = '1.7.0'
 
-# First, try hashlib
-_done = False
-try:
-    from .hashlibscrypt import *
-except ImportError:
-    pass
-else:
-    _done = True
-
-# If that didn't work, try loading libscrypt
-if not _done:
-    try:
-        from .pylibscrypt import *
-    except ImportError:
-        pass
-    else:
-        _done = True
-
-# Next: try the scrypt module
-if not _done:
-    try:
-        from .pyscrypt import *
-    except ImportError:
-        pass
-    else:
-        _done = True
-
-# Next: libsodium
-if not _done:
-    try:
-        from .pylibsodium import *
-    except ImportError:
-        pass
-    else:
-        _done = True
-
-# Unless we are on pypy, we want to try libsodium_salsa as well
-if not _done:
-    import platform
-    if platform.python_implementation() != 'PyPy':
+import importlib as _importlib
+import os as _os
+import sys as _sys
+import threading as _threading
+
+from .common import (
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT)
+from .context import ScryptContext
+from .mcf import ScryptMCF, parse_mcf, scrypt_mcf_check_batch as _check_batch
+
+
+# Implementations in order of preference: hashlib, libscrypt, the scrypt
+# module, libsodium and, unless on pypy, libsodium_salsa and numpy. The inlined
+# Python version is the last resort.
+_BACKENDS = ['hashlibscrypt', 'pylibscrypt', 'pyscrypt', 'pylibsodium']
+if not hasattr(_sys, 'pypy_version_info'):
+    _BACKENDS += ['pylibsodium_salsa', 'numpyscrypt']
+_BACKENDS += ['pypyscrypt_inline']
+
+# Loading one can be slow, e.g. finding libraries runs ldconfig, so that is
+# left for the first call
+_module = None
+_lock = _threading.Lock()
+
+# What the functions here call: the implementation module or, while metrics
+# are enabled, its instrumented functions
+_impl = None
+
+
+def _load():
+    # If asked to, use whichever is fastest here
+    if _os.environ.get('PYLIBSCRYPT_AUTOTUNE', '0') not in ('', '0'):
+        from . import autotune
+        return autotune.choose(
+            autotune.params_from_env(_os.environ['PYLIBSCRYPT_AUTOTUNE']))
+
+    for name in _BACKENDS[:-1]:
         try:
-            from .pylibsodium_salsa import *
+            return _importlib.import_module('.' + name, __name__)
         except ImportError:
             pass
-        else:
-            _done = True
+    return _importlib.import_module('.' + _BACKENDS[-1], __name__)
+
+
+def preload():
+    """Loads the scrypt implementation now instead of on first use
+
+    Returns the implementation module, which the functions here call.
+    """
+    global _module, _impl
+    if _module is None:
+        with _lock:
+            if _module is None:
+                module = _load()
+                _impl = module
+                _module = module
+    return _module
+
+
+def _route(functions):
+    # Makes the functions here call those of functions, or of the
+    # implementation again if None
+    global _impl
+    _impl = functions if functions is not None else preload()
+
+
+def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
+    """Returns a key derived using the scrypt key-derivarion function
+
+    N must be a power of two larger than 1 but no larger than 2 ** 63 (insane)
+    r and p must be positive numbers such that r * p < 2 ** 30
+    """
+    return (_impl or preload()).scrypt(password, salt, N, r, p, olen)
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, e.g. bytearrays that can be wiped
+    after use, and the key is as long as out.
+    """
+    return (_impl or preload()).scrypt_into(out, password, salt, N, r, p)
+
+
+def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+               prefix=SCRYPT_MCF_PREFIX_DEFAULT):
+    """Derives a Modular Crypt Format hash using the scrypt KDF
+
+    If no salt is given, a random salt of 128+ bits is used. (Recommended.)
+    """
+    return (_impl or preload()).scrypt_mcf(password, salt, N, r, p, prefix)
+
+
+def scrypt_mcf_check(mcf, password):
+    """Returns True if the password matches the given MCF hash"""
+    return (_impl or preload()).scrypt_mcf_check(mcf, password)
+
+
+def scrypt_batch(passwords, salts, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                 olen=64):
+    """Returns a list of keys, one for each pair of password and salt
+
+    With NumPy as the implementation, the lanes of all the derivations run
+    together. Otherwise scrypt() is called for each pair.
+    """
+    module = preload()
+    if hasattr(module, 'scrypt_batch'):
+        return module.scrypt_batch(passwords, salts, N, r, p, olen)
+    passwords = list(passwords)
+    salts = list(salts)
+    if len(passwords) != len(salts):
+        raise ValueError('passwords and salts must be of the same length')
+    return [scrypt(password, salt, N, r, p, olen)
+            for password, salt in zip(passwords, salts)]
+
+
+def scrypt_mcf_check_batch(pairs):
+    """Returns a list of whether each password matches its MCF hash
+
+    Takes an iterable of (mcf, password) pairs. Hashes that share parameters
+    are checked together using scrypt_batch().
+    """
+    return _check_batch(scrypt_batch, pairs)
+
 
-# If that didn't work either, the inlined Python version
-if not _done:
-    from .pypyscrypt_inline import *
+def pick_params(max_time, max_mem=None, backend=None):
+    """Returns the strongest (N, r, p) taking at most max_time seconds here
 
-__all__ = ['scrypt', 'scrypt_mcf', 'scrypt_mcf_check']
+    Derivations with them also use at most max_mem bytes, by default the
+    memory budget or half the physical memory. See pylibscrypt.pickparams for
+    details.
+    """
+    from .pickparams import pick_params
+    return pick_params(max_time, max_mem, backend)
 
 
+__all__ = ['scrypt', 'scrypt_batch', 'scrypt_into', 'scrypt_mcf',
+           'scrypt_mcf_check', 'scrypt_mcf_check_batch', 'ScryptContext',
+           'ScryptMCF', 'parse_mcf', 'pick_params', 'preload']
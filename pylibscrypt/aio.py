@@ -0,0 +1,145 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Asyncio interface to scrypt (Python 3.5+)
+
+The coroutines scrypt, scrypt_mcf and scrypt_mcf_check run the derivation in
+an executor so they do not block the event loop. Backends calling into C
+release the GIL and use a thread pool, the Python ones a process pool.
+
+At most limit derivations run at once, others wait their turn. A cancelled
+call that has not started yet is dropped. One that has started runs to
+completion in the background, still counting towards the limit.
+
+For other settings, create an AsyncScrypt and use its methods instead.
+"""
+
+
+import asyncio
+import concurrent.futures
+import os
+
+from .common import (
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT)
+
+
+# Backends that release the GIL while deriving
+_NATIVE = ('hashlibscrypt', 'pylibscrypt', 'pylibsodium')
+
+
+class AsyncScrypt(object):
+    """Runs scrypt from module in executor, at most limit at a time
+
+    module defaults to the implementation chosen by importing pylibscrypt and
+    limit to the number of CPUs. If no executor is given, one is created on
+    first use: threads for backends that release the GIL, otherwise processes.
+    """
+
+    def __init__(self, module=None, executor=None, limit=None):
+        if module is None:
+            from . import preload
+            module = preload()
+        self.module = module
+        self.limit = limit or os.cpu_count() or 1
+        self._executor = executor
+        self._semaphore = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.module.__name__.rsplit('.', 1)[-1] in _NATIVE:
+                pool = concurrent.futures.ThreadPoolExecutor
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor
+            self._executor = pool(self.limit)
+        return self._executor
+
+    def shutdown(self, wait=True):
+        """Shuts down the executor, if one has been created"""
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+            self._executor = None
+
+    async def _run(self, f, *args):
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        await self._semaphore.acquire()
+
+        def release(future):
+            try:
+                loop.call_soon_threadsafe(self._semaphore.release)
+            except RuntimeError:
+                # The loop is gone, as is anyone waiting on the semaphore
+                pass
+
+        try:
+            future = self.executor.submit(f, *args)
+        except:
+            self._semaphore.release()
+            raise
+        # Released only when done, even if we are cancelled before that
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def scrypt(self, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                     olen=64):
+        """Returns a key derived using the scrypt key-derivarion function"""
+        return await self._run(self.module.scrypt, password, salt, N, r, p,
+                               olen)
+
+    async def scrypt_mcf(self, password, salt=None, N=SCRYPT_N, r=SCRYPT_r,
+                         p=SCRYPT_p, prefix=SCRYPT_MCF_PREFIX_DEFAULT):
+        """Derives a Modular Crypt Format hash using the scrypt KDF"""
+        return await self._run(self.module.scrypt_mcf, password, salt, N, r,
+                               p, prefix)
+
+    async def scrypt_mcf_check(self, mcf, password):
+        """Returns True if the password matches the given MCF hash"""
+        return await self._run(self.module.scrypt_mcf_check, mcf, password)
+
+
+_default = None
+
+
+def _get_default():
+    global _default
+    if _default is None:
+        _default = AsyncScrypt()
+    return _default
+
+
+async def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
+    """Returns a key derived using the scrypt key-derivarion function
+
+    See pylibscrypt.scrypt for the parameters.
+    """
+    return await _get_default().scrypt(password, salt, N, r, p, olen)
+
+
+async def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                     prefix=SCRYPT_MCF_PREFIX_DEFAULT):
+    """Derives a Modular Crypt Format hash using the scrypt KDF
+
+    See pylibscrypt.scrypt_mcf for the parameters.
+    """
+    return await _get_default().scrypt_mcf(password, salt, N, r, p, prefix)
+
+
+async def scrypt_mcf_check(mcf, password):
+    """Returns True if the password matches the given MCF hash"""
+    return await _get_default().scrypt_mcf_check(mcf, password)
+
+
+__all__ = ['AsyncScrypt', 'scrypt', 'scrypt_mcf', 'scrypt_mcf_check']
@@ -0,0 +1,117 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Chooses the fastest scrypt implementation by timing them
+
+pylibscrypt normally picks the first implementation that loads, in the fixed
+order of BACKENDS. With PYLIBSCRYPT_AUTOTUNE set in the environment it instead
+uses the one that is fastest here, for the parameters given as N,r,p in the
+variable or the defaults if it is just 1.
+
+Timing every implementation is slow, so the winner is stored in a file under
+the user cache directory, separately for each host, Python version and
+parameters. Later processes load it directly.
+"""
+
+
+import importlib
+import os
+
+from . import _BACKENDS as BACKENDS
+from . import libload
+from .cachedir import cache_dir, host_key, read_json, update_json
+from .common import SCRYPT_N, SCRYPT_r, SCRYPT_p, clock
+
+
+# Small derivation every implementation is timed on first
+REFERENCE = (2**8, 8, 1)
+
+# Implementations this many times slower on it are not timed further
+_SLOWER = 10
+
+
+def _load(name):
+    return importlib.import_module('.' + name, __package__)
+
+
+def _time(module, N, r, p):
+    t = clock()
+    module.scrypt(b'password', b'NaCl', N, r, p)
+    return clock() - t
+
+
+def probe(params=(SCRYPT_N, SCRYPT_r, SCRYPT_p), backends=None):
+    """Returns {name: seconds} for each implementation that can be imported
+
+    Each is timed on REFERENCE, and those within a factor of ten of the best
+    also on params. The time is the sum of both, or None if not timed on
+    params.
+    """
+    modules = {}
+    for name in backends or BACKENDS:
+        try:
+            modules[name] = _load(name)
+        except ImportError:
+            pass
+    if not modules:
+        raise ImportError('no scrypt implementation found')
+
+    times = dict((name, _time(m, *REFERENCE)) for name, m in modules.items())
+    best = min(times.values())
+    for name, m in modules.items():
+        if times[name] > best * _SLOWER:
+            times[name] = None
+        else:
+            times[name] += _time(m, *params)
+    return times
+
+
+def choose(params=(SCRYPT_N, SCRYPT_r, SCRYPT_p), path=None, refresh=False):
+    """Returns the fastest implementation module for params
+
+    The result is read from path, by default autotune.json in cache_dir(), or
+    timed with probe() and stored there if missing or refresh is set. Where
+    the libraries were found is then stored in libraries.json next to it.
+    """
+    if path is None:
+        path = os.path.join(cache_dir(), 'autotune.json')
+    key = host_key('%d,%d,%d' % tuple(params))
+    name = read_json(path).get(key) if not refresh else None
+    if name in BACKENDS:
+        try:
+            return _load(name)
+        except ImportError:
+            pass
+
+    times = probe(params)
+    name = min((t, name) for name, t in times.items() if t is not None)[1]
+    update_json(path, key, name)
+    # Store where the libraries were found while at it
+    libload.save_paths(os.path.join(os.path.dirname(path), 'libraries.json'))
+    return _load(name)
+
+
+def params_from_env(value):
+    """Returns the parameters a PYLIBSCRYPT_AUTOTUNE value asks for"""
+    if ',' not in value:
+        return (SCRYPT_N, SCRYPT_r, SCRYPT_p)
+    try:
+        N, r, p = (int(v) for v in value.split(','))
+    except ValueError:
+        raise ValueError('PYLIBSCRYPT_AUTOTUNE must be 1 or N,r,p')
+    return N, r, p
+
+
+__all__ = ['BACKENDS', 'REFERENCE', 'cache_dir', 'choose', 'params_from_env',
+           'probe']
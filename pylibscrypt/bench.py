@@ -1,4 +1,4 @@
-# Copyright (c) 2014-2015, Jan Varho
+# Copyright (c) 2014-2017, Jan Varho
 #
 # Permission to use, copy, modify, and/or distribute this software for any
 # purpose with or without fee is hereby granted, provided that the above
@@ -12,41 +12,366 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-"""Simple benchmark of python vs c scrypt"""
+"""Benchmark of the scrypt implementations
 
-import time
+Run as python -m pylibscrypt.bench to time every implementation available on
+a grid of parameters, e.g.
 
-from .pylibscrypt import scrypt
-from .pypyscrypt_inline import scrypt as pyscrypt
-from .pylibsodium_salsa import scrypt as pcscrypt
+    python -m pylibscrypt.bench -N 1024,16384 -r 8 -p 1,2 --json out.json
 
+Each combination runs in a new process, so that its peak memory use can be
+measured. Implementations are only imported there, as the process inherits the
+peak of its parent. Reported are the median and 95th percentile time of a derivation,
+derivations per second and the peak resident set size of the process.
 
-# Benchmark time in seconds
-tmin = 5
-Nmax = 20
+With --baseline the results are compared to an earlier --json file, and the
+exit status is 1 if any got slower or used more memory than the thresholds.
 
-t1 = time.time()
-for i in xrange(1, Nmax+1):
-    pyscrypt(b'password', b'NaCl', N=2**i)
-    if time.time() - t1 > tmin:
-        Nmax = i
-        break
-t1 = time.time() - t1
-print('Using N = 2,4,..., 2**%d' % Nmax)
-print('Python scrypt took %.2fs' % t1)
+With --scaling it instead measures how the implementations scale with the
+number of workers, as threads and as processes, printing the aggregate
+derivations per second for each count. Implementations that don't get faster
+with threads while they do with processes hold the GIL. Also printed is the
+smallest number of workers within 10% of the best, past which adding more
+does not help.
+"""
 
-t2 = time.time()
-for i in xrange(1, Nmax+1):
-    pcscrypt(b'password', b'NaCl', N=2**i)
-t2 = time.time() - t2
-print('Py + C scrypt took %.2fs' % t2)
 
-t3 = time.time()
-for i in xrange(1, Nmax+1):
-    scrypt(b'password', b'NaCl', N=2**i)
-t3 = time.time() - t3
-print('C scrypt took      %.2fs' % t3)
+import argparse
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
 
-print('Python scrypt took %.2f times as long as C' % (t1 / t3))
-print('Py + C scrypt took %.2f times as long as C' % (t2 / t3))
+from . import _BACKENDS
+from .common import clock, parse_int
 
+
+def _percentile(times, q):
+    # Nearest rank, of sorted times
+    return times[max(0, -(-len(times) * q // 100) - 1)]
+
+
+def measure(module, N, r, p, repeat=5, max_time=10.0):
+    """Times module.scrypt with the given parameters
+
+    Runs at most repeat derivations, stopping early after max_time seconds.
+    Returns a dict of the number of runs, median and p95 times in seconds, and
+    derivations per second.
+    """
+    times = []
+    start = clock()
+    while len(times) < repeat and (not times or clock() - start < max_time):
+        t = clock()
+        module.scrypt(b'password', b'NaCl', N, r, p)
+        times.append(clock() - t)
+    total = sum(times)
+    times.sort()
+    return {
+        'runs': len(times),
+        'median': _percentile(times, 50),
+        'p95': _percentile(times, 95),
+        'per_second': len(times) / total if total else None,
+    }
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes, or None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run(backend, N, r, p, repeat=5, max_time=10.0):
+    """Measures one combination in a new process, returning its result dict
+
+    Returns None if the backend cannot be imported.
+    """
+    cmd = [sys.executable, '-m', __package__ + '.bench', '--child', backend,
+           '-N', str(N), '-r', str(r), '-p', str(p),
+           '--repeat', str(repeat), '--max-time', str(max_time)]
+    # The package may not be installed, only on our path
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [path for path in [env.get('PYTHONPATH')] if path])
+    out = subprocess.check_output(cmd, env=env)
+    result = json.loads(out.decode())
+    if result is None:
+        return None
+    result.update(backend=backend, N=N, r=r, p=p)
+    return result
+
+
+def compare(results, baseline, threshold=0.1, rss_threshold=0.25):
+    """Returns descriptions of results worse than in baseline
+
+    A result is worse if its median time is more than threshold, or its peak
+    RSS more than rss_threshold, larger as a fraction of the baseline.
+    """
+    base = dict(((b['backend'], b['N'], b['r'], b['p']), b)
+                for b in baseline['results'])
+    worse = []
+    for res in results['results']:
+        key = (res['backend'], res['N'], res['r'], res['p'])
+        if key not in base:
+            continue
+        b = base[key]
+        name = '%s N=%d r=%d p=%d' % key
+        if res['median'] > b['median'] * (1 + threshold):
+            worse.append('%s: median %.3gs, was %.3gs' %
+                         (name, res['median'], b['median']))
+        if (res.get('peak_rss') and b.get('peak_rss') and
+            res['peak_rss'] > b['peak_rss'] * (1 + rss_threshold)):
+            worse.append('%s: peak RSS %d, was %d' %
+                         (name, res['peak_rss'], b['peak_rss']))
+    return worse
+
+
+def _derive(args):
+    # Runs count derivations in a worker process
+    backend, N, r, p, count = args
+    module = importlib.import_module('.' + backend, __package__)
+    for _ in range(count):
+        module.scrypt(b'password', b'NaCl', N, r, p)
+
+
+def _threads_rate(module, N, r, p, workers, count):
+    start = threading.Event()
+
+    def derive():
+        start.wait()
+        for _ in range(count):
+            module.scrypt(b'password', b'NaCl', N, r, p)
+
+    threads = [threading.Thread(target=derive) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    t = clock()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return workers * count / (clock() - t)
+
+
+def _processes_rate(backend, N, r, p, workers, count):
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Imports the implementation in the workers before timing
+        pool.map(_derive, [(backend, N, r, p, 0)] * workers, 1)
+        t = clock()
+        pool.map(_derive, [(backend, N, r, p, count)] * workers, 1)
+        return workers * count / (clock() - t)
+    finally:
+        pool.terminate()
+
+
+def worker_counts(ncpu=None):
+    """Returns the numbers of workers to measure by default
+
+    These are the powers of two up to twice the number of CPUs, and the
+    number of CPUs and twice that.
+    """
+    ncpu = ncpu or multiprocessing.cpu_count()
+    counts = set([ncpu, 2 * ncpu])
+    n = 1
+    while n < 2 * ncpu:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def scaling(backend, N, r, p, workers=None, duration=1.0, processes=True):
+    """Measures derivations per second with each number of workers
+
+    Each worker runs about duration seconds worth of derivations, timed on
+    one first. Returns a list of dicts with the number of workers and the
+    rates in threads and processes, the latter None unless processes is set.
+    Raises ImportError if the backend cannot be imported.
+    """
+    module = importlib.import_module('.' + backend, __package__)
+    t = clock()
+    module.scrypt(b'password', b'NaCl', N, r, p)
+    count = max(1, int(duration / max(clock() - t, 1e-9)))
+    points = []
+    for n in workers or worker_counts():
+        points.append({
+            'workers': n,
+            'threads': _threads_rate(module, N, r, p, n, count),
+            'processes': (_processes_rate(backend, N, r, p, n, count)
+                          if processes else None),
+        })
+    return points
+
+
+def knee(points, key='threads', within=0.1):
+    """Returns the fewest workers within a fraction of the best rate"""
+    best = max(pt[key] for pt in points)
+    return min(pt['workers'] for pt in points
+               if pt[key] >= best * (1 - within))
+
+
+def holds_gil(points, ratio=1.5):
+    """Tells from scaling() results whether the implementation holds the GIL
+
+    That is when threads never get ratio times faster than one while
+    processes do. Returns None if that cannot be told, i.e. processes were
+    not measured or didn't scale either, like on a single CPU.
+    """
+    def speedup(key):
+        one = min(points, key=lambda pt: pt['workers'])[key]
+        return max(pt[key] for pt in points) / one
+
+    if len(points) < 2 or points[0]['processes'] is None:
+        return None
+    if speedup('processes') < ratio:
+        return None
+    return speedup('threads') < ratio
+
+
+def _ints(s):
+    return [parse_int(v) for v in s.split(',')]
+
+
+def _format(result):
+    rss = result.get('peak_rss')
+    return '%-18s %8d %3d %3d %5d %10.4f %10.4f %10.1f %8s' % (
+        result['backend'], result['N'], result['r'], result['p'],
+        result['runs'], result['median'], result['p95'],
+        result['per_second'] or 0,
+        '%.1fM' % (rss / 2.0**20) if rss else '-')
+
+
+def _main_scaling(args, results):
+    results['cpus'] = multiprocessing.cpu_count()
+    for backend in args.backends or _BACKENDS:
+        for N, r, p in itertools.product(args.N, args.r, args.p):
+            try:
+                points = scaling(backend, N, r, p, args.workers,
+                                 args.duration, args.processes)
+            except ImportError:
+                break
+            print('%s N=%d r=%d p=%d' % (backend, N, r, p))
+            print('  %7s %12s %12s' % ('workers', 'threads/s', 'processes/s'))
+            for pt in points:
+                print('  %7d %12.2f %12s' % (
+                    pt['workers'], pt['threads'],
+                    '%.2f' % pt['processes'] if pt['processes'] else '-'))
+            gil = holds_gil(points)
+            if gil is not None:
+                print('  %s the GIL' % ('holds' if gil else 'releases'))
+            print('  threads stop helping past %d' % knee(points))
+            if args.processes:
+                print('  processes stop helping past %d' %
+                      knee(points, 'processes'))
+            sys.stdout.flush()
+            results['results'].append({
+                'backend': backend, 'N': N, 'r': r, 'p': p,
+                'scaling': points, 'holds_gil': gil,
+                'knee_threads': knee(points),
+                'knee_processes': (knee(points, 'processes')
+                                   if args.processes else None),
+            })
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pylibscrypt.bench',
+        description='Benchmarks the available scrypt implementations.')
+    parser.add_argument('-b', '--backends', type=lambda s: s.split(','),
+                        help='comma-separated implementations to run, '
+                             'default all available')
+    parser.add_argument('-N', type=_ints, default=[2**10, 2**14],
+                        help='comma-separated values of N, e.g. 2**14')
+    parser.add_argument('-r', type=_ints, default=[8],
+                        help='comma-separated values of r')
+    parser.add_argument('-p', type=_ints, default=[1],
+                        help='comma-separated values of p')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='derivations per combination')
+    parser.add_argument('--max-time', type=float, default=10.0,
+                        help='seconds after which to stop repeating')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown as a fraction, default 0.1')
+    parser.add_argument('--rss-threshold', type=float, default=0.25,
+                        help='allowed growth of peak RSS, default 0.25')
+    parser.add_argument('--scaling', action='store_true',
+                        help='measure scaling with threads and processes')
+    parser.add_argument('--workers', type=_ints,
+                        help='comma-separated numbers of workers for '
+                             '--scaling, default powers of two to 2x CPUs')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds of derivations per worker for '
+                             '--scaling, default 1')
+    parser.add_argument('--no-processes', dest='processes',
+                        action='store_false',
+                        help='only measure threads with --scaling')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        try:
+            module = importlib.import_module('.' + args.child, __package__)
+        except ImportError:
+            print(json.dumps(None))
+            return 0
+        result = measure(module, args.N[0], args.r[0], args.p[0],
+                         args.repeat, args.max_time)
+        result['peak_rss'] = peak_rss()
+        print(json.dumps(result))
+        return 0
+
+    results = {
+        'host': socket.gethostname(),
+        'python': '%s %s' % (platform.python_implementation(),
+                             platform.python_version()),
+        'results': [],
+    }
+    if args.scaling:
+        return _main_scaling(args, results)
+    print('%-18s %8s %3s %3s %5s %10s %10s %10s %8s' % (
+        'backend', 'N', 'r', 'p', 'runs', 'median s', 'p95 s', 'per s',
+        'peak RSS'))
+    for backend in args.backends or _BACKENDS:
+        for N, r, p in itertools.product(args.N, args.r, args.p):
+            result = run(backend, N, r, p, args.repeat, args.max_time)
+            if result is None:
+                # Not available
+                break
+            results['results'].append(result)
+            print(_format(result))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        worse = compare(results, baseline, args.threshold, args.rss_threshold)
+        for line in worse:
+            print('Regression: ' + line)
+        if worse:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
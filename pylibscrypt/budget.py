@@ -0,0 +1,171 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Process-wide memory budget for scrypt calls in progress
+
+Every implementation reserves the memory a derivation needs from the budget
+before starting it and returns it when done. By default the budget is the
+memory limit of the cgroup the process runs in, if there is one.
+
+Use set_budget() to change it, e.g. set_budget(2**30, timeout=0) to allow at
+most 1 GiB and fail immediately instead of waiting when that is in use.
+"""
+
+
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+
+_CGROUP = '/sys/fs/cgroup'
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def cgroup_memory_limit():
+    """Returns the memory limit in bytes of our cgroup, or None if unlimited
+
+    Supports both cgroup v2 (memory.max) and v1 (memory.limit_in_bytes).
+    """
+    paths = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                path = path.lstrip('/')
+                if not controllers:
+                    paths.append(os.path.join(_CGROUP, path, 'memory.max'))
+                elif 'memory' in controllers.split(','):
+                    paths.append(os.path.join(
+                        _CGROUP, 'memory', path, 'memory.limit_in_bytes'))
+    except (IOError, OSError, ValueError):
+        pass
+
+    # Inside a container our cgroup is usually mounted as the root
+    paths.append(os.path.join(_CGROUP, 'memory.max'))
+    paths.append(os.path.join(_CGROUP, 'memory', 'memory.limit_in_bytes'))
+
+    for path in paths:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if value == 'max':
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            continue
+        # cgroup v1 reports no limit as a huge page-aligned number
+        return value if value < 2**60 else None
+    return None
+
+
+class MemoryBudget(object):
+    """Limits the total memory used by scrypt calls in progress
+
+    limit is in bytes, or None for no limit. A call that would exceed the
+    limit waits for others to finish, for at most timeout seconds unless
+    timeout is None. If it times out, MemoryError is raised. A call that
+    needs more than the whole budget raises ValueError, as it can never fit.
+    """
+
+    def __init__(self, limit=None, timeout=None):
+        self.limit = limit
+        self.timeout = timeout
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def set_limit(self, limit, timeout=None):
+        """Changes the limit and timeout, also for calls already waiting"""
+        with self._cond:
+            self.limit = limit
+            self.timeout = timeout
+            self._cond.notify_all()
+
+    def acquire(self, size):
+        """Reserves size bytes, waiting if necessary"""
+        with self._cond:
+            deadline = None
+            if self.timeout is not None:
+                deadline = _clock() + self.timeout
+            # The limit can change while waiting
+            while self.limit is not None and self.used + size > self.limit:
+                if size > self.limit:
+                    raise ValueError(
+                        'scrypt parameters exceed the memory budget')
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - _clock()
+                if remaining <= 0:
+                    raise MemoryError('scrypt memory budget in use, %d of %d '
+                                      'bytes' % (self.used, self.limit))
+                self._cond.wait(remaining)
+            self.used += size
+
+    def release(self, size):
+        """Returns size bytes reserved by acquire"""
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        """Context manager that holds size bytes of the budget"""
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+_budget = None
+_lock = threading.Lock()
+
+
+def get_budget():
+    """Returns the MemoryBudget in use, by default the cgroup limit"""
+    global _budget
+    if _budget is None:
+        with _lock:
+            if _budget is None:
+                _budget = MemoryBudget(cgroup_memory_limit())
+    return _budget
+
+
+def set_budget(limit, timeout=None):
+    """Sets the budget to limit bytes, None for no limit
+
+    Calls exceeding it wait at most timeout seconds, or forever if None.
+    Calls in progress keep their memory reserved under the new limit.
+    """
+    global _budget
+    with _lock:
+        if _budget is None:
+            _budget = MemoryBudget(limit, timeout)
+        else:
+            _budget.set_limit(limit, timeout)
+
+
+def memory_required(N, r, p, lanes=1):
+    """Returns the memory scrypt needs in bytes, running lanes at a time"""
+    return 128 * r * (N * lanes + p + 2)
+
+
+def reserve(N, r, p, lanes=1):
+    """Context manager that holds the memory scrypt needs from the budget"""
+    return get_budget().reserve(memory_required(N, r, p, lanes))
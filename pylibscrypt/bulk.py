@@ -0,0 +1,96 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Bulk scrypt using a pool of threads
+
+scrypt_many and scrypt_mcf_check_many run many derivations on a thread pool.
+The backends calling into C (hashlib, libscrypt and libsodium) release the GIL,
+so this scales with the number of cores. With the Python ones it still works,
+one derivation at a time.
+
+Both are generators yielding a (result, error) pair per input, in input order.
+If an input fails, its error is the exception raised and its result None, and
+the rest are still processed. Only a few inputs per thread are read ahead, so
+the input can be a long or even endless iterator.
+"""
+
+
+from collections import deque
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from .common import SCRYPT_N, SCRYPT_r, SCRYPT_p
+
+
+# Inputs submitted per thread before waiting for the first result
+_ahead = 2
+
+
+def _default_module():
+    from . import preload
+    return preload()
+
+
+def _result(async_result):
+    try:
+        return async_result.get(), None
+    except Exception as e:
+        return None, e
+
+
+def _imap(f, items, workers):
+    """Yields (result, error) of f(*item) for each item, using workers threads
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(f, item))
+            if len(pending) >= _ahead * workers:
+                yield _result(pending.popleft())
+        while pending:
+            yield _result(pending.popleft())
+    finally:
+        # Drops inputs not yet started if the caller stops early
+        pool.terminate()
+
+
+def scrypt_many(pairs, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64,
+                workers=None, module=None):
+    """Yields (key, error) for each (password, salt) pair in input order
+
+    Parameters are as for scrypt(). workers defaults to the number of CPUs and
+    module to the implementation chosen by importing pylibscrypt.
+    """
+    if module is None:
+        module = _default_module()
+    f = lambda password, salt: module.scrypt(password, salt, N, r, p, olen)
+    return _imap(f, pairs, workers)
+
+
+def scrypt_mcf_check_many(pairs, workers=None, module=None):
+    """Yields (match, error) for each (mcf, password) pair in input order
+
+    match is True if the password matches the MCF hash. workers defaults to
+    the number of CPUs and module to the implementation chosen by importing
+    pylibscrypt.
+    """
+    if module is None:
+        module = _default_module()
+    return _imap(module.scrypt_mcf_check, pairs, workers)
+
+
+__all__ = ['scrypt_many', 'scrypt_mcf_check_many']
@@ -0,0 +1,173 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Cache of successful scrypt_mcf_check results
+
+For clients that authenticate on every request, checking the same password
+against the same hash over and over. Only successful checks are cached, and
+only as an HMAC of the hash and password under a random key, so the cache
+never holds anything that could be used to recover or test a password outside
+this process.
+
+Entries expire after ttl seconds, and the least recently used are dropped when
+there are more than maxsize. Call invalidate(mcf) when a password changes.
+
+With shared set, a table of that many entries is also kept in shared memory,
+so that processes forked after creating the cache share their hits. Any
+invalidation then applies in all of them.
+"""
+
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+from .mcf import ScryptMCF, _compare
+
+
+# Shared table slots: mcf tag, pair tag, expiry time
+_SLOT = struct.Struct('32s32sd')
+
+
+def _mcf_parts(mcf):
+    if isinstance(mcf, ScryptMCF):
+        return (struct.pack('<3Q', mcf.N, mcf.r, mcf.p), mcf.salt, mcf.hash)
+    return (mcf,)
+
+
+def _tag(key, *parts):
+    h = hmac.new(key, digestmod=hashlib.sha256)
+    for part in parts:
+        h.update(struct.pack('<Q', len(part)))
+        h.update(part)
+    return h.digest()
+
+
+class VerifyCache(object):
+    """Caches successful checks of check(mcf, password)
+
+    check defaults to the scrypt_mcf_check chosen by importing pylibscrypt.
+    maxsize is the number of hashes to keep and ttl their lifetime in seconds.
+    If shared is given, that many slots are also kept in shared memory.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, check=None, shared=0):
+        if check is None:
+            from . import scrypt_mcf_check as check
+        self.check = check
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+        self._generation = 0
+        if shared:
+            self._shared = multiprocessing.RawArray('c', shared * _SLOT.size)
+            self._shared_generation = multiprocessing.RawValue('L', 0)
+            self._shared_lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _sync(self):
+        # Drops local entries if another process has invalidated any
+        if self._shared is None:
+            return
+        generation = self._shared_generation.value
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def _slot(self, mcf_tag):
+        n = len(self._shared) // _SLOT.size
+        return struct.unpack('<Q', mcf_tag[:8])[0] % n * _SLOT.size
+
+    def _get(self, mcf_tag, now):
+        with self._lock:
+            self._sync()
+            entry = self._entries.pop(mcf_tag, None)
+            if entry is not None and entry[1] > now:
+                self._entries[mcf_tag] = entry
+                return entry[0]
+        if self._shared is None:
+            return None
+        i = self._slot(mcf_tag)
+        with self._shared_lock:
+            tag, pair_tag, expires = _SLOT.unpack(
+                self._shared[i:i + _SLOT.size])
+        if tag == mcf_tag and expires > now:
+            return pair_tag
+        return None
+
+    def _put(self, mcf_tag, pair_tag, now):
+        expires = now + self.ttl
+        with self._lock:
+            self._entries.pop(mcf_tag, None)
+            self._entries[mcf_tag] = (pair_tag, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if self._shared is not None:
+            i = self._slot(mcf_tag)
+            with self._shared_lock:
+                self._shared[i:i + _SLOT.size] = _SLOT.pack(
+                    mcf_tag, pair_tag, expires)
+
+    def scrypt_mcf_check(self, mcf, password):
+        """Returns True if the password matches the given MCF hash"""
+        if (not isinstance(mcf, (bytes, ScryptMCF)) or
+            not isinstance(password, bytes)):
+            return self.check(mcf, password)
+
+        parts = _mcf_parts(mcf)
+        mcf_tag = _tag(self._key, *parts)
+        pair_tag = _tag(self._key, password, *parts)
+        now = time.time()
+        cached = self._get(mcf_tag, now)
+        if cached is not None and _compare(cached, pair_tag):
+            return True
+
+        if not self.check(mcf, password):
+            return False
+        self._put(mcf_tag, pair_tag, now)
+        return True
+
+    def invalidate(self, mcf=None):
+        """Drops the entry for mcf, or all entries if mcf is None
+
+        A hash is cached separately as bytes and as a ScryptMCF, so mcf must
+        be given in the same form as it was checked.
+        """
+        with self._lock:
+            if mcf is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(_tag(self._key, *_mcf_parts(mcf)), None)
+        if self._shared is None:
+            return
+        with self._shared_lock:
+            if mcf is None:
+                self._shared[:] = b'\0' * len(self._shared)
+            else:
+                i = self._slot(_tag(self._key, *_mcf_parts(mcf)))
+                self._shared[i:i + _SLOT.size] = b'\0' * _SLOT.size
+            self._shared_generation.value += 1
+
+
+__all__ = ['VerifyCache']
@@ -0,0 +1,91 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""The user cache directory and the JSON files kept there
+
+autotune, libload and pickparams store what they have measured or found in
+files under cache_dir(), each a JSON object keyed by host and whatever else the
+result depends on.
+"""
+
+
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def cache_dir():
+    """Returns the directory pylibscrypt stores its results in"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'pylibscrypt')
+
+
+def host_key(name):
+    """Returns the key of name for this host and Python version"""
+    return '%s %s-%s %s' % (
+        socket.gethostname(), platform.python_implementation(),
+        platform.python_version(), name)
+
+
+def read_json(path):
+    """Returns the object stored in path, or {} if missing or invalid"""
+    try:
+        with open(path) as f:
+            results = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return results if isinstance(results, dict) else {}
+
+
+def write_json(path, results):
+    """Stores the dict results in path, ignoring errors
+
+    It is written to a temporary file first so readers never see a partial
+    one.
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        _replace(tmp, path)
+    except (IOError, OSError):
+        os.remove(tmp)
+
+
+def update_json(path, key, value):
+    """Stores value under key in the object in path, ignoring errors"""
+    # Reread to keep what other processes have stored meanwhile
+    results = read_json(path)
+    results[key] = value
+    write_json(path, results)
+
+
+__all__ = ['cache_dir', 'host_key', 'read_json', 'update_json', 'write_json']
@@ -15,6 +15,7 @@
 """Common constants and functions used by scrypt implementations"""
 
 import numbers
+import time
 
 
 SCRYPT_MCF_PREFIX_7 = b'$7$'
@@ -29,10 +30,23 @@ SCRYPT_p = 1
 # The last one differs from libscrypt defaults, but matches the 'interactive'
 # work factor from the original paper. For long term storage where runtime of
 # key derivation is not a problem, you could use 16 as in libscrypt or better
-# yet increase N if memory is plentiful.
+# yet increase N if memory is plentiful. pylibscrypt.pick_params() finds the
+# largest that fit a time and memory limit on this host.
 
 xrange = xrange if 'xrange' in globals() else range
 
+# For timing derivations, the most precise clock available
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def parse_int(s):
+    """Parses an integer argument, which may be a power such as 2**14"""
+    if '**' in s:
+        base, exp = s.split('**')
+        return int(base) ** int(exp)
+    return int(s)
+
+
 def check_args(password, salt, N, r, p, olen=64):
     if not isinstance(password, bytes):
         raise TypeError('password must be a byte string')
@@ -59,3 +73,36 @@ def check_args(password, salt, N, r, p, olen=64):
     if olen <= 0:
         raise ValueError('length must be positive')
 
+
+
+def _byte_view(buf, name):
+    try:
+        view = memoryview(buf)
+    except TypeError:
+        raise TypeError('%s must be a byte string or buffer' % name)
+    if view.ndim != 1 or view.format != 'B' or view.itemsize != 1:
+        try:
+            view = view.cast('B')
+        except (AttributeError, TypeError):
+            raise TypeError('%s must be a contiguous buffer' % name)
+    if not getattr(view, 'c_contiguous', True):
+        raise TypeError('%s must be a contiguous buffer' % name)
+    return view
+
+
+def check_into_args(out, password, salt, N, r, p):
+    """Checks scrypt_into arguments, returning the buffers as byte memoryviews
+    """
+    out = _byte_view(out, 'out')
+    password = _byte_view(password, 'password')
+    salt = _byte_view(salt, 'salt')
+    if out.readonly:
+        raise TypeError('out must be a writable buffer')
+    check_args(b'', b'', N, r, p, len(out))
+    return out, password, salt
+
+
+def scrypt_into_copy(scrypt, out, password, salt, N, r, p):
+    """scrypt_into for implementations of scrypt taking and returning bytes"""
+    out, password, salt = check_into_args(out, password, salt, N, r, p)
+    out[:] = scrypt(password.tobytes(), salt.tobytes(), N, r, p, len(out))
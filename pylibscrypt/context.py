@@ -0,0 +1,137 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Scrypt with parameters fixed in advance
+
+A ScryptContext checks its parameters and computes everything derived from
+them once, instead of on every call. The C implementations also reuse an
+output buffer per thread. With small N this is a large part of the time taken.
+"""
+
+
+import base64
+import os
+
+from . import mcf as mcf_mod
+from .common import (
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_7, SCRYPT_MCF_PREFIX_s1,
+    SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY, check_args)
+
+
+def _prepare(module, N, r, p, olen):
+    # Implementations calling into C have their own, for the rest it only
+    # saves checking the parameters
+    if hasattr(module, '_prepare'):
+        return module._prepare(N, r, p, olen)
+    scrypt = module.scrypt
+    return lambda password, salt: scrypt(password, salt, N, r, p, olen)
+
+
+class ScryptContext(object):
+    """scrypt, scrypt_mcf and scrypt_mcf_check with fixed parameters
+
+    N, r, p and olen are as for scrypt(), and prefix as for scrypt_mcf(). They
+    are checked here, raising TypeError or ValueError like those would. module
+    defaults to the implementation chosen by importing pylibscrypt.
+    """
+
+    def __init__(self, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64,
+                 prefix=SCRYPT_MCF_PREFIX_DEFAULT, module=None):
+        check_args(b'', b'', N, r, p, olen)
+        if module is None:
+            from . import preload
+            module = preload()
+        self.N, self.r, self.p, self.olen = N, r, p, olen
+        self.prefix = prefix
+        self.module = module
+        self._scrypt = _prepare(module, N, r, p, olen)
+        self._prepared = {olen: self._scrypt}
+
+        if prefix == SCRYPT_MCF_PREFIX_s1:
+            self._hlen = 64
+            self._mcf = mcf_mod._scrypt_mcf_encode_s1(N, r, p, b'', b'')[:-1]
+        elif prefix in (SCRYPT_MCF_PREFIX_7, SCRYPT_MCF_PREFIX_ANY):
+            self._hlen = 32
+            self._mcf = mcf_mod._scrypt_mcf_encode_7(N, r, p, b'', b'')[:14]
+        else:
+            raise ValueError('Unrecognized MCF format')
+        if r > 255 or p > 255 or N > 2**31:
+            # Not supported by the MCF formats
+            self._mcf = None
+
+    def _prepared_olen(self, olen):
+        try:
+            return self._prepared[olen]
+        except KeyError:
+            f = _prepare(self.module, self.N, self.r, self.p, olen)
+            return self._prepared.setdefault(olen, f)
+
+    def scrypt(self, password, salt):
+        """Returns a key derived using the scrypt key-derivarion function"""
+        if not isinstance(password, bytes):
+            raise TypeError('password must be a byte string')
+        if not isinstance(salt, bytes):
+            raise TypeError('salt must be a byte string')
+        return self._scrypt(password, salt)
+
+    def scrypt_mcf(self, password, salt=None):
+        """Derives a Modular Crypt Format hash using the scrypt KDF
+
+        Salt must be a byte string 1-16 bytes long. If no salt is given, a
+        random salt of 128+ bits is used. (Recommended.)
+        """
+        if self._mcf is None:
+            # Raises the error for the parameters
+            return self.module.scrypt_mcf(password, salt, self.N, self.r,
+                                          self.p, self.prefix)
+        if not isinstance(password, bytes):
+            raise TypeError('password must be a byte string')
+        if b'\0' in password:
+            raise ValueError('scrypt_mcf password must not contain zero bytes')
+        if salt is not None:
+            if not isinstance(salt, bytes):
+                raise TypeError('salt must be a byte string')
+            if not (1 <= len(salt) <= 16):
+                raise ValueError('salt must be 1-16 bytes')
+
+        scrypt = self._prepared_olen(self._hlen)
+        if self._hlen == 64:
+            if salt is None:
+                salt = os.urandom(16)
+            hash = scrypt(password, salt)
+            return (self._mcf + base64.b64encode(salt) + b'$' +
+                    base64.b64encode(hash))
+        if salt is None:
+            salt = os.urandom(32)
+        salt = mcf_mod._cb64enc(salt)
+        hash = scrypt(password, salt)
+        return self._mcf + salt + b'$' + mcf_mod._cb64enc(hash)
+
+    def scrypt_mcf_check(self, mcf, password):
+        """Returns True if the password matches the given MCF hash
+
+        Hashes with other N, r or p are checked using the module.
+        """
+        if not isinstance(mcf, (bytes, mcf_mod.ScryptMCF)):
+            raise TypeError('MCF must be a byte string')
+        if not isinstance(password, bytes):
+            raise TypeError('password must be a byte string')
+        N, r, p, salt, hash, hlen = mcf_mod._scrypt_mcf_params(mcf)
+        if (N, r, p) != (self.N, self.r, self.p) or hlen < 1:
+            return self.module.scrypt_mcf_check(mcf, password)
+        h = self._prepared_olen(hlen)(password, salt)
+        return mcf_mod._compare(h, hash)
+
+
+__all__ = ['ScryptContext']
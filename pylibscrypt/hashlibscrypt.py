@@ -23,8 +23,10 @@ except:
     raise ImportError('hashlib.scrypt failed to import')
 
 from . import mcf as mcf_mod
+from .budget import get_budget, memory_required
 from .common import (
-    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, check_args)
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, check_args,
+    check_into_args)
 
 
 def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
@@ -49,13 +51,47 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     check_args(password, salt, N, r, p, olen)
 
     # Set the memory required based on parameter values
-    m = 128 * r * (N + p + 2)
+    m = memory_required(N, r, p)
 
-    try:
-        return _scrypt(
-            password=password, salt=salt, n=N, r=r, p=p, maxmem=m, dklen=olen)
-    except:
-        raise ValueError
+    with get_budget().reserve(m):
+        try:
+            return _scrypt(password=password, salt=salt, n=N, r=r, p=p,
+                           maxmem=m, dklen=olen)
+        except:
+            raise ValueError
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    out, password, salt = check_into_args(out, password, salt, N, r, p)
+    m = memory_required(N, r, p)
+
+    with get_budget().reserve(m):
+        try:
+            out[:] = _scrypt(password=password, salt=salt, n=N, r=r, p=p,
+                             maxmem=m, dklen=len(out))
+        except:
+            raise ValueError
+
+
+def _prepare(N, r, p, olen):
+    """Returns scrypt(password, salt) for parameters already checked"""
+    m = memory_required(N, r, p)
+
+    def scrypt(password, salt):
+        budget = get_budget()
+        budget.acquire(m)
+        try:
+            return _scrypt(password=password, salt=salt, n=N, r=r, p=p,
+                           maxmem=m, dklen=olen)
+        except:
+            raise ValueError
+        finally:
+            budget.release(m)
+    return scrypt
 
 
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
@@ -12,11 +12,98 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-"""Inlines the salsa20 core lines into salsa20_8"""
+"""Inlines the salsa20 core lines into salsa20_8
+
+The Salsa20/8 state is kept in local variables, loaded and stored with
+single tuple (un)packings that also do the XOR-in and add-back.
+
+Also generates BlockMix and SMix specialized for common values of r, with
+the loops in BlockMix unrolled and all offsets constant.
+"""
+
+# Values of r to specialize for
+SPECIALIZE_R = (1, 8, 16)
 
 of = open('pylibscrypt/pypyscrypt_inline.py', 'w')
 assert of
 
+def specialize(r):
+    """Returns BlockMix and SMix specialized for r"""
+
+    n = 32 * r
+    out = [
+        'def blockmix_salsa8_r%d(BY):' % r,
+        '    """Blockmix for r = %d; Used by SMix"""' % r,
+        '',
+        '    X = BY[%d:%d]' % (n - 16, n),
+        '    tmp = [0]*16',
+        '',
+    ]
+    # Write each block straight to its place in the shuffled output
+    for i in range(2 * r):
+        d = n + 16 * ((i >> 1) + (i & 1) * r)
+        out.append('    salsa20_8(X, tmp, BY, %d, BY, %d)' % (16 * i, d))
+    out += [
+        '',
+        '    BY[0:%d] = BY[%d:%d]' % (n, n, 2 * n),
+        '',
+        '',
+        'def smix_fill_r%d(X, r, N, V):' % r,
+        '    """First loop of SMix for r = %d"""' % r,
+        '',
+        '    for i in xrange(0, %d * N, %d):' % (n, n),
+        '        V[i:i + %d] = X[0:%d]' % (n, n),
+        '        blockmix_salsa8_r%d(X)' % r,
+        '',
+        '',
+        'def smix_mix_r%d(X, r, N, V):' % r,
+        '    """Second loop of SMix for r = %d"""' % r,
+        '',
+        '    for i in xrange(N):',
+        '        j = (X[%d] & (N - 1)) * %d' % (n - 16, n),
+        '        Vj = V[j:j + %d]' % n,
+        '        X[0:%d] = array(_WORD, [a ^ b for a, b in zip(X, Vj)])' % n,
+        '        blockmix_salsa8_r%d(X)' % r,
+        '',
+        '',
+        'def smix_r%d(B, Bi, r, N, V, X):' % r,
+        '    """SMix for r = %d"""' % r,
+        '',
+        '    X[0:%d] = B[Bi:Bi + %d]' % (n, n),
+        '    smix_fill_r%d(X, r, N, V)' % r,
+        '    smix_mix_r%d(X, r, N, V)' % r,
+        '    B[Bi:Bi + %d] = X[0:%d]' % (n, n),
+        '',
+        '',
+    ]
+    return '\n'.join(out) + '\n'
+
+
+def words(name, i):
+    """Returns the 16 state words as locals on two lines, indented by i"""
+    w = ['%s%d' % (name, k) for k in range(16)]
+    return (' '*i + ' ' + ', '.join(w[:8]) + ',\n' +
+            ' '*i + ' ' + ', '.join(w[8:]))
+
+
+def salsa_load(i):
+    """Returns the XOR of src into B, unpacked to locals"""
+    return (
+        ' '*i + '(' + words('x', i).lstrip() + ') = (\n' +
+        words('j', i) + ') = [\n' +
+        ' '*i + '    a ^ b for a, b in zip(B, src[s_start:s_start + 16])]\n'
+    )
+
+
+def salsa_store(i):
+    """Returns the add-back, packed and written to B and dest"""
+    out = ' '*i + 'dest[d_start:d_start + 16] = B[:] = array(_WORD, (\n'
+    for k in range(0, 16, 2):
+        out += ' '*(i + 4) + '(x%d + j%d) & 0xffffffff, ' % (k, k)
+        out += '(x%d + j%d) & 0xffffffff,\n' % (k + 1, k + 1)
+    return out + ' '*i + '))\n'
+
+
 def indent(line):
     i = 0
     while i < len(line) and line[i] == ' ':
@@ -29,19 +116,35 @@ with open('pylibscrypt/pypyscrypt.py', 'r') as f:
     lc = 0
     rl = []
     skipping = False
+    in_salsa = False
+    loaded = False
+    skip_body = False
     for line in f:
         lc += 1
         if lc == 1:
             of.write('# Automatically generated file, see inline.py\n\n')
         i = indent(line)
+        if skipping:
+            if not line[i:].startswith('def'):
+                continue
+            skipping = False
+        if skip_body:
+            skip_body = False
+            continue
+
         if line[i:].startswith('def R('):
             skipping = True
         elif line[i:].startswith('def array_overwrite('):
             skipping = True
-        elif skipping:
-            if line[i:].startswith('def'):
-                of.write(line)
-                skipping = False
+        elif line[i:].startswith('def '):
+            in_salsa = line[i:].startswith('def salsa20_8(')
+            of.write(line)
+
+        elif in_salsa and line[i:].startswith('for i in xrange(16):'):
+            # The loops over the state words become tuple (un)packing
+            of.write(salsa_store(i) if loaded else salsa_load(i))
+            loaded = True
+            skip_body = True
 
         elif line[i:].startswith('R('):
             parts = line.split(';')
@@ -59,18 +162,32 @@ with open('pylibscrypt/pypyscrypt.py', 'r') as f:
                     qvals = q.split(',')[1:]
                     qvals = [int(v.strip(' )\n')) for v in qvals]
                     of.write(' '*i)
-                    of.write('a = (x[%d]+x[%d]) & 0xffffffff\n' %
+                    of.write('a = (x%d+x%d) & 0xffffffff\n' %
                              (pvals[1], pvals[2]))
                     of.write(' '*i)
-                    of.write('b = (x[%d]+x[%d]) & 0xffffffff\n' %
+                    of.write('b = (x%d+x%d) & 0xffffffff\n' %
                              (qvals[1], qvals[2]))
                     of.write(' '*i)
-                    of.write('x[%d] ^= (a << %d) | (a >> %d)\n' %
+                    of.write('x%d ^= (a << %d) | (a >> %d)\n' %
                              (pvals[0], pvals[3], 32 - pvals[3]))
                     of.write(' '*i)
-                    of.write('x[%d] ^= (b << %d) | (b >> %d)\n' %
+                    of.write('x%d ^= (b << %d) | (b >> %d)\n' %
                              (qvals[0], qvals[3], 32 - qvals[3]))
 
+        elif line.startswith('_smix_r = {}'):
+            for r in SPECIALIZE_R:
+                of.write(specialize(r))
+            of.write('_smix_r = {%s}\n' % ', '.join(
+                '%d: smix_r%d' % (r, r) for r in SPECIALIZE_R))
+
+        elif line.startswith('_smix_fill_r = {}'):
+            of.write('_smix_fill_r = {%s}\n' % ', '.join(
+                '%d: smix_fill_r%d' % (r, r) for r in SPECIALIZE_R))
+
+        elif line.startswith('_smix_mix_r = {}'):
+            of.write('_smix_mix_r = {%s}\n' % ', '.join(
+                '%d: smix_mix_r%d' % (r, r) for r in SPECIALIZE_R))
+
         elif line[i:].startswith('array_overwrite('):
             vals = line.split(',')
             vals[0] = vals[0].split('(')[1]
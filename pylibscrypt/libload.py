@@ -0,0 +1,204 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Loads shared libraries, remembering where they were found
+
+Searching for a library with ctypes.util.find_library runs ldconfig or even
+gcc on Linux, which is slow to do in every process. Instead, the path of the
+library found can be stored in libraries.json in the cache directory. It is
+used as long as the file there has the same mtime and inode.
+
+Importing an implementation never writes the file. save_paths() does, and
+autotune when it stores its results. Run python -m pylibscrypt.libload to
+store where libsodium and libscrypt are found.
+
+To skip the search altogether, set PYLIBSCRYPT_LIBSODIUM or
+PYLIBSCRYPT_LIBSCRYPT to the path of the library.
+"""
+
+
+import ctypes
+import importlib
+import os
+import sys
+
+from .cachedir import cache_dir, host_key, read_json, update_json
+
+
+# Libraries searched for in this process, to store with save_paths()
+_found = {}
+
+
+class _DlInfo(ctypes.Structure):
+    _fields_ = [
+        ('dli_fname', ctypes.c_char_p),
+        ('dli_fbase', ctypes.c_void_p),
+        ('dli_sname', ctypes.c_char_p),
+        ('dli_saddr', ctypes.c_void_p),
+    ]
+
+
+def _loaded_path(lib, symbol):
+    """Returns the path lib was loaded from, or None if unknown"""
+    if os.path.isabs(lib._name):
+        return lib._name
+    try:
+        if os.name == 'nt':
+            buf = ctypes.create_unicode_buffer(32768)
+            n = ctypes.windll.kernel32.GetModuleFileNameW(
+                ctypes.c_void_p(lib._handle), buf, len(buf))
+            return buf.value if n else None
+        dladdr = ctypes.CDLL(None).dladdr
+    except (AttributeError, OSError):
+        return None
+    dladdr.argtypes = [ctypes.c_void_p, ctypes.POINTER(_DlInfo)]
+    info = _DlInfo()
+    addr = ctypes.cast(getattr(lib, symbol), ctypes.c_void_p)
+    if not dladdr(addr, ctypes.byref(info)) or not info.dli_fname:
+        return None
+    path = info.dli_fname
+    if not isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding())
+    return path if os.path.isabs(path) else None
+
+
+class _PyBuffer(ctypes.Structure):
+    _fields_ = [
+        ('buf', ctypes.c_void_p),
+        ('obj', ctypes.c_void_p),
+        ('len', ctypes.c_ssize_t),
+        ('itemsize', ctypes.c_ssize_t),
+        ('readonly', ctypes.c_int),
+        ('ndim', ctypes.c_int),
+        ('format', ctypes.c_char_p),
+        ('shape', ctypes.c_void_p),
+        ('strides', ctypes.c_void_p),
+        ('suboffsets', ctypes.c_void_p),
+        ('smalltable', ctypes.c_ssize_t * 2),
+        ('internal', ctypes.c_void_p),
+    ]
+
+
+def _address(view):
+    """Returns the address of the memory of a writable memoryview"""
+    buf = _PyBuffer()
+    obj = ctypes.py_object(view)
+    # PyBUF_WRITABLE
+    if ctypes.pythonapi.PyObject_GetBuffer(obj, ctypes.byref(buf), 1):
+        raise TypeError('buffer is not writable')
+    # The view keeps the memory in place, not this export of it
+    address = buf.buf
+    ctypes.pythonapi.PyBuffer_Release(ctypes.byref(buf))
+    return address
+
+
+def buffer_arg(view):
+    """Returns a ctypes argument pointing to the memory of a byte memoryview
+
+    Only read-only buffers other than bytes are copied. The view must be kept
+    until the argument is no longer used.
+    """
+    if not view.readonly:
+        array = ctypes.c_char * len(view)
+        try:
+            return array.from_buffer(view)
+        except TypeError:
+            # Python 2, where ctypes only takes old-style buffers
+            return array.from_address(_address(view))
+    obj = getattr(view, 'obj', None)
+    if isinstance(obj, bytes) and len(obj) == len(view):
+        return obj
+    return view.tobytes()
+
+
+def _key(name):
+    return host_key('%s %d-bit' % (name, ctypes.sizeof(ctypes.c_void_p) * 8))
+
+
+def load_library(name, symbol, find, path=None):
+    """Returns a ctypes.CDLL of library name, or None if not found
+
+    The library is loaded from $PYLIBSCRYPT_<NAME> if set, otherwise from
+    where it was found last time. Failing that, find() is called to search for
+    it, and should return the CDLL or None. symbol is a function exported by
+    the library, used to tell which file was loaded. path is the file the
+    locations are read from, by default libraries.json in cache_dir().
+    """
+    env = 'PYLIBSCRYPT_' + name.upper()
+    if os.environ.get(env):
+        try:
+            return ctypes.CDLL(os.environ[env])
+        except OSError as e:
+            raise ImportError('Unable to load %s from %s: %s' %
+                              (name, env, e))
+
+    if path is None:
+        path = os.path.join(cache_dir(), 'libraries.json')
+    key = _key(name)
+    entry = read_json(path).get(key)
+    try:
+        st = os.stat(entry['path'])
+        if (st.st_mtime, st.st_ino) == (entry['mtime'], entry['inode']):
+            return ctypes.CDLL(entry['path'])
+    except (OSError, KeyError, TypeError):
+        pass
+
+    lib = find()
+    if lib is None:
+        return None
+    loaded = _loaded_path(lib, symbol)
+    if loaded is not None:
+        try:
+            st = os.stat(loaded)
+        except OSError:
+            return lib
+        _found[key] = {
+            'path': loaded, 'mtime': st.st_mtime, 'inode': st.st_ino}
+    return lib
+
+
+def save_paths(path=None):
+    """Stores where the libraries searched for in this process were found
+
+    path is as for load_library(). Later processes then load them from there.
+    """
+    if not _found:
+        return
+    if path is None:
+        path = os.path.join(cache_dir(), 'libraries.json')
+    for key, entry in _found.items():
+        update_json(path, key, entry)
+
+
+def main():
+    # Run with -m this module is __main__, not the one the implementations use
+    libload = importlib.import_module('.libload', __package__)
+    # Loading the implementations searches for the libraries
+    for name in ('pylibscrypt', 'pylibsodium'):
+        try:
+            importlib.import_module('.' + name, __package__)
+        except ImportError:
+            pass
+    path = os.path.join(cache_dir(), 'libraries.json')
+    libload.save_paths(path)
+    for key, entry in sorted(read_json(path).items()):
+        print('%s: %s' % (key, entry.get('path')))
+    return 0
+
+
+__all__ = ['buffer_arg', 'load_library', 'save_paths']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,8 +15,15 @@
 import ctypes.util
 import sys
 
+from .libload import load_library
+
 
 def get_libsodium():
+    '''Load the libsodium C library, from where it was last found if possible'''
+    return load_library('libsodium', 'sodium_init', _find_libsodium)
+
+
+def _find_libsodium():
     '''Locate the libsodium C library'''
 
     __SONAMES = (13, 10, 5, 4)
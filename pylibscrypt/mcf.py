@@ -40,8 +40,12 @@ not verify.
 """
 
 
+from array import array
 import base64
 import binascii
+from functools import partial
+from itertools import compress, repeat
+from operator import eq, itemgetter, methodcaller
 import os
 import struct
 
@@ -50,13 +54,16 @@ from .common import (
     SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY)
 
 
+def _log2(N):
+    # Smallest t >= 1 such that 2**t >= N
+    return max(1, (N - 1).bit_length())
+
+
 def _scrypt_mcf_encode_s1(N, r, p, salt, hash):
     h64 = base64.b64encode(hash)
     s64 = base64.b64encode(salt)
 
-    t = 1
-    while 2**t < N:
-        t += 1
+    t = _log2(N)
     params = p + (r << 8) + (t << 16)
 
     return (
@@ -94,68 +101,58 @@ def _scrypt_mcf_decode_s1(mcf):
 
 
 # Crypt base 64
+#
+# Crypt base 64 packs bits little-endian, from the low bits of the first byte,
+# while standard base 64 is big-endian. Reversing the input of a standard
+# codec and its output makes the two line up, leaving just the alphabet to
+# translate.
 _cb64 = b'./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-_cb64a = bytearray(_cb64)
-_icb64 = (
-    [None] * 46 +
-    [
-        0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, None, None, None, None, None,
-        None, None, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25,
-        26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, None, None, None,
-        None, None, None, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49,
-        50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63
-    ] +
-    [None] * 133
-)
+_b64 = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+try:
+    _maketrans = bytes.maketrans
+except AttributeError:
+    from string import maketrans as _maketrans
+_cb64_to_b64 = _maketrans(_cb64, _b64)
+_b64_to_cb64 = _maketrans(_b64, _cb64)
+
+try:
+    _b2a = partial(binascii.b2a_base64, newline=False)
+    _b2a(b'')
+except TypeError:
+    _b2a = lambda b: binascii.b2a_base64(b)[:-1]
+
+# $7$ parameters: 6 bits of log2(N) followed by 30 each of r and p
+_PARAMS_7 = struct.Struct('<QB')
 
 
 def _cb64enc(arr):
-    arr = bytearray(arr)
-    out = bytearray()
-    val = bits = pos = 0
-    for b in arr:
-        val += b << bits
-        bits += 8
-    while bits >= 0:
-        out.append(_cb64a[val & 0x3f])
-        bits -= 6
-        val = val >> 6
-    return bytes(out)
+    """Encodes all bits of arr, plus zeros to fill the last character"""
+    arr = bytes(arr)
+    # Zero padding in front makes room for the partial last character
+    b64 = _b2a(b'\0' * (3 - len(arr) % 3) + arr[::-1])
+    return b64[:-(len(arr) * 8 // 6 + 2):-1].translate(_b64_to_cb64)
 
 
 def _scrypt_mcf_encode_7(N, r, p, salt, hash):
-    t = 1
-    while 2**t < N:
-        t += 1
+    t = _log2(N)
+    params = t | (r & 0x3fffffff) << 6 | (p & 0x3fffffff) << 36
+    params = _PARAMS_7.pack(params & 0xffffffffffffffff, params >> 64)
     return (
-        b'$7$' +
-        # N
-        _cb64[t::64] +
-        # r
-        _cb64[r & 0x3f::64] + _cb64[(r >> 6) & 0x3f::64] +
-        _cb64[(r >> 12) & 0x3f::64] + _cb64[(r >> 18) & 0x3f::64] +
-        _cb64[(r >> 24) & 0x3f::64] +
-        # p
-        _cb64[p & 0x3f::64] + _cb64[(p >> 6) & 0x3f::64] +
-        _cb64[(p >> 12) & 0x3f::64] + _cb64[(p >> 18) & 0x3f::64] +
-        _cb64[(p >> 24) & 0x3f::64] +
-        # rest
+        b'$7$' + _cb64enc(params)[:11] +
         salt +
         b'$' + _cb64enc(hash)
     )
 
 
 def _cb64dec(arr):
-    out = bytearray()
-    val = bits = pos = 0
-    for b in arr:
-        val += _icb64[b] << bits
-        bits += 6
-        if bits >= 8:
-            out.append(val & 0xff)
-            bits -= 8
-            val >>= 8
-    return out
+    """Decodes whole bytes of arr, ignoring any bits left over"""
+    arr = bytes(arr)
+    if arr.translate(None, _cb64):
+        raise ValueError('Incorrect crypt base64 in MCF')
+    b64 = arr[::-1].translate(_cb64_to_b64)
+    raw = binascii.a2b_base64(b'A' * (-len(arr) % 4) + b64)
+    return raw[::-1][:len(arr) * 6 // 8]
 
 
 def _scrypt_mcf_decode_7(mcf):
@@ -163,18 +160,19 @@ def _scrypt_mcf_decode_7(mcf):
     if not (mcf.startswith(b'$7$') and len(s) == 4):
         return None
 
-    s64 = bytearray(s[2])
-    h64 = bytearray(s[3])
+    s64, h64 = s[2:]
+    if len(s64) < 11:
+        raise ValueError('Unrecognized MCF format')
     try:
-        N = 2 ** _icb64[s64[0]]
-        r = (_icb64[s64[1]] + (_icb64[s64[2]] << 6) + (_icb64[s64[3]] << 12) +
-             (_icb64[s64[4]] << 18) + (_icb64[s64[5]] << 24))
-        p = (_icb64[s64[6]] + (_icb64[s64[7]] << 6) + (_icb64[s64[8]] << 12) +
-             (_icb64[s64[9]] << 18) + (_icb64[s64[10]] << 24))
-        salt = bytes(s64[11:])
-        hash = bytes(_cb64dec(h64))
-    except (IndexError, TypeError):
+        # One padding character to decode all 66 bits
+        low, high = _PARAMS_7.unpack(_cb64dec(s64[:11] + b'.'))
+        hash = _cb64dec(h64)
+    except ValueError:
         raise ValueError('Unrecognized MCF format')
+    N = 2 ** (low & 0x3f)
+    r = (low >> 6) & 0x3fffffff
+    p = (low >> 36 | high << 28) & 0x3fffffff
+    salt = s64[11:]
 
     return N, r, p, salt, hash, len(hash)
 
@@ -196,6 +194,62 @@ def _scrypt_mcf_decode(mcf):
     return params
 
 
+class ScryptMCF(object):
+    """A decoded MCF hash, see parse_mcf()"""
+    __slots__ = ('N', 'r', 'p', 'salt', 'hash', 'olen')
+
+    def __init__(self, N, r, p, salt, hash):
+        self.N = N
+        self.r = r
+        self.p = p
+        self.salt = salt
+        self.hash = hash
+        self.olen = len(hash)
+
+    def __reduce__(self):
+        return (ScryptMCF, (self.N, self.r, self.p, self.salt, self.hash))
+
+    def __eq__(self, other):
+        if not isinstance(other, ScryptMCF):
+            return NotImplemented
+        return self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__reduce__()[1])
+
+    def __repr__(self):
+        return 'ScryptMCF(N=%d, r=%d, p=%d, salt=%r, hash=%r)' % (
+            self.N, self.r, self.p, self.salt, self.hash)
+
+
+def parse_mcf(mcf):
+    """Decodes an MCF hash in either format into a ScryptMCF
+
+    Every scrypt_mcf_check accepts the result in place of the hash, so it can
+    be stored and reused to skip decoding the hash on every check.
+    """
+    if not isinstance(mcf, bytes):
+        raise TypeError('MCF must be a byte string')
+    return ScryptMCF(*_scrypt_mcf_decode(mcf)[:5])
+
+
+def _scrypt_mcf_params(mcf):
+    if isinstance(mcf, ScryptMCF):
+        return mcf.N, mcf.r, mcf.p, mcf.salt, mcf.hash, mcf.olen
+    return _scrypt_mcf_decode(mcf)
+
+
+def _compare(h1, h2):
+    """Compares two hashes of equal length in constant time"""
+    cmp = 0
+    for i, j in zip(bytearray(h1), bytearray(h2)):
+        cmp |= i ^ j
+    return cmp == 0
+
+
 def scrypt_mcf(scrypt, password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
                prefix=SCRYPT_MCF_PREFIX_DEFAULT):
     """Derives a Modular Crypt Format hash using the scrypt KDF given
@@ -238,17 +292,398 @@ def scrypt_mcf(scrypt, password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
 def scrypt_mcf_check(scrypt, mcf, password):
     """Returns True if the password matches the given MCF hash
 
-    Supports both the libscrypt $s1$ format and the $7$ format.
+    Supports both the libscrypt $s1$ format and the $7$ format, as well as
+    hashes already decoded by parse_mcf().
     """
-    if not isinstance(mcf, bytes):
+    if not isinstance(mcf, (bytes, ScryptMCF)):
         raise TypeError('MCF must be a byte string')
     if not isinstance(password, bytes):
         raise TypeError('password must be a byte string')
 
-    N, r, p, salt, hash, hlen = _scrypt_mcf_decode(mcf)
+    N, r, p, salt, hash, hlen = _scrypt_mcf_params(mcf)
     h = scrypt(password, salt, N=N, r=r, p=p, olen=hlen)
-    cmp = 0
-    for i, j in zip(bytearray(h), bytearray(hash)):
-        cmp |= i ^ j
-    return cmp == 0
+    return _compare(h, hash)
+
+
+def scrypt_mcf_check_batch(scrypt_batch, pairs):
+    """Returns a list of whether each password matches its MCF hash
+
+    Takes an iterable of (mcf, password) pairs. Those with the same parameters
+    are checked with a single call to the scrypt_batch given, which should have
+    the signature:
+    scrypt_batch(passwords, salts, N, r, p, olen)
+    """
+    pairs = list(pairs)
+    groups = {}
+    for i, (mcf, password) in enumerate(pairs):
+        if not isinstance(mcf, (bytes, ScryptMCF)):
+            raise TypeError('MCF must be a byte string')
+        if not isinstance(password, bytes):
+            raise TypeError('password must be a byte string')
+        N, r, p, salt, hash, hlen = _scrypt_mcf_params(mcf)
+        groups.setdefault((N, r, p, hlen), []).append((i, password, salt, hash))
+
+    out = [False] * len(pairs)
+    for (N, r, p, hlen), group in groups.items():
+        index, passwords, salts, hashes = zip(*group)
+        hs = scrypt_batch(passwords, salts, N, r, p, hlen)
+        for i, h, hash in zip(index, hs, hashes):
+            out[i] = _compare(h, hash)
+    return out
+
+
+
+# Bulk parsing and encoding
+#
+# Hashes created by the same code usually share a layout: the same length with
+# the separators and padding in the same places. Such runs are checked using
+# strided slices of the joined hashes and decoded with a few calls per column
+# instead of per hash. Anything else is parsed one hash at a time.
 
+# Python 2 arrays have no 64-bit type code, use long which usually is
+try:
+    array('Q')
+    _QWORD = 'Q'
+except ValueError:
+    _QWORD = 'L'
+
+# Bytes of a buffer or file parsed at a time
+_CHUNK = 2**20
+
+
+class MCFColumns(object):
+    """Columns of MCF hashes, see parse_mcf_columns()
+
+    prefix, salt, hash and error are lists and N, r and p arrays, with an entry
+    per hash. Hashes that failed to parse have None as prefix, zero parameters,
+    empty salt and hash, and the reason in error. Indexing returns a ScryptMCF.
+    """
+    __slots__ = ('prefix', 'N', 'r', 'p', 'salt', 'hash', 'error')
+
+    def __init__(self, prefix=(), N=(), r=(), p=(), salt=(), hash=(),
+                 error=()):
+        self.prefix = list(prefix)
+        self.N = array(_QWORD, N)
+        self.r = array('L', r)
+        self.p = array('L', p)
+        self.salt = list(salt)
+        self.hash = list(hash)
+        self.error = list(error)
+
+    def __len__(self):
+        return len(self.prefix)
+
+    def __getitem__(self, i):
+        if self.error[i] is not None:
+            raise ValueError(self.error[i])
+        return ScryptMCF(self.N[i], self.r[i], self.p[i], self.salt[i],
+                         self.hash[i])
+
+    def extend(self, other):
+        """Appends the hashes of another MCFColumns"""
+        for name in self.__slots__:
+            getattr(self, name).extend(getattr(other, name))
+
+
+def _parse_rows(rows):
+    """Parses rows one at a time, returning the columns as lists"""
+    cols = [], [], [], [], [], [], []
+    for row in rows:
+        try:
+            N, r, p, salt, hash, hlen = _scrypt_mcf_decode(row)
+            if N >= 2**64:
+                raise ValueError('Unrecognized MCF parameters')
+            prefix = row[:4] if row.startswith(b'$s1$') else row[:3]
+            values = prefix, N, r, p, salt, hash, None
+        except (ValueError, TypeError) as e:
+            values = None, 0, 0, 0, b'', b'', str(e)
+        for col, value in zip(cols, values):
+            col.append(value)
+    return cols
+
+
+def _uniform(data, L, n, pos, char):
+    """Checks that every row of L bytes in data has char at each pos"""
+    return all(data[i::L].count(char) == n for i in pos)
+
+
+def _parse_params(rows, data, L, start, end, decode):
+    """Decodes the parameters at row[start:end] of each row
+
+    Returns lists of N, r, p and errors. Each distinct value is decoded only
+    once, using decode on it.
+    """
+    n = len(rows)
+    row = rows[0]
+    uniform = all(data[i::L] == row[i:i + 1] * n for i in range(start, end))
+    if uniform:
+        keys = [row[start:end]]
+    else:
+        keys = list(map(itemgetter(slice(start, end)), rows))
+
+    params = {}
+    for key in set(keys):
+        try:
+            N, r, p = decode(key)[:3]
+            if N >= 2**64:
+                raise ValueError('Unrecognized MCF parameters')
+            params[key] = N, r, p, None
+        except (ValueError, TypeError) as e:
+            params[key] = 0, 0, 0, str(e)
+    if uniform:
+        return [[v] * n for v in params[keys[0]]]
+    return [list(c) for c in zip(*map(params.__getitem__, keys))]
+
+
+def _parse_s1(rows, L):
+    """Parses $s1$ rows of length L sharing a layout, or returns None"""
+    n = len(rows)
+    data = b''.join(rows)
+    row = rows[0]
+    pos = [i for i, c in enumerate(bytearray(row)) if c == 36]  # '$'
+    if (len(pos) != 4 or pos[:3] != [0, 3, 10] or data.count(b'$') != 4 * n or
+        not _uniform(data, L, n, pos, b'$') or
+        data[1::L] != b's' * n or data[2::L] != b'1' * n):
+        return None
+
+    # Salt and hash must be padded base64 in the same places in every row
+    k = pos[3]
+    ls, lh = k - 11, L - k - 1
+    if ls % 4 or lh % 4:
+        return None
+    ps = ls - len(row[11:k].rstrip(b'='))
+    ph = lh - len(row[k + 1:].rstrip(b'='))
+    pads = list(range(k - ps, k)) + list(range(L - ph, L))
+    if (ps > 2 or ph > 2 or data.count(b'=') != n * (ps + ph) or
+        not _uniform(data, L, n, pads, b'=') or
+        data.translate(None, _b64 + b'$=')):
+        return None
+
+    N, r, p, error = _parse_params(
+        rows, data, L, 4, 10,
+        lambda key: _scrypt_mcf_decode_s1(b'$s1$' + key + b'$$'))
+
+    # With the padding replaced, every field is a whole number of 4-character
+    # groups, so everything decodes at once: 's1' and the parameters to six
+    # bytes, followed by the salt and the hash with their padding as zeros
+    buf = binascii.a2b_base64(data.replace(b'=', b'A'))
+    stride = (8 + ls + lh) * 3 // 4
+    if len(buf) != n * stride:
+        return None
+    s0, h0 = 6, 6 + ls * 3 // 4
+    slen, hlen = ls * 3 // 4 - ps, lh * 3 // 4 - ph
+    end = len(buf)
+    salt = list(map(buf.__getitem__, map(
+        slice, range(s0, end + s0, stride), range(s0 + slen, end + 1, stride))))
+    hash = list(map(buf.__getitem__, map(
+        slice, range(h0, end + h0, stride), range(h0 + hlen, end + 1, stride))))
+
+    prefix = [b'$s1$'] * n
+    for i in compress(range(n), error):
+        prefix[i], salt[i], hash[i] = None, b'', b''
+    return prefix, N, r, p, salt, hash, error
+
+
+def _parse_7(rows, L):
+    """Parses $7$ rows of length L sharing a layout, or returns None"""
+    n = len(rows)
+    data = b''.join(rows)
+    row = rows[0]
+    pos = [i for i, c in enumerate(bytearray(row)) if c == 36]  # '$'
+    if (len(pos) != 3 or pos[:2] != [0, 2] or pos[2] < 14 or
+        data.count(b'$') != 3 * n or not _uniform(data, L, n, pos, b'$') or
+        data[1::L] != b'7' * n):
+        return None
+
+    N, r, p, error = _parse_params(
+        rows, data, L, 3, 14,
+        lambda key: _scrypt_mcf_decode_7(b'$7$' + key + b'$'))
+
+    # The hash is little-endian, so reversing it and translating to the
+    # standard alphabet makes it big-endian base64 with a zero pad in front
+    k = pos[2]
+    salt = list(map(itemgetter(slice(14, k)), rows))
+    hs = list(map(itemgetter(slice(None, k, -1)), rows))
+    if b''.join(hs).translate(None, _cb64):
+        return None
+    lh = L - k - 1
+    pad = b'A' * (-lh % 4)
+    blen, hlen = (lh + len(pad)) * 3 // 4, lh * 6 // 8
+    hs = map(methodcaller('translate', _cb64_to_b64), hs)
+    hs = map(binascii.a2b_base64, map(pad.__add__, hs))
+    stop = blen - 1 - hlen
+    hash = list(map(itemgetter(slice(blen - 1, stop if stop >= 0 else None,
+                                     -1)), hs))
+
+    prefix = [b'$7$'] * n
+    for i in compress(range(n), error):
+        prefix[i], salt[i], hash[i] = None, b'', b''
+    return prefix, N, r, p, salt, hash, error
+
+
+def _parse_group(rows, L):
+    if L > 3 and rows[0].startswith(b'$s1$'):
+        cols = _parse_s1(rows, L)
+    elif L > 2 and rows[0].startswith(b'$7$'):
+        cols = _parse_7(rows, L)
+    else:
+        cols = None
+    return cols or _parse_rows(rows)
+
+
+def parse_mcf_columns(data, sep=b'\n'):
+    """Parses MCF hashes separated by sep into MCFColumns
+
+    data can be bytes or any other buffer, such as an mmap. A trailing
+    separator is ignored. Hashes that fail to parse get an error message in
+    their row instead of failing the whole call.
+
+    Hashes sharing a layout, such as those created by scrypt_mcf with the
+    default salt, are decoded together, many times faster than one at a time.
+    """
+    if not isinstance(data, bytes):
+        # A chunk at a time, so that a large mmap is not copied whole
+        starts = range(0, len(data), _CHUNK)
+        try:
+            view = memoryview(data)
+            chunks = (view[i:i + _CHUNK].tobytes() for i in starts)
+        except TypeError:
+            # An mmap on Python 2, which slices to bytes
+            chunks = (data[i:i + _CHUNK] for i in starts)
+        columns = MCFColumns()
+        for part in _iter_columns(chunks, sep):
+            columns.extend(part)
+        return columns
+    rows = data.split(sep)
+    if not rows[-1]:
+        rows.pop()
+    return _parse_split(rows)
+
+
+def _parse_split(rows):
+    n = len(rows)
+
+    # Group the rows by length and by the kind of hash
+    groups = []
+    lens = list(map(len, rows))
+    for L in set(lens):
+        if L == lens[0] and lens.count(L) == n:
+            idx = list(range(n))
+        else:
+            idx = list(compress(range(n), map(partial(eq, L), lens)))
+        group = list(map(rows.__getitem__, idx))
+        if L < 2:
+            groups.append((idx, _parse_rows(group)))
+            continue
+        kinds = list(bytearray(b''.join(group)[1::L]))
+        for c in set(kinds):
+            if len(kinds) == kinds.count(c):
+                sub, sub_idx = group, idx
+            else:
+                sub = list(compress(group, map(partial(eq, c), kinds)))
+                sub_idx = list(compress(idx, map(partial(eq, c), kinds)))
+            groups.append((sub_idx, _parse_group(sub, L)))
+
+    if len(groups) == 1:
+        return MCFColumns(*groups[0][1])
+
+    # Put the rows back in order
+    order = []
+    cols = [], [], [], [], [], [], []
+    for idx, group in groups:
+        order.extend(idx)
+        for col, values in zip(cols, group):
+            col.extend(values)
+    where = [0] * n
+    for j, i in enumerate(order):
+        where[i] = j
+    return MCFColumns(*[map(col.__getitem__, where) for col in cols])
+
+
+def _iter_columns(chunks, sep):
+    rest = b''
+    for chunk in chunks:
+        chunk = rest + chunk
+        i = chunk.rfind(sep)
+        if i < 0:
+            rest = chunk
+            continue
+        rest = chunk[i + len(sep):]
+        # Every row up to the last separator is whole, even an empty last one
+        yield _parse_split(chunk[:i].split(sep))
+    if rest:
+        yield _parse_split([rest])
+
+
+def iter_mcf_columns(f, sep=b'\n', size=_CHUNK):
+    """Reads MCF hashes separated by sep from file f, yielding MCFColumns
+
+    Reads about size bytes at a time, yielding the hashes in each as soon as
+    they have been parsed.
+    """
+    return _iter_columns(iter(partial(f.read, size), b''), sep)
+
+
+def _encode_prefix(encode, keys, strip):
+    """Returns the parameter part of each hash, encoding each one only once"""
+    params = {}
+    for key in set(keys):
+        params[key] = encode(*(key + (b'', b'')))[:-strip]
+    return map(params.__getitem__, keys)
+
+
+def _encode_7_hashes(hashes):
+    """Encodes hashes of equal length in crypt base64, as _cb64enc"""
+    hlen = len(hashes[0])
+    pad = b'\0' * (3 - hlen % 3)
+    blen, clen = (hlen + len(pad)) * 4 // 3, hlen * 8 // 6 + 1
+    hs = map(pad.__add__, map(itemgetter(slice(None, None, -1)), hashes))
+    hs = map(methodcaller('translate', _b64_to_cb64), map(_b2a, hs))
+    return list(map(itemgetter(slice(blen - 1, blen - 1 - clen, -1)), hs))
+
+
+def encode_mcf_columns(columns, sep=b'\n'):
+    """Encodes MCFColumns back into MCF hashes, each followed by sep
+
+    Each hash is encoded in the format given by its prefix. Rows with an error
+    are left empty, so the output stays aligned with the input.
+    """
+    n = len(columns)
+    out = [b''] * n
+    s1 = list(compress(range(n), map(partial(eq, SCRYPT_MCF_PREFIX_s1),
+                                     columns.prefix)))
+    s7 = list(compress(range(n), map(partial(eq, SCRYPT_MCF_PREFIX_7),
+                                     columns.prefix)))
+    N, r, p = columns.N, columns.r, columns.p
+
+    if s1:
+        get = lambda col: list(map(col.__getitem__, s1))
+        pre = _encode_prefix(_scrypt_mcf_encode_s1,
+                             list(zip(get(N), get(r), get(p))), 2)
+        hs = map(b'$'.join, zip(pre, map(_b2a, get(columns.salt)),
+                                map(_b2a, get(columns.hash))))
+        if len(s1) == n:
+            out = list(hs)
+        else:
+            for i, h in zip(s1, hs):
+                out[i] = h
+
+    if s7:
+        hashes = list(map(columns.hash.__getitem__, s7))
+        lens = list(map(len, hashes))
+        h64 = [None] * len(s7)
+        for L in set(lens):
+            idx = list(compress(range(len(s7)), map(partial(eq, L), lens)))
+            for j, h in zip(idx, _encode_7_hashes(
+                    list(map(hashes.__getitem__, idx)))):
+                h64[j] = h
+        get = lambda col: list(map(col.__getitem__, s7))
+        pre = _encode_prefix(_scrypt_mcf_encode_7,
+                             list(zip(get(N), get(r), get(p))), 2)
+        hs = map(b''.join, zip(pre, get(columns.salt), repeat(b'$'), h64))
+        for i, h in zip(s7, hs):
+            out[i] = h
+
+    if not n:
+        return b''
+    return sep.join(out) + sep
@@ -0,0 +1,252 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Metrics of the time taken by scrypt calls
+
+After enable(), the scrypt, scrypt_into, scrypt_mcf and scrypt_mcf_check
+functions of pylibscrypt record how long each call took, in a latency
+histogram per function, implementation and N, r and p. That includes names
+imported with from pylibscrypt import ... before enable(). Calls that raise
+are also counted as errors. render() returns the metrics in the Prometheus
+text format, e.g. to serve from an HTTP endpoint.
+
+Functions registered with add_hook() are called with the same details after
+each call, to feed other monitoring systems.
+
+Nothing is recorded until enable() is called, and the functions call the
+implementation without wrapping then. Calls through a ScryptContext, aio,
+bulk or an implementation module directly are not recorded.
+"""
+
+
+from collections import namedtuple
+import threading
+
+from . import mcf as mcf_mod
+from .common import (
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, clock)
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class Metrics(object):
+    """Latency histograms and error counts of scrypt calls"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, function, backend, N, r, p, seconds, error=False):
+        """Records a call of function that took seconds
+
+        N, r and p may be None if unknown, e.g. for an invalid MCF hash.
+        """
+        key = (function, backend, N, r, p)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Counts per bucket, sum, count and errors
+                series = self._series[key] = [
+                    [0] * len(self.buckets), 0.0, 0, 0]
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    series[0][i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+            if error:
+                series[3] += 1
+
+    def reset(self):
+        """Forgets everything recorded"""
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        def labels(key, extra=''):
+            values = ['' if v is None else _escape(str(v)) for v in key]
+            return ('{function="%s",backend="%s",N="%s",r="%s",p="%s"%s}' %
+                    tuple(values + [extra]))
+
+        with self._lock:
+            series = [(k, (list(v[0]),) + tuple(v[1:]))
+                      for k, v in self._series.items()]
+        series.sort(key=lambda s: labels(s[0]))
+
+        out = [
+            '# HELP pylibscrypt_duration_seconds Time taken by scrypt calls',
+            '# TYPE pylibscrypt_duration_seconds histogram',
+        ]
+        for key, (counts, total, count, errors) in series:
+            cumulative = 0
+            for le, n in zip(self.buckets, counts):
+                cumulative += n
+                out.append('pylibscrypt_duration_seconds_bucket%s %d' % (
+                    labels(key, ',le="%r"' % le), cumulative))
+            out.append('pylibscrypt_duration_seconds_bucket%s %d' % (
+                labels(key, ',le="+Inf"'), count))
+            out.append('pylibscrypt_duration_seconds_sum%s %r' % (
+                labels(key), total))
+            out.append('pylibscrypt_duration_seconds_count%s %d' % (
+                labels(key), count))
+        out += [
+            '# HELP pylibscrypt_errors_total Scrypt calls that raised',
+            '# TYPE pylibscrypt_errors_total counter',
+        ]
+        for key, (counts, total, count, errors) in series:
+            out.append('pylibscrypt_errors_total%s %d' % (labels(key), errors))
+        return '\n'.join(out) + '\n'
+
+
+REGISTRY = Metrics()
+
+_hooks = [REGISTRY.observe]
+_instrumented = None
+_enable_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """Calls hook(function, backend, N, r, p, seconds, error) after each call
+
+    Hooks run in the calling thread, so should be quick.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stops calling a hook added with add_hook"""
+    _hooks.remove(hook)
+
+
+def _observe(function, backend, N, r, p, start, error):
+    seconds = clock() - start
+    for hook in list(_hooks):
+        hook(function, backend, N, r, p, seconds, error)
+
+
+_Functions = namedtuple('_Functions',
+                        'scrypt scrypt_into scrypt_mcf scrypt_mcf_check')
+
+
+def _instrument(module):
+    backend = module.__name__.rsplit('.', 1)[-1]
+    _scrypt = module.scrypt
+    _scrypt_into = module.scrypt_into
+    _scrypt_mcf = module.scrypt_mcf
+    _scrypt_mcf_check = module.scrypt_mcf_check
+
+    def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
+        t = clock()
+        try:
+            key = _scrypt(password, salt, N, r, p, olen)
+        except Exception:
+            _observe('scrypt', backend, N, r, p, t, True)
+            raise
+        _observe('scrypt', backend, N, r, p, t, False)
+        return key
+
+    def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+        t = clock()
+        try:
+            _scrypt_into(out, password, salt, N, r, p)
+        except Exception:
+            _observe('scrypt_into', backend, N, r, p, t, True)
+            raise
+        _observe('scrypt_into', backend, N, r, p, t, False)
+
+    def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                   prefix=SCRYPT_MCF_PREFIX_DEFAULT):
+        t = clock()
+        try:
+            mcf = _scrypt_mcf(password, salt, N, r, p, prefix)
+        except Exception:
+            _observe('scrypt_mcf', backend, N, r, p, t, True)
+            raise
+        _observe('scrypt_mcf', backend, N, r, p, t, False)
+        return mcf
+
+    def scrypt_mcf_check(mcf, password):
+        t = clock()
+        N = r = p = None
+        try:
+            # Only for the labels, the implementation gets mcf as it was given
+            record = mcf
+            if not isinstance(record, mcf_mod.ScryptMCF):
+                record = mcf_mod.parse_mcf(record)
+            N, r, p = record.N, record.r, record.p
+        except (TypeError, ValueError):
+            # Left for the implementation to raise
+            pass
+        try:
+            ok = _scrypt_mcf_check(mcf, password)
+        except Exception:
+            _observe('scrypt_mcf_check', backend, N, r, p, t, True)
+            raise
+        _observe('scrypt_mcf_check', backend, N, r, p, t, False)
+        return ok
+
+    for f, orig in ((scrypt, _scrypt), (scrypt_into, _scrypt_into),
+                    (scrypt_mcf, _scrypt_mcf),
+                    (scrypt_mcf_check, _scrypt_mcf_check)):
+        f.__doc__ = orig.__doc__
+    return _Functions(scrypt, scrypt_into, scrypt_mcf, scrypt_mcf_check)
+
+
+def enable():
+    """Starts recording the calls of the pylibscrypt functions
+
+    Loads the implementation if not loaded yet, see pylibscrypt.preload().
+    """
+    global _instrumented
+    from . import preload, _route
+    with _enable_lock:
+        if _instrumented is not None:
+            return
+        _instrumented = _instrument(preload())
+        _route(_instrumented)
+
+
+def disable():
+    """Stops recording, calling the implementation directly again"""
+    global _instrumented
+    from . import _route
+    with _enable_lock:
+        if _instrumented is None:
+            return
+        _route(None)
+        _instrumented = None
+
+
+def enabled():
+    """Returns True if calls are being recorded"""
+    return _instrumented is not None
+
+
+def render():
+    """Returns the recorded metrics in the Prometheus text format"""
+    return REGISTRY.render()
+
+
+__all__ = ['BUCKETS', 'Metrics', 'REGISTRY', 'add_hook', 'disable', 'enable',
+           'enabled', 'remove_hook', 'render']
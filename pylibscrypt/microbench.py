@@ -0,0 +1,254 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Microbenchmarks of the pure Python scrypt building blocks
+
+Run as python -m pylibscrypt.microbench to time the kernels of pypyscrypt and
+pypyscrypt_inline, and the MCF codec, one by one, e.g.
+
+    python -m pylibscrypt.microbench -r 8 -k salsa,smix --json out.json
+
+Each kernel is timed in a number of samples, each of enough calls to take
+--min-time seconds. Reported are the mean time per call in nanoseconds and its
+95% confidence interval, from Student's t distribution over the samples.
+
+With --baseline the results are compared to an earlier --json file. Changes
+with confidence intervals that don't overlap are listed, and the exit status
+is 1 if any kernel got slower.
+"""
+
+
+import argparse
+from array import array
+from functools import partial
+import importlib
+from itertools import repeat
+import json
+import math
+import platform
+import socket
+import sys
+
+from . import mcf
+from .common import clock, parse_int
+
+
+# Two-sided 95% critical values of Student's t, by degrees of freedom
+_T95 = (
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042,
+)
+
+MODULES = ('pypyscrypt', 'pypyscrypt_inline')
+
+
+def engine_kernels(module, r=8, N=32):
+    """Returns [(name, function)] of the kernels of a pure Python engine
+
+    The functions take no arguments and call the kernel once, on buffers for
+    r, using the versions specialized for r where the engine has them. The
+    SMix phases run N iterations.
+    """
+    prefix = module.__name__.rsplit('.', 1)[-1] + '.'
+    words = lambda n: array(module._WORD, range(n))
+    B, src, dest = words(16), words(16), words(16)
+    BY, X = words(64 * r), words(64 * r)
+    V = array(module._WORD, [0]) * (32 * r * N)
+
+    blockmix = getattr(module, 'blockmix_salsa8_r%d' % r, None)
+    if blockmix is None:
+        blockmix = module.blockmix_salsa8
+        blockmix_call = partial(blockmix, BY, 32 * r, r)
+    else:
+        blockmix_call = partial(blockmix, BY)
+    fill = getattr(module, 'smix_fill_r%d' % r, module.smix_fill)
+    mix = getattr(module, 'smix_mix_r%d' % r, module.smix_mix)
+
+    return [(prefix + name, f) for name, f in [
+        ('salsa20_8', partial(module.salsa20_8, B, [0] * 16, src, 0, dest, 0)),
+        (blockmix.__name__, blockmix_call),
+        (fill.__name__, partial(fill, X, r, N, V)),
+        (mix.__name__, partial(mix, X, r, N, V)),
+        ('blockxor', partial(module.blockxor, V, 0, X, 0, 32 * r)),
+        ('integerify', partial(module.integerify, X, r)),
+        ('_pbkdf2', partial(module._pbkdf2, 'sha256', b'password', b'NaCl',
+                            1, 128 * r)),
+    ]]
+
+
+def mcf_kernels():
+    """Returns [(name, function)] of the MCF codec kernels"""
+    data = bytes(bytearray(range(64)))
+    s1 = mcf._scrypt_mcf_encode_s1(2**14, 8, 1, data[:16], data)
+    h32 = mcf._cb64enc(data[:32])
+    h7 = mcf._scrypt_mcf_encode_7(2**14, 8, 1, h32, data[32:])
+    return [
+        ('mcf._cb64enc', partial(mcf._cb64enc, data[:32])),
+        ('mcf._cb64dec', partial(mcf._cb64dec, h32)),
+        ('mcf._b64decode', partial(mcf._b64decode, s1.split(b'$')[4])),
+        ('mcf._scrypt_mcf_decode $s1$', partial(mcf._scrypt_mcf_decode, s1)),
+        ('mcf._scrypt_mcf_decode $7$', partial(mcf._scrypt_mcf_decode, h7)),
+    ]
+
+
+def _time(f, loops):
+    t = clock()
+    for _ in repeat(None, loops):
+        f()
+    return clock() - t
+
+
+def _calibrate(f, min_time):
+    # Number of calls that takes at least min_time
+    loops = 1
+    while True:
+        t = _time(f, loops)
+        if t >= min_time:
+            return loops
+        if t <= 0:
+            loops *= 10
+        else:
+            loops = max(loops * 2, int(loops * 1.2 * min_time / t))
+
+
+def _interval(values):
+    # Mean, sample standard deviation and 95% confidence half-width
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return mean, None, None
+    stdev = math.sqrt(sum((v - mean)**2 for v in values) / (n - 1))
+    t = _T95[n - 1] if n - 1 < len(_T95) else 1.960
+    return mean, stdev, t * stdev / math.sqrt(n)
+
+
+def measure(f, samples=20, min_time=0.01):
+    """Times calls of f, returning a dict of the results in nanoseconds
+
+    The mean time per call is reported with the standard deviation of the
+    samples and the half-width of its 95% confidence interval, as well as the
+    fastest sample.
+    """
+    f()
+    loops = _calibrate(f, min_time)
+    times = [_time(f, loops) * 1e9 / loops for _ in range(samples)]
+    mean, stdev, ci = _interval(times)
+    return {
+        'loops': loops,
+        'samples': samples,
+        'mean': mean,
+        'stdev': stdev,
+        'ci': ci,
+        'min': min(times),
+    }
+
+
+def compare(results, baseline):
+    """Returns descriptions of kernels that got slower and faster
+
+    Only changes larger than the two confidence intervals combined count.
+    """
+    base = dict((b['kernel'], b) for b in baseline['results'])
+    slower, faster = [], []
+    for res in results['results']:
+        b = base.get(res['kernel'])
+        if b is None:
+            continue
+        margin = (res['ci'] or 0) + (b['ci'] or 0)
+        line = '%s: %.0f ns, was %.0f ns (%+.1f%%)' % (
+            res['kernel'], res['mean'], b['mean'],
+            100.0 * (res['mean'] / b['mean'] - 1))
+        if res['mean'] - b['mean'] > margin:
+            slower.append(line)
+        elif b['mean'] - res['mean'] > margin:
+            faster.append(line)
+    return slower, faster
+
+
+def _format(result):
+    ci = result['ci']
+    return '%-40s %14.0f %12s %7s' % (
+        result['kernel'], result['mean'],
+        '+-%.0f' % ci if ci is not None else '-',
+        '%.1f%%' % (100.0 * ci / result['mean']) if ci is not None else '-')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pylibscrypt.microbench',
+        description='Times the pure Python scrypt kernels and MCF codec.')
+    parser.add_argument('-k', '--kernels', type=lambda s: s.split(','),
+                        help='comma-separated substrings of the kernel names '
+                             'to run, default all')
+    parser.add_argument('-m', '--modules', type=lambda s: s.split(','),
+                        default=list(MODULES),
+                        help='comma-separated engines, default %s' %
+                             ','.join(MODULES))
+    parser.add_argument('-r', type=int, default=8, help='r, default 8')
+    parser.add_argument('-N', type=parse_int, default=32,
+                        help='iterations of the SMix phases, default 32')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='samples per kernel, default 20')
+    parser.add_argument('--min-time', type=float, default=0.01,
+                        help='seconds per sample, default 0.01')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare to')
+    args = parser.parse_args(argv)
+
+    kernels = []
+    for name in args.modules:
+        module = importlib.import_module('.' + name, __package__)
+        kernels += engine_kernels(module, args.r, args.N)
+    kernels += mcf_kernels()
+    if args.kernels:
+        kernels = [(name, f) for name, f in kernels
+                   if any(k in name for k in args.kernels)]
+
+    results = {
+        'host': socket.gethostname(),
+        'python': '%s %s' % (platform.python_implementation(),
+                             platform.python_version()),
+        'r': args.r,
+        'N': args.N,
+        'results': [],
+    }
+    print('%-40s %14s %12s %7s' % ('kernel', 'ns per call', '95% CI', ''))
+    for name, f in kernels:
+        result = measure(f, args.samples, args.min_time)
+        result['kernel'] = name
+        results['results'].append(result)
+        print(_format(result))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower, faster = compare(results, baseline)
+        for line in slower:
+            print('Slower: ' + line)
+        for line in faster:
+            print('Faster: ' + line)
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Scrypt implementation using NumPy to run the p lanes in parallel
+
+All state is kept in uint32 arrays with the lanes as the last axis, so every
+Salsa20 operation is a single vector operation over the lanes. The words of
+each block are stored in diagonal order, as in SIMD implementations of Salsa20,
+so the four quarter-rounds of a round are computed together as well.
+
+Each NumPy call has a fixed overhead, so this only pays off with several
+lanes. With fewer the pure Python implementation is used instead.
+"""
+
+
+try:
+    import numpy as np
+except ImportError:
+    raise
+except:
+    raise ImportError('numpy failed to import')
+
+from . import mcf as mcf_mod
+from .budget import reserve
+from . import pypyscrypt_inline as scr_mod
+from .common import (
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, xrange,
+    check_args, scrypt_into_copy)
+
+
+# Python 3.4+ have PBKDF2 in hashlib, so use it...
+try:
+    from hashlib import pbkdf2_hmac as _pbkdf2
+except ImportError:
+    # but fall back to Python implementation in < 3.4
+    from .pbkdf2 import pbkdf2_hmac as _pbkdf2
+
+
+# Fewer lanes than this are faster in pure Python
+_min_lanes = 5
+
+# Every lane run in parallel needs its own V, so limit their total size
+_max_mem = 2**28
+
+
+# Word order within blocks; rows are the diagonals of the Salsa20 matrix
+_DIAGONAL = [0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11]
+
+# Row rotations between column and row rounds
+_ROT1 = np.array([1, 2, 3, 0])
+_ROT2 = np.array([2, 3, 0, 1])
+_ROT3 = np.array([3, 0, 1, 2])
+
+
+def R(d, a1, a2, b, t, u):
+    """Four Salsa20 row operations at once"""
+
+    np.add(a1, a2, t)
+    np.left_shift(t, b, u)
+    np.right_shift(t, 32 - b, t)
+    np.bitwise_or(t, u, t)
+    np.bitwise_xor(d, t, d)
+
+
+def salsa20_8(x, s, y, t, u):
+    """Salsa20/8 http://en.wikipedia.org/wiki/Salsa20
+
+    Operates in place on x, a (4, 4, lanes) array of diagonals.
+    s, y, t and u are scratch space.
+    """
+
+    s[...] = x
+    a, b, c, d = x
+    by, cy, dy = y[1:]
+
+    # This is the actual Salsa 20/8: four identical double rounds
+    for i in xrange(4):
+        R(b, a, d, 7, t, u);   R(c, b, a, 9, t, u)
+        R(d, c, b, 13, t, u);  R(a, d, c, 18, t, u)
+        np.take(b, _ROT3, 0, by)
+        np.take(c, _ROT2, 0, cy)
+        np.take(d, _ROT1, 0, dy)
+        R(dy, a, by, 7, t, u); R(cy, dy, a, 9, t, u)
+        R(by, cy, dy, 13, t, u); R(a, by, cy, 18, t, u)
+        np.take(by, _ROT1, 0, b)
+        np.take(cy, _ROT2, 0, c)
+        np.take(dy, _ROT3, 0, d)
+
+    # The latter half is still part of salsa20
+    np.add(x, s, x)
+
+
+def blockmix_salsa8(X, Y, r, tmp):
+    """Blockmix; Used by SMix"""
+
+    x = tmp[0]
+    x[...] = X[2 * r - 1]                              # BlockMix - 1
+
+    for i in xrange(2 * r):                            # BlockMix - 2
+        np.bitwise_xor(x, X[i], x)                     # BlockMix - 3(inner)
+        salsa20_8(*tmp)                                # BlockMix - 3(outer)
+        Y[(i >> 1) + (i & 1) * r] = x                  # BlockMix - 4, 6
+
+    X[...] = Y
+
+
+def smix(X, r, N, V, tmp):
+    """SMix; a specific case of ROMix based on Salsa20/8
+
+    X is the (2 * r, 4, 4, lanes) input and output, V has room for N of them.
+    """
+
+    Y = np.empty_like(X)
+    lanes = np.arange(X.shape[-1])
+
+    for i in xrange(N):                                # ROMix - 2
+        V[i] = X                                       # ROMix - 3
+        blockmix_salsa8(X, Y, r, tmp)                  # ROMix - 4
+
+    for i in xrange(N):                                # ROMix - 6
+        j = X[2 * r - 1, 0, 0] & (N - 1)               # ROMix - 7
+        Vj = V[j, ..., lanes].transpose(1, 2, 3, 0)    # (a block per lane)
+        np.bitwise_xor(X, Vj, X)                       # ROMix - 8(inner)
+        blockmix_salsa8(X, Y, r, tmp)                  # ROMix - 9(outer)
+
+
+def smix_lanes(B, r, N, w):
+    """Runs SMix on every lane in B, w lanes at a time
+
+    B is the little-endian output of the initial PBKDF2. Returns the result in
+    the same format.
+    """
+
+    try:
+        B = B.reshape(-1, 2 * r, 16)[:, :, _DIAGONAL].astype(np.uint32)
+        V = np.empty((N, 2 * r, 4, 4, w), dtype=np.uint32)
+    except (MemoryError, OverflowError, ValueError):
+        raise ValueError("scrypt parameters don't fit in memory")
+
+    for i in xrange(0, len(B), w):
+        X = B[i:i + w].transpose(1, 2, 0).reshape(2 * r, 4, 4, -1)
+        n = X.shape[-1]
+        tmp = (
+            np.empty((4, 4, n), dtype=np.uint32),
+            np.empty((4, 4, n), dtype=np.uint32),
+            np.empty((4, 4, n), dtype=np.uint32),
+            np.empty((4, n), dtype=np.uint32),
+            np.empty((4, n), dtype=np.uint32),
+        )
+        smix(X, r, N, V[..., :n], tmp)
+        B[i:i + w] = X.reshape(2 * r, 16, n).transpose(2, 0, 1)
+
+    out = np.empty(B.shape, dtype='<u4')
+    out[:, :, _DIAGONAL] = B
+    return out
+
+
+def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
+    """Returns a key derived using the scrypt key-derivarion function
+
+    N must be a power of two larger than 1 but no larger than 2 ** 63 (insane)
+    r and p must be positive numbers such that r * p < 2 ** 30
+
+    The default values are:
+    N -- 2**14 (~16k)
+    r -- 8
+    p -- 1
+
+    Memory usage is proportional to N*r. Defaults require about 16 MiB.
+    Time taken is proportional to N*p. Defaults take <100ms of a recent x86.
+
+    The last one differs from libscrypt defaults, but matches the 'interactive'
+    work factor from the original paper. For long term storage where runtime of
+    key derivation is not a problem, you could use 16 as in libscrypt or better
+    yet increase N if memory is plentiful.
+    """
+
+    check_args(password, salt, N, r, p, olen)
+
+    # Run as many lanes at once as fit in the memory limit
+    w = min(p, max(1, _max_mem // (128 * r * N)))
+    if w < _min_lanes:
+        return scr_mod.scrypt(password, salt, N, r, p, olen)
+
+    with reserve(N, r, p, w):
+        # Everything is arrays of 32-bit uints for all but pbkdf2
+        try:
+            B = _pbkdf2('sha256', password, salt, 1, p * 128 * r)
+        except (MemoryError, OverflowError):
+            raise ValueError("scrypt parameters don't fit in memory")
+
+        B = smix_lanes(np.frombuffer(B, dtype='<u4'), r, N, w)
+    return _pbkdf2('sha256', password, B.tobytes(), 1, olen)
+
+
+def scrypt_batch(passwords, salts, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                 olen=64):
+    """Returns a list of keys derived using the scrypt key-derivarion function
+
+    Derives one key for each pair of password and salt, with the same
+    parameters as scrypt(). The lanes of all the derivations are run in
+    parallel, so this is much faster than separate calls to scrypt() when
+    there are several passwords.
+    """
+
+    passwords = list(passwords)
+    salts = list(salts)
+    if len(passwords) != len(salts):
+        raise ValueError('passwords and salts must be of the same length')
+    for password, salt in zip(passwords, salts):
+        check_args(password, salt, N, r, p, olen)
+
+    # Run as many lanes at once as fit in the memory limit
+    k = len(passwords) * p
+    w = min(k, max(1, _max_mem // (128 * r * N)))
+    if w < _min_lanes:
+        return [scr_mod.scrypt(password, salt, N, r, p, olen)
+                for password, salt in zip(passwords, salts)]
+
+    with reserve(N, r, k, w):
+        try:
+            B = b''.join(_pbkdf2('sha256', password, salt, 1, p * 128 * r)
+                         for password, salt in zip(passwords, salts))
+        except (MemoryError, OverflowError):
+            raise ValueError("scrypt parameters don't fit in memory")
+
+        B = smix_lanes(np.frombuffer(B, dtype='<u4'), r, N, w)
+    B = B.reshape(len(passwords), -1)
+    return [_pbkdf2('sha256', password, B[i].tobytes(), 1, olen)
+            for i, password in enumerate(passwords)]
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    scrypt_into_copy(scrypt, out, password, salt, N, r, p)
+
+
+def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+               prefix=SCRYPT_MCF_PREFIX_DEFAULT):
+    """Derives a Modular Crypt Format hash using the scrypt KDF
+
+    Parameter space is smaller than for scrypt():
+    N must be a power of two larger than 1 but no larger than 2 ** 31
+    r and p must be positive numbers between 1 and 255
+    Salt must be a byte string 1-16 bytes long.
+
+    If no salt is given, a random salt of 128+ bits is used. (Recommended.)
+    """
+    return mcf_mod.scrypt_mcf(scrypt, password, salt, N, r, p, prefix)
+
+
+def scrypt_mcf_check(mcf, password):
+    """Returns True if the password matches the given MCF hash"""
+    return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
+
+
+def scrypt_mcf_check_batch(pairs):
+    """Returns a list of whether each password matches its MCF hash
+
+    Takes an iterable of (mcf, password) pairs. Hashes that share parameters
+    are checked together using scrypt_batch().
+    """
+    return mcf_mod.scrypt_mcf_check_batch(scrypt_batch, pairs)
+
+
+__all__ = ['scrypt', 'scrypt_batch', 'scrypt_into', 'scrypt_mcf',
+           'scrypt_mcf_check', 'scrypt_mcf_check_batch']
+
+
+if __name__ == "__main__":
+    import sys
+    from . import tests
+    tests.run_scrypt_suite(sys.modules[__name__])
@@ -0,0 +1,222 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Picks scrypt parameters for a time and memory limit
+
+Like pickparams of the tarsnap scrypt utility, pick_params() returns the
+strongest N, r and p that take at most a given time and memory here. It uses
+a model of the time taken, a fixed overhead plus a cost per block of 128 * r
+bytes, i.e. linear in N * r * p. The model is calibrated by timing the
+implementation once and stored in costmodel.json in the autotune cache
+directory, separately for each host, Python version and implementation.
+
+Run as python -m pylibscrypt.pickparams, e.g.
+
+    python -m pylibscrypt.pickparams -t 0.1 -m 64M
+    python -m pylibscrypt.pickparams --predict 2**20,8,1
+"""
+
+
+import argparse
+import importlib
+import os
+import sys
+
+from .budget import get_budget, memory_required
+from .cachedir import cache_dir, host_key, read_json, update_json
+from .common import SCRYPT_r, clock, parse_int
+
+
+# Calibration doubles N until a derivation takes this long
+CALIBRATION_TIME = 0.1
+
+# Largest parameters picked, as supported by the MCF formats
+_MAX_N = 2**31
+_MAX_P = 255
+
+
+class CostModel(object):
+    """Time taken by an implementation, overhead + per_block * N * r * p"""
+
+    def __init__(self, overhead, per_block):
+        self.overhead = overhead
+        self.per_block = per_block
+
+    def predict(self, N, r, p):
+        """Returns the seconds a derivation is expected to take"""
+        return self.overhead + self.per_block * N * r * p
+
+    def __repr__(self):
+        return 'CostModel(%r, %r)' % (self.overhead, self.per_block)
+
+
+def _module(backend):
+    if backend is None:
+        from . import preload
+        return preload()
+    return importlib.import_module('.' + backend, __package__)
+
+
+def _time(module, N, r):
+    # Fastest of three, as small N is noisy
+    times = []
+    for _ in range(3):
+        t = clock()
+        module.scrypt(b'password', b'NaCl', N, r, 1)
+        times.append(clock() - t)
+    return min(times)
+
+
+def calibrate(module, min_time=CALIBRATION_TIME):
+    """Returns a CostModel for module, timed on this host
+
+    N is doubled until a derivation takes min_time, and the model fitted to
+    the last two times.
+    """
+    r = SCRYPT_r
+    N, t = 2**6, _time(module, 2**6, r)
+    prev = None
+    while t < min_time and N < 2**20:
+        prev = N, t
+        N *= 2
+        t = _time(module, N, r)
+    if prev is None or t <= prev[1]:
+        return CostModel(0.0, t / (N * r))
+    per_block = (t - prev[1]) / ((N - prev[0]) * r)
+    return CostModel(max(0.0, prev[1] - per_block * prev[0] * r), per_block)
+
+
+def cost_model(backend=None, path=None, refresh=False):
+    """Returns the CostModel of an implementation, by default the one in use
+
+    backend is a module name as in autotune.BACKENDS. The model is read from
+    path, by default costmodel.json in cachedir.cache_dir(), or calibrated and
+    stored there if missing or refresh is set.
+    """
+    module = _module(backend)
+    if path is None:
+        path = os.path.join(cache_dir(), 'costmodel.json')
+    key = host_key(module.__name__.rsplit('.', 1)[-1])
+    entry = read_json(path).get(key) if not refresh else None
+    try:
+        return CostModel(float(entry['overhead']), float(entry['per_block']))
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    model = calibrate(module)
+    update_json(path, key,
+                {'overhead': model.overhead, 'per_block': model.per_block})
+    return model
+
+
+def predict(N, r, p, backend=None, path=None):
+    """Returns the seconds scrypt with N, r and p is expected to take here"""
+    return cost_model(backend, path).predict(N, r, p)
+
+
+def _physical_memory():
+    # Bytes of RAM, or None if unknown, e.g. on Windows
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def pick_params(max_time, max_mem=None, backend=None, r=SCRYPT_r, path=None):
+    """Returns the strongest (N, r, p) within max_time seconds and max_mem
+
+    max_mem is in bytes and defaults to the memory budget if limited, else
+    half the physical memory, like in the tarsnap scrypt utility. N is made
+    as large as both allow, then p as large as the time allows. Both stay
+    small enough for scrypt_mcf. Raises ValueError if not even N = 2 fits.
+    """
+    model = cost_model(backend, path)
+    if max_mem is None:
+        max_mem = get_budget().limit
+    if max_mem is None:
+        memory = _physical_memory()
+        if memory is not None:
+            max_mem = memory // 2
+
+    def fits(N, p):
+        if max_mem is not None and memory_required(N, r, p) > max_mem:
+            return False
+        return model.predict(N, r, p) <= max_time
+
+    if not fits(2, 1):
+        raise ValueError('no scrypt parameters fit in %gs and %s bytes' %
+                         (max_time, max_mem))
+    N = 2
+    while N < _MAX_N and fits(N * 2, 1):
+        N *= 2
+    p = 1
+    while p < _MAX_P and fits(N, p + 1):
+        p += 1
+    return N, r, p
+
+
+def _size(s):
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def _params(s):
+    N, r, p = (parse_int(v) for v in s.split(','))
+    return N, r, p
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pylibscrypt.pickparams',
+        description='Picks scrypt parameters for a time and memory limit.')
+    parser.add_argument('-t', '--max-time', type=float, default=0.1,
+                        help='seconds a derivation may take, default 0.1')
+    parser.add_argument('-m', '--max-mem', type=_size,
+                        help='bytes a derivation may use, e.g. 64M, default '
+                             'the memory budget or half the RAM')
+    parser.add_argument('-r', type=int, default=SCRYPT_r,
+                        help='r, default %d' % SCRYPT_r)
+    parser.add_argument('-b', '--backend',
+                        help='implementation, default the one in use')
+    parser.add_argument('--predict', type=_params, metavar='N,r,p',
+                        help='only print the time N,r,p is expected to take')
+    parser.add_argument('--refresh', action='store_true',
+                        help='calibrate again instead of using the stored '
+                             'model')
+    args = parser.parse_args(argv)
+
+    model = cost_model(args.backend, refresh=args.refresh)
+    if args.predict:
+        print('%.4g s' % model.predict(*args.predict))
+        return 0
+    try:
+        N, r, p = pick_params(args.max_time, args.max_mem, args.backend,
+                              args.r)
+    except ValueError as e:
+        print(e)
+        return 1
+    print('N=2**%d r=%d p=%d (%.4g s, %.1f MiB)' % (
+        N.bit_length() - 1, r, p, model.predict(N, r, p),
+        memory_required(N, r, p) / 2.0**20))
+    return 0
+
+
+__all__ = ['CostModel', 'calibrate', 'cost_model', 'pick_params', 'predict']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,26 +20,37 @@ import ctypes
 from ctypes import c_char_p, c_size_t, c_uint64, c_uint32
 from ctypes.util import find_library
 import os
+import threading
 
 from .common import (
     SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_s1,
-    SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY, check_args)
+    SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY, check_args,
+    check_into_args)
 from . import mcf as mcf_mod
+from .budget import get_budget, memory_required, reserve
+from .libload import buffer_arg, load_library
 
 
-_libscrypt_soname = find_library('scrypt')
-if _libscrypt_soname is None:
+def _find_libscrypt():
+    soname = find_library('scrypt')
+    if soname is None:
+        return None
+    try:
+        return ctypes.CDLL(soname)
+    except OSError:
+        raise ImportError('Unable to load libscrypt: ' + soname)
+
+
+_libscrypt = load_library('libscrypt', 'libscrypt_scrypt', _find_libscrypt)
+if _libscrypt is None:
     raise ImportError('Unable to find libscrypt')
 
 try:
-    _libscrypt = ctypes.CDLL(_libscrypt_soname)
     _libscrypt_scrypt = _libscrypt.libscrypt_scrypt
     _libscrypt_mcf = _libscrypt.libscrypt_mcf
     _libscrypt_check = _libscrypt.libscrypt_check
-except OSError:
-    raise ImportError('Unable to load libscrypt: ' + _libscrypt_soname)
 except AttributeError:
-    raise ImportError('Incompatible libscrypt: ' + _libscrypt_soname)
+    raise ImportError('Incompatible libscrypt: ' + _libscrypt._name)
 
 _libscrypt_scrypt.argtypes = [
     c_char_p,  # password
@@ -90,14 +101,58 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     check_args(password, salt, N, r, p, olen)
 
     out = ctypes.create_string_buffer(olen)
-    ret = _libscrypt_scrypt(password, len(password), salt, len(salt),
-                          N, r, p, out, len(out))
+    with reserve(N, r, p):
+        ret = _libscrypt_scrypt(password, len(password), salt, len(salt),
+                                N, r, p, out, len(out))
     if ret:
         raise ValueError
 
     return out.raw
 
 
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+
+    Writable buffers are passed to libscrypt without copying.
+    """
+    out, password, salt = check_into_args(out, password, salt, N, r, p)
+
+    with reserve(N, r, p):
+        ret = _libscrypt_scrypt(buffer_arg(password), len(password),
+                                buffer_arg(salt), len(salt), N, r, p,
+                                buffer_arg(out), len(out))
+    if ret:
+        raise ValueError
+
+
+def _prepare(N, r, p, olen):
+    """Returns scrypt(password, salt) for parameters already checked
+
+    Each thread reuses its own output buffer.
+    """
+    m = memory_required(N, r, p)
+    local = threading.local()
+
+    def scrypt(password, salt):
+        try:
+            out = local.out
+        except AttributeError:
+            out = local.out = ctypes.create_string_buffer(olen)
+        budget = get_budget()
+        budget.acquire(m)
+        try:
+            ret = _libscrypt_scrypt(password, len(password), salt, len(salt),
+                                    N, r, p, out, olen)
+        finally:
+            budget.release(m)
+        if ret:
+            raise ValueError
+        return out.raw
+    return scrypt
+
+
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
                prefix=SCRYPT_MCF_PREFIX_DEFAULT):
     """Derives a Modular Crypt Format hash using the scrypt KDF
@@ -142,15 +197,18 @@ def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
 
 def scrypt_mcf_check(mcf, password):
     """Returns True if the password matches the given MCF hash"""
-    if not isinstance(mcf, bytes):
+    if not isinstance(mcf, (bytes, mcf_mod.ScryptMCF)):
         raise TypeError('MCF must be a byte string')
     if not isinstance(password, bytes):
         raise TypeError('password must be a byte string')
-    if len(mcf) != 124 or b'\0' in password:
+    if (isinstance(mcf, mcf_mod.ScryptMCF) or len(mcf) != 124 or
+        b'\0' in password):
         return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
 
+    N, r, p = mcf_mod._scrypt_mcf_decode(mcf)[:3]
     mcfbuf = ctypes.create_string_buffer(mcf)
-    ret = _libscrypt_check(mcfbuf, password)
+    with reserve(N, r, p):
+        ret = _libscrypt_check(mcfbuf, password)
     if ret < 0:
         return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
 
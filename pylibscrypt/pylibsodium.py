@@ -18,13 +18,17 @@
 import ctypes
 from ctypes import c_char_p, c_size_t, c_uint64, c_uint32, c_void_p
 import platform
+import threading
 from warnings import catch_warnings, filterwarnings
 
 from . import mcf as mcf_mod
 from . import libsodium_load
+from .libload import buffer_arg
+from .budget import get_budget, memory_required, reserve
 from .common import (
     SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_7, SCRYPT_MCF_PREFIX_s1,
-    SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY, check_args)
+    SCRYPT_MCF_PREFIX_DEFAULT, SCRYPT_MCF_PREFIX_ANY, check_args,
+    check_into_args, scrypt_into_copy)
 
 if platform.python_implementation() == 'PyPy':
     from . import pypyscrypt_inline as scr_mod
@@ -125,26 +129,93 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
 
     if _scrypt_ll:
         out = ctypes.create_string_buffer(olen)
-        if _scrypt_ll(password, len(password), salt, len(salt),
-                      N, r, p, out, olen):
-            raise ValueError
+        with reserve(N, r, p):
+            if _scrypt_ll(password, len(password), salt, len(salt),
+                          N, r, p, out, olen):
+                raise ValueError
         return out.raw
 
     if len(salt) != _scrypt_salt or r != 8 or (p & (p - 1)) or (N*p <= 512):
         return scr_mod.scrypt(password, salt, N, r, p, olen)
 
-    s = next(i for i in range(1, 64) if 2**i == N)
-    t = next(i for i in range(0, 30) if 2**i == p)
+    s = N.bit_length() - 1
+    t = p.bit_length() - 1
     m = 2**(10 + s)
     o = 2**(5 + t + s)
     if s > 53 or t + s > 58:
         raise ValueError
     out = ctypes.create_string_buffer(olen)
-    if _scrypt(out, olen, password, len(password), salt, o, m) != 0:
-        raise ValueError
+    with reserve(N, r, p):
+        if _scrypt(out, olen, password, len(password), salt, o, m) != 0:
+            raise ValueError
     return out.raw
 
 
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+
+    If libsodium has the low-level scrypt, writable buffers are passed to it
+    without copying.
+    """
+    if not _scrypt_ll:
+        return scrypt_into_copy(scrypt, out, password, salt, N, r, p)
+    out, password, salt = check_into_args(out, password, salt, N, r, p)
+
+    with reserve(N, r, p):
+        if _scrypt_ll(buffer_arg(password), len(password),
+                      buffer_arg(salt), len(salt), N, r, p,
+                      buffer_arg(out), len(out)):
+            raise ValueError
+
+
+def _prepare(N, r, p, olen):
+    """Returns scrypt(password, salt) for parameters already checked
+
+    Each thread reuses its own output buffer.
+    """
+    size = memory_required(N, r, p)
+    local = threading.local()
+
+    if _scrypt_ll:
+        def call(out, password, salt):
+            return _scrypt_ll(password, len(password), salt, len(salt),
+                              N, r, p, out, olen)
+    else:
+        s = N.bit_length() - 1
+        t = p.bit_length() - 1
+        if (r != 8 or (p & (p - 1)) or (N*p <= 512) or
+            s > 53 or t + s > 58):
+            return lambda password, salt: scrypt(password, salt, N, r, p,
+                                                 olen)
+        m = 2**(10 + s)
+        o = 2**(5 + t + s)
+
+        def call(out, password, salt):
+            if len(salt) != _scrypt_salt:
+                return None
+            return _scrypt(out, olen, password, len(password), salt, o, m)
+
+    def prepared(password, salt):
+        try:
+            out = local.out
+        except AttributeError:
+            out = local.out = ctypes.create_string_buffer(olen)
+        budget = get_budget()
+        budget.acquire(size)
+        try:
+            ret = call(out, password, salt)
+        finally:
+            budget.release(size)
+        if ret is None:
+            return scr_mod.scrypt(password, salt, N, r, p, olen)
+        if ret:
+            raise ValueError
+        return out.raw
+    return prepared
+
+
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
                prefix=SCRYPT_MCF_PREFIX_DEFAULT):
     """Derives a Modular Crypt Format hash using the scrypt KDF
@@ -171,12 +242,14 @@ def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
         _scrypt_ll):
         return mcf_mod.scrypt_mcf(scrypt, password, salt, N, r, p, prefix)
 
-    s = next(i for i in range(1, 32) if 2**i == N)
-    t = next(i for i in range(0, 8) if 2**i == p)
+    s = N.bit_length() - 1
+    t = p.bit_length() - 1
     m = 2**(10 + s)
     o = 2**(5 + t + s)
     mcf = ctypes.create_string_buffer(102)
-    if _scrypt_str(mcf, password, len(password), o, m) != 0:
+    with reserve(N, r, p):
+        ret = _scrypt_str(mcf, password, len(password), o, m)
+    if ret != 0:
         return mcf_mod.scrypt_mcf(scrypt, password, salt, N, r, p, prefix)
 
     if prefix in (SCRYPT_MCF_PREFIX_7, SCRYPT_MCF_PREFIX_ANY):
@@ -189,10 +262,14 @@ def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
 
 def scrypt_mcf_check(mcf, password):
     """Returns True if the password matches the given MCF hash"""
+    if isinstance(mcf, mcf_mod.ScryptMCF):
+        return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
     if not isinstance(mcf, bytes):
         raise TypeError('MCF must be a byte string')
     if mcf_mod._scrypt_mcf_7_is_standard(mcf) and not _scrypt_ll:
-        return _scrypt_str_chk(mcf, password, len(password)) == 0
+        N, r, p = mcf_mod._scrypt_mcf_decode_7(mcf)[:3]
+        with reserve(N, r, p):
+            return _scrypt_str_chk(mcf, password, len(password)) == 0
     return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
 
 
@@ -32,9 +32,10 @@ from warnings import warn
 
 from . import mcf as mcf_mod
 from . import libsodium_load
+from .budget import reserve
 from .common import (
     SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, xrange,
-    check_args)
+    check_args, scrypt_into_copy)
 
 
 _libsodium = libsodium_load.get_libsodium()
@@ -162,22 +163,32 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
 
     check_args(password, salt, N, r, p, olen)
 
-    # Everything is lists of 64-bit uints for all but pbkdf2
-    try:
-        B  = _pbkdf2('sha256', password, salt, 1, p * 128 * r)
-        B  = list(struct.unpack('<%dQ' % (len(B) // 8), B))
-        XY = [0] * (32 * r)
-        V  = [0] * (16 * r * N)
-    except (MemoryError, OverflowError):
-        raise ValueError("scrypt parameters don't fit in memory")
+    with reserve(N, r, p):
+        # Everything is lists of 64-bit uints for all but pbkdf2
+        try:
+            B  = _pbkdf2('sha256', password, salt, 1, p * 128 * r)
+            B  = list(struct.unpack('<%dQ' % (len(B) // 8), B))
+            XY = [0] * (32 * r)
+            V  = [0] * (16 * r * N)
+        except (MemoryError, OverflowError):
+            raise ValueError("scrypt parameters don't fit in memory")
 
-    for i in xrange(p):
-        smix(B, i * 16 * r, r, N, V, XY)
+        for i in xrange(p):
+            smix(B, i * 16 * r, r, N, V, XY)
+        del XY, V
 
     B = struct.pack('<%dQ' % len(B), *B)
     return _pbkdf2('sha256', password, B, 1, olen)
 
 
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    scrypt_into_copy(scrypt, out, password, salt, N, r, p)
+
+
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
                prefix=SCRYPT_MCF_PREFIX_DEFAULT):
     """Derives a Modular Crypt Format hash using the scrypt KDF
@@ -32,12 +32,21 @@
 # https://github.com/wg/scrypt
 
 
-import struct
+from array import array
+import errno
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
 
 from . import mcf as mcf_mod
+from .budget import reserve
 from .common import (
     SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, xrange,
-    check_args)
+    check_args, scrypt_into_copy)
+from .stages import StageTimer, marker
 
 
 # Python 3.4+ have PBKDF2 in hashlib, so use it...
@@ -48,6 +57,32 @@ except ImportError:
     from .pbkdf2 import pbkdf2_hmac as _pbkdf2
 
 
+# Arrays of 32-bit uints take a fraction of the memory of lists of ints
+_WORD = 'I' if array('I').itemsize == 4 else 'L'
+try:
+    _tobytes = array.tobytes
+except AttributeError:
+    # Python 2
+    _tobytes = array.tostring
+
+
+# Number of worker processes to run the p lanes in, None runs them serially.
+# Each worker needs its own V, so memory usage grows accordingly. They are
+# started on first use and kept for later calls.
+workers = None
+
+# Called with the stages of each derivation if set, see stages.py
+profile_hook = None
+
+# Where V is kept when running the lanes serially. None is an array in memory.
+# True maps anonymous memory, which still needs RAM plus swap for V, and a
+# directory name a temporary file there, so that derivations larger than RAM
+# can page to disk. The file is allocated on disk up front, while anonymous
+# memory is only allocated as used. Both are hinted for sequential or random
+# access in the loops of SMix. Requires Python 3.
+map_v = None
+
+
 def array_overwrite(source, s_start, dest, d_start, length):
     dest[d_start:d_start + length] = source[s_start:s_start + length]
 
@@ -112,23 +147,158 @@ def blockmix_salsa8(BY, Yi, r):
         array_overwrite(BY, Yi + (i*2 + 1) * 16, BY, (i + r) * 16, 16)
 
 
-def smix(B, Bi, r, N, V, X):
-    """SMix; a specific case of ROMix based on Salsa20/8"""
-
-    array_overwrite(B, Bi, X, 0, 32 * r)               # ROMix - 1
+def smix_fill(X, r, N, V):
+    """First loop of SMix, filling V sequentially"""
 
     for i in xrange(N):                                # ROMix - 2
         array_overwrite(X, 0, V, i * (32 * r), 32 * r) # ROMix - 3
         blockmix_salsa8(X, 32 * r, r)                  # ROMix - 4
 
+
+def smix_mix(X, r, N, V):
+    """Second loop of SMix, reading V in random order"""
+
     for i in xrange(N):                                # ROMix - 6
         j = integerify(X, r) & (N - 1)                 # ROMix - 7
         blockxor(V, j * (32 * r), X, 0, 32 * r)        # ROMix - 8(inner)
         blockmix_salsa8(X, 32 * r, r)                  # ROMix - 9(outer)
 
+
+def smix(B, Bi, r, N, V, X):
+    """SMix; a specific case of ROMix based on Salsa20/8"""
+
+    array_overwrite(B, Bi, X, 0, 32 * r)               # ROMix - 1
+    smix_fill(X, r, N, V)
+    smix_mix(X, r, N, V)
     array_overwrite(X, 0, B, Bi, 32 * r)               # ROMix - 10
 
 
+# SMix specialized for some values of r, generated by inline.py
+_smix_r = {}
+_smix_fill_r = {}
+_smix_mix_r = {}
+
+
+def _allocate(f, size):
+    """Allocates size bytes of disk for file f, raising OSError if full"""
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        # Not supported by the file system
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    zeros = b'\0' * min(size, 2**20)
+    for _ in xrange(size // len(zeros)):
+        f.write(zeros)
+    f.write(zeros[:size % len(zeros)])
+    f.flush()
+
+
+def map_words(n, path=None):
+    """Returns a memory map of n 32-bit words and a memoryview of them
+
+    The map is of anonymous memory, or of a temporary file in directory path.
+    The file is allocated first, as writing to a map of a sparse file on a
+    full disk kills the process with SIGBUS.
+    """
+    if not hasattr(memoryview, 'cast'):
+        raise ValueError('mapping V requires Python 3')
+    size = n * array(_WORD).itemsize
+    if path is None:
+        m = mmap.mmap(-1, size)
+    else:
+        with tempfile.TemporaryFile(dir=path) as f:
+            _allocate(f, size)
+            m = mmap.mmap(f.fileno(), size)
+    return m, memoryview(m).cast(_WORD)
+
+
+def _advise(m, advice):
+    # Access pattern hint, where supported (Python 3.8+)
+    if m is not None and hasattr(m, 'madvise') and hasattr(mmap, advice):
+        m.madvise(getattr(mmap, advice))
+
+
+def smix_lane(args):
+    """Runs SMix on a single lane; used by worker processes"""
+
+    B, r, N = args
+    XY = array(_WORD, [0]) * (64 * r)
+    V  = array(_WORD, [0]) * (32 * r * N)
+    _smix_r.get(r, smix)(B, 0, r, N, V, XY)
+    return B
+
+
+_pool = None
+_pool_key = None
+# Calls using each pool, so that a replaced one is shut down once unused
+_pool_users = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """Returns the pool of worker processes, starting it if needed
+
+    Each call must be paired with _put_pool() once done with the pool.
+    """
+
+    global _pool, _pool_key, _pool_users
+    # A forked child can't use the pools of its parent
+    key = (workers, os.getpid())
+    unused = None
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool_key is not None and _pool_key[1] != key[1]:
+                _pool_users = {}
+            elif _pool is not None and not _pool_users[_pool]:
+                unused = _pool
+                del _pool_users[unused]
+            _pool = multiprocessing.Pool(workers)
+            _pool_key = key
+            _pool_users[_pool] = 0
+        pool = _pool
+        _pool_users[pool] += 1
+    if unused is not None:
+        _shut_down(unused)
+    return pool
+
+
+def _put_pool(pool):
+    """Releases a pool from _get_pool(), shutting it down if replaced"""
+
+    with _pool_lock:
+        _pool_users[pool] -= 1
+        unused = pool is not _pool and not _pool_users[pool]
+        if unused:
+            del _pool_users[pool]
+    if unused:
+        _shut_down(pool)
+
+
+def _shut_down(pool):
+    pool.close()
+    pool.join()
+
+
+def smix_lanes(B, r, N, p, workers):
+    """Runs SMix on the p lanes of B in a pool of worker processes"""
+
+    lanes = [(B[i * 32 * r:(i + 1) * 32 * r], r, N) for i in xrange(p)]
+    pool = _get_pool(workers)
+    try:
+        lanes = pool.map(smix_lane, lanes)
+    except (MemoryError, OverflowError):
+        raise ValueError("scrypt parameters don't fit in memory")
+    finally:
+        _put_pool(pool)
+
+    for i in xrange(p):
+        B[i * 32 * r:(i + 1) * 32 * r] = lanes[i]
+
+
 def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     """Returns a key derived using the scrypt key-derivarion function
 
@@ -148,23 +318,106 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     key derivation is not a problem, you could use 16 as in libscrypt or better
     yet increase N if memory is plentiful.
     """
+    if profile_hook is not None:
+        key, stages = scrypt_profile(password, salt, N, r, p, olen)
+        profile_hook(stages)
+        return key
+    return _scrypt(password, salt, N, r, p, olen)
+
+
+def scrypt_profile(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                   olen=64):
+    """Like scrypt(), but returns the key and the stages of the derivation
+
+    The stages are a dict of the time taken by each, see stages.py.
+    """
+    timer = StageTimer()
+    key = _scrypt(password, salt, N, r, p, olen, timer)
+    return key, timer.stages
+
 
+def _scrypt(password, salt, N, r, p, olen, timer=None):
     check_args(password, salt, N, r, p, olen)
+    mark = marker(timer)
 
-    # Everything is lists of 32-bit uints for all but pbkdf2
+    # Everything is arrays of 32-bit uints for all but pbkdf2
     try:
         B  = _pbkdf2('sha256', password, salt, 1, p * 128 * r)
-        B  = list(struct.unpack('<%dI' % (len(B) // 4), B))
-        XY = [0] * (64 * r)
-        V  = [0] * (32 * r * N)
+        mark('pbkdf2_in')
+        B  = array(_WORD, B)
     except (MemoryError, OverflowError):
         raise ValueError("scrypt parameters don't fit in memory")
-
-    for i in xrange(p):
-        smix(B, i * 32 * r, r, N, V, XY)
-
-    B = struct.pack('<%dI' % len(B), *B)
-    return _pbkdf2('sha256', password, B, 1, olen)
+    if sys.byteorder == 'big':
+        B.byteswap()
+    mark('unpack')
+
+    if workers and workers > 1 and p > 1:
+        with reserve(N, r, p, min(workers, p)):
+            smix_lanes(B, r, N, p, workers)
+        mark('lanes')
+    else:
+        path = map_v
+        # A file-backed V is written back to its file, which was allocated on
+        # disk, rather than kept in memory, so only the rest counts
+        file_backed = path is not None and path is not True
+        with reserve(N, r, p, 0 if file_backed else 1):
+            Vmap = None
+            try:
+                XY = array(_WORD, [0]) * (64 * r)
+                if path is None:
+                    V  = array(_WORD, [0]) * (32 * r * N)
+                else:
+                    Vmap, V = map_words(32 * r * N,
+                                        None if path is True else path)
+            except (MemoryError, OverflowError):
+                raise ValueError("scrypt parameters don't fit in memory")
+            except EnvironmentError as e:
+                if e.errno != errno.ENOMEM:
+                    raise
+                raise ValueError("scrypt parameters don't fit in memory")
+            mark('alloc')
+
+            if timer is None and Vmap is None:
+                smix_r = _smix_r.get(r, smix)
+                for i in xrange(p):
+                    smix_r(B, i * 32 * r, r, N, V, XY)
+            else:
+                # The loops of SMix separately, to time them or hint the
+                # access pattern
+                fill = _smix_fill_r.get(r, smix_fill)
+                mix = _smix_mix_r.get(r, smix_mix)
+                for i in xrange(p):
+                    array_overwrite(B, i * 32 * r, XY, 0, 32 * r)
+                    mark('unpack')
+                    _advise(Vmap, 'MADV_SEQUENTIAL')
+                    fill(XY, r, N, V)
+                    mark('fill')
+                    _advise(Vmap, 'MADV_RANDOM')
+                    mix(XY, r, N, V)
+                    mark('mix')
+                    array_overwrite(XY, 0, B, i * 32 * r, 32 * r)
+                    mark('pack')
+            if Vmap is not None:
+                V.release()
+                Vmap.close()
+            del XY, V
+            mark('alloc')
+
+    if sys.byteorder == 'big':
+        B.byteswap()
+    B = _tobytes(B)
+    mark('pack')
+    key = _pbkdf2('sha256', password, B, 1, olen)
+    mark('pbkdf2_out')
+    return key
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    scrypt_into_copy(scrypt, out, password, salt, N, r, p)
 
 
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
@@ -186,7 +439,8 @@ def scrypt_mcf_check(mcf, password):
     return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
 
 
-__all__ = ['scrypt', 'scrypt_mcf', 'scrypt_mcf_check']
+__all__ = ['scrypt', 'scrypt_into', 'scrypt_mcf', 'scrypt_mcf_check',
+           'scrypt_profile']
 
 
 if __name__ == "__main__":
@@ -34,12 +34,21 @@
 # https://github.com/wg/scrypt
 
 
-import struct
+from array import array
+import errno
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
 
 from . import mcf as mcf_mod
+from .budget import reserve
 from .common import (
     SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, xrange,
-    check_args)
+    check_args, scrypt_into_copy)
+from .stages import StageTimer, marker
 
 
 # Python 3.4+ have PBKDF2 in hashlib, so use it...
@@ -50,6 +59,32 @@ except ImportError:
     from .pbkdf2 import pbkdf2_hmac as _pbkdf2
 
 
+# Arrays of 32-bit uints take a fraction of the memory of lists of ints
+_WORD = 'I' if array('I').itemsize == 4 else 'L'
+try:
+    _tobytes = array.tobytes
+except AttributeError:
+    # Python 2
+    _tobytes = array.tostring
+
+
+# Number of worker processes to run the p lanes in, None runs them serially.
+# Each worker needs its own V, so memory usage grows accordingly. They are
+# started on first use and kept for later calls.
+workers = None
+
+# Called with the stages of each derivation if set, see stages.py
+profile_hook = None
+
+# Where V is kept when running the lanes serially. None is an array in memory.
+# True maps anonymous memory, which still needs RAM plus swap for V, and a
+# directory name a temporary file there, so that derivations larger than RAM
+# can page to disk. The file is allocated on disk up front, while anonymous
+# memory is only allocated as used. Both are hinted for sequential or random
+# access in the loops of SMix. Requires Python 3.
+map_v = None
+
+
 def blockxor(source, s_start, dest, d_start, length):
     for i in xrange(length):
         dest[d_start + i] ^= source[s_start + i]
@@ -66,80 +101,91 @@ def salsa20_8(B, x, src, s_start, dest, d_start):
     """Salsa20/8 http://en.wikipedia.org/wiki/Salsa20"""
 
     # Merged blockxor for speed
-    for i in xrange(16):
-        x[i] = B[i] = B[i] ^ src[s_start + i]
+    (x0, x1, x2, x3, x4, x5, x6, x7,
+     x8, x9, x10, x11, x12, x13, x14, x15) = (
+     j0, j1, j2, j3, j4, j5, j6, j7,
+     j8, j9, j10, j11, j12, j13, j14, j15) = [
+        a ^ b for a, b in zip(B, src[s_start:s_start + 16])]
 
     # This is the actual Salsa 20/8: four identical double rounds
     for i in xrange(4):
-        a = (x[0]+x[12]) & 0xffffffff
-        b = (x[5]+x[1]) & 0xffffffff
-        x[4] ^= (a << 7) | (a >> 25)
-        x[9] ^= (b << 7) | (b >> 25)
-        a = (x[10]+x[6]) & 0xffffffff
-        b = (x[15]+x[11]) & 0xffffffff
-        x[14] ^= (a << 7) | (a >> 25)
-        x[3] ^= (b << 7) | (b >> 25)
-        a = (x[4]+x[0]) & 0xffffffff
-        b = (x[9]+x[5]) & 0xffffffff
-        x[8] ^= (a << 9) | (a >> 23)
-        x[13] ^= (b << 9) | (b >> 23)
-        a = (x[14]+x[10]) & 0xffffffff
-        b = (x[3]+x[15]) & 0xffffffff
-        x[2] ^= (a << 9) | (a >> 23)
-        x[7] ^= (b << 9) | (b >> 23)
-        a = (x[8]+x[4]) & 0xffffffff
-        b = (x[13]+x[9]) & 0xffffffff
-        x[12] ^= (a << 13) | (a >> 19)
-        x[1] ^= (b << 13) | (b >> 19)
-        a = (x[2]+x[14]) & 0xffffffff
-        b = (x[7]+x[3]) & 0xffffffff
-        x[6] ^= (a << 13) | (a >> 19)
-        x[11] ^= (b << 13) | (b >> 19)
-        a = (x[12]+x[8]) & 0xffffffff
-        b = (x[1]+x[13]) & 0xffffffff
-        x[0] ^= (a << 18) | (a >> 14)
-        x[5] ^= (b << 18) | (b >> 14)
-        a = (x[6]+x[2]) & 0xffffffff
-        b = (x[11]+x[7]) & 0xffffffff
-        x[10] ^= (a << 18) | (a >> 14)
-        x[15] ^= (b << 18) | (b >> 14)
-        a = (x[0]+x[3]) & 0xffffffff
-        b = (x[5]+x[4]) & 0xffffffff
-        x[1] ^= (a << 7) | (a >> 25)
-        x[6] ^= (b << 7) | (b >> 25)
-        a = (x[10]+x[9]) & 0xffffffff
-        b = (x[15]+x[14]) & 0xffffffff
-        x[11] ^= (a << 7) | (a >> 25)
-        x[12] ^= (b << 7) | (b >> 25)
-        a = (x[1]+x[0]) & 0xffffffff
-        b = (x[6]+x[5]) & 0xffffffff
-        x[2] ^= (a << 9) | (a >> 23)
-        x[7] ^= (b << 9) | (b >> 23)
-        a = (x[11]+x[10]) & 0xffffffff
-        b = (x[12]+x[15]) & 0xffffffff
-        x[8] ^= (a << 9) | (a >> 23)
-        x[13] ^= (b << 9) | (b >> 23)
-        a = (x[2]+x[1]) & 0xffffffff
-        b = (x[7]+x[6]) & 0xffffffff
-        x[3] ^= (a << 13) | (a >> 19)
-        x[4] ^= (b << 13) | (b >> 19)
-        a = (x[8]+x[11]) & 0xffffffff
-        b = (x[13]+x[12]) & 0xffffffff
-        x[9] ^= (a << 13) | (a >> 19)
-        x[14] ^= (b << 13) | (b >> 19)
-        a = (x[3]+x[2]) & 0xffffffff
-        b = (x[4]+x[7]) & 0xffffffff
-        x[0] ^= (a << 18) | (a >> 14)
-        x[5] ^= (b << 18) | (b >> 14)
-        a = (x[9]+x[8]) & 0xffffffff
-        b = (x[14]+x[13]) & 0xffffffff
-        x[10] ^= (a << 18) | (a >> 14)
-        x[15] ^= (b << 18) | (b >> 14)
+        a = (x0+x12) & 0xffffffff
+        b = (x5+x1) & 0xffffffff
+        x4 ^= (a << 7) | (a >> 25)
+        x9 ^= (b << 7) | (b >> 25)
+        a = (x10+x6) & 0xffffffff
+        b = (x15+x11) & 0xffffffff
+        x14 ^= (a << 7) | (a >> 25)
+        x3 ^= (b << 7) | (b >> 25)
+        a = (x4+x0) & 0xffffffff
+        b = (x9+x5) & 0xffffffff
+        x8 ^= (a << 9) | (a >> 23)
+        x13 ^= (b << 9) | (b >> 23)
+        a = (x14+x10) & 0xffffffff
+        b = (x3+x15) & 0xffffffff
+        x2 ^= (a << 9) | (a >> 23)
+        x7 ^= (b << 9) | (b >> 23)
+        a = (x8+x4) & 0xffffffff
+        b = (x13+x9) & 0xffffffff
+        x12 ^= (a << 13) | (a >> 19)
+        x1 ^= (b << 13) | (b >> 19)
+        a = (x2+x14) & 0xffffffff
+        b = (x7+x3) & 0xffffffff
+        x6 ^= (a << 13) | (a >> 19)
+        x11 ^= (b << 13) | (b >> 19)
+        a = (x12+x8) & 0xffffffff
+        b = (x1+x13) & 0xffffffff
+        x0 ^= (a << 18) | (a >> 14)
+        x5 ^= (b << 18) | (b >> 14)
+        a = (x6+x2) & 0xffffffff
+        b = (x11+x7) & 0xffffffff
+        x10 ^= (a << 18) | (a >> 14)
+        x15 ^= (b << 18) | (b >> 14)
+        a = (x0+x3) & 0xffffffff
+        b = (x5+x4) & 0xffffffff
+        x1 ^= (a << 7) | (a >> 25)
+        x6 ^= (b << 7) | (b >> 25)
+        a = (x10+x9) & 0xffffffff
+        b = (x15+x14) & 0xffffffff
+        x11 ^= (a << 7) | (a >> 25)
+        x12 ^= (b << 7) | (b >> 25)
+        a = (x1+x0) & 0xffffffff
+        b = (x6+x5) & 0xffffffff
+        x2 ^= (a << 9) | (a >> 23)
+        x7 ^= (b << 9) | (b >> 23)
+        a = (x11+x10) & 0xffffffff
+        b = (x12+x15) & 0xffffffff
+        x8 ^= (a << 9) | (a >> 23)
+        x13 ^= (b << 9) | (b >> 23)
+        a = (x2+x1) & 0xffffffff
+        b = (x7+x6) & 0xffffffff
+        x3 ^= (a << 13) | (a >> 19)
+        x4 ^= (b << 13) | (b >> 19)
+        a = (x8+x11) & 0xffffffff
+        b = (x13+x12) & 0xffffffff
+        x9 ^= (a << 13) | (a >> 19)
+        x14 ^= (b << 13) | (b >> 19)
+        a = (x3+x2) & 0xffffffff
+        b = (x4+x7) & 0xffffffff
+        x0 ^= (a << 18) | (a >> 14)
+        x5 ^= (b << 18) | (b >> 14)
+        a = (x9+x8) & 0xffffffff
+        b = (x14+x13) & 0xffffffff
+        x10 ^= (a << 18) | (a >> 14)
+        x15 ^= (b << 18) | (b >> 14)
 
     # While we are handling the data, write it to the correct dest.
     # The latter half is still part of salsa20
-    for i in xrange(16):
-        dest[d_start + i] = B[i] = (x[i] + B[i]) & 0xffffffff
+    dest[d_start:d_start + 16] = B[:] = array(_WORD, (
+        (x0 + j0) & 0xffffffff, (x1 + j1) & 0xffffffff,
+        (x2 + j2) & 0xffffffff, (x3 + j3) & 0xffffffff,
+        (x4 + j4) & 0xffffffff, (x5 + j5) & 0xffffffff,
+        (x6 + j6) & 0xffffffff, (x7 + j7) & 0xffffffff,
+        (x8 + j8) & 0xffffffff, (x9 + j9) & 0xffffffff,
+        (x10 + j10) & 0xffffffff, (x11 + j11) & 0xffffffff,
+        (x12 + j12) & 0xffffffff, (x13 + j13) & 0xffffffff,
+        (x14 + j14) & 0xffffffff, (x15 + j15) & 0xffffffff,
+    ))
 
 
 def blockmix_salsa8(BY, Yi, r):
@@ -159,23 +205,319 @@ def blockmix_salsa8(BY, Yi, r):
         BY[(i + r) * 16:((i + r) * 16)+(16)] = BY[Yi + (i*2 + 1) * 16:(Yi + (i*2 + 1) * 16)+(16)]
 
 
-def smix(B, Bi, r, N, V, X):
-    """SMix; a specific case of ROMix based on Salsa20/8"""
-
-    X[0:(0)+(32 * r)] = B[Bi:(Bi)+(32 * r)]
+def smix_fill(X, r, N, V):
+    """First loop of SMix, filling V sequentially"""
 
     for i in xrange(N):                                # ROMix - 2
         V[i * (32 * r):(i * (32 * r))+(32 * r)] = X[0:(0)+(32 * r)]
         blockmix_salsa8(X, 32 * r, r)                  # ROMix - 4
 
+
+def smix_mix(X, r, N, V):
+    """Second loop of SMix, reading V in random order"""
+
     for i in xrange(N):                                # ROMix - 6
         j = integerify(X, r) & (N - 1)                 # ROMix - 7
         blockxor(V, j * (32 * r), X, 0, 32 * r)        # ROMix - 8(inner)
         blockmix_salsa8(X, 32 * r, r)                  # ROMix - 9(outer)
 
+
+def smix(B, Bi, r, N, V, X):
+    """SMix; a specific case of ROMix based on Salsa20/8"""
+
+    X[0:(0)+(32 * r)] = B[Bi:(Bi)+(32 * r)]
+    smix_fill(X, r, N, V)
+    smix_mix(X, r, N, V)
     B[Bi:(Bi)+(32 * r)] = X[0:(0)+(32 * r)]
 
 
+# SMix specialized for some values of r, generated by inline.py
+def blockmix_salsa8_r1(BY):
+    """Blockmix for r = 1; Used by SMix"""
+
+    X = BY[16:32]
+    tmp = [0]*16
+
+    salsa20_8(X, tmp, BY, 0, BY, 32)
+    salsa20_8(X, tmp, BY, 16, BY, 48)
+
+    BY[0:32] = BY[32:64]
+
+
+def smix_fill_r1(X, r, N, V):
+    """First loop of SMix for r = 1"""
+
+    for i in xrange(0, 32 * N, 32):
+        V[i:i + 32] = X[0:32]
+        blockmix_salsa8_r1(X)
+
+
+def smix_mix_r1(X, r, N, V):
+    """Second loop of SMix for r = 1"""
+
+    for i in xrange(N):
+        j = (X[16] & (N - 1)) * 32
+        Vj = V[j:j + 32]
+        X[0:32] = array(_WORD, [a ^ b for a, b in zip(X, Vj)])
+        blockmix_salsa8_r1(X)
+
+
+def smix_r1(B, Bi, r, N, V, X):
+    """SMix for r = 1"""
+
+    X[0:32] = B[Bi:Bi + 32]
+    smix_fill_r1(X, r, N, V)
+    smix_mix_r1(X, r, N, V)
+    B[Bi:Bi + 32] = X[0:32]
+
+
+def blockmix_salsa8_r8(BY):
+    """Blockmix for r = 8; Used by SMix"""
+
+    X = BY[240:256]
+    tmp = [0]*16
+
+    salsa20_8(X, tmp, BY, 0, BY, 256)
+    salsa20_8(X, tmp, BY, 16, BY, 384)
+    salsa20_8(X, tmp, BY, 32, BY, 272)
+    salsa20_8(X, tmp, BY, 48, BY, 400)
+    salsa20_8(X, tmp, BY, 64, BY, 288)
+    salsa20_8(X, tmp, BY, 80, BY, 416)
+    salsa20_8(X, tmp, BY, 96, BY, 304)
+    salsa20_8(X, tmp, BY, 112, BY, 432)
+    salsa20_8(X, tmp, BY, 128, BY, 320)
+    salsa20_8(X, tmp, BY, 144, BY, 448)
+    salsa20_8(X, tmp, BY, 160, BY, 336)
+    salsa20_8(X, tmp, BY, 176, BY, 464)
+    salsa20_8(X, tmp, BY, 192, BY, 352)
+    salsa20_8(X, tmp, BY, 208, BY, 480)
+    salsa20_8(X, tmp, BY, 224, BY, 368)
+    salsa20_8(X, tmp, BY, 240, BY, 496)
+
+    BY[0:256] = BY[256:512]
+
+
+def smix_fill_r8(X, r, N, V):
+    """First loop of SMix for r = 8"""
+
+    for i in xrange(0, 256 * N, 256):
+        V[i:i + 256] = X[0:256]
+        blockmix_salsa8_r8(X)
+
+
+def smix_mix_r8(X, r, N, V):
+    """Second loop of SMix for r = 8"""
+
+    for i in xrange(N):
+        j = (X[240] & (N - 1)) * 256
+        Vj = V[j:j + 256]
+        X[0:256] = array(_WORD, [a ^ b for a, b in zip(X, Vj)])
+        blockmix_salsa8_r8(X)
+
+
+def smix_r8(B, Bi, r, N, V, X):
+    """SMix for r = 8"""
+
+    X[0:256] = B[Bi:Bi + 256]
+    smix_fill_r8(X, r, N, V)
+    smix_mix_r8(X, r, N, V)
+    B[Bi:Bi + 256] = X[0:256]
+
+
+def blockmix_salsa8_r16(BY):
+    """Blockmix for r = 16; Used by SMix"""
+
+    X = BY[496:512]
+    tmp = [0]*16
+
+    salsa20_8(X, tmp, BY, 0, BY, 512)
+    salsa20_8(X, tmp, BY, 16, BY, 768)
+    salsa20_8(X, tmp, BY, 32, BY, 528)
+    salsa20_8(X, tmp, BY, 48, BY, 784)
+    salsa20_8(X, tmp, BY, 64, BY, 544)
+    salsa20_8(X, tmp, BY, 80, BY, 800)
+    salsa20_8(X, tmp, BY, 96, BY, 560)
+    salsa20_8(X, tmp, BY, 112, BY, 816)
+    salsa20_8(X, tmp, BY, 128, BY, 576)
+    salsa20_8(X, tmp, BY, 144, BY, 832)
+    salsa20_8(X, tmp, BY, 160, BY, 592)
+    salsa20_8(X, tmp, BY, 176, BY, 848)
+    salsa20_8(X, tmp, BY, 192, BY, 608)
+    salsa20_8(X, tmp, BY, 208, BY, 864)
+    salsa20_8(X, tmp, BY, 224, BY, 624)
+    salsa20_8(X, tmp, BY, 240, BY, 880)
+    salsa20_8(X, tmp, BY, 256, BY, 640)
+    salsa20_8(X, tmp, BY, 272, BY, 896)
+    salsa20_8(X, tmp, BY, 288, BY, 656)
+    salsa20_8(X, tmp, BY, 304, BY, 912)
+    salsa20_8(X, tmp, BY, 320, BY, 672)
+    salsa20_8(X, tmp, BY, 336, BY, 928)
+    salsa20_8(X, tmp, BY, 352, BY, 688)
+    salsa20_8(X, tmp, BY, 368, BY, 944)
+    salsa20_8(X, tmp, BY, 384, BY, 704)
+    salsa20_8(X, tmp, BY, 400, BY, 960)
+    salsa20_8(X, tmp, BY, 416, BY, 720)
+    salsa20_8(X, tmp, BY, 432, BY, 976)
+    salsa20_8(X, tmp, BY, 448, BY, 736)
+    salsa20_8(X, tmp, BY, 464, BY, 992)
+    salsa20_8(X, tmp, BY, 480, BY, 752)
+    salsa20_8(X, tmp, BY, 496, BY, 1008)
+
+    BY[0:512] = BY[512:1024]
+
+
+def smix_fill_r16(X, r, N, V):
+    """First loop of SMix for r = 16"""
+
+    for i in xrange(0, 512 * N, 512):
+        V[i:i + 512] = X[0:512]
+        blockmix_salsa8_r16(X)
+
+
+def smix_mix_r16(X, r, N, V):
+    """Second loop of SMix for r = 16"""
+
+    for i in xrange(N):
+        j = (X[496] & (N - 1)) * 512
+        Vj = V[j:j + 512]
+        X[0:512] = array(_WORD, [a ^ b for a, b in zip(X, Vj)])
+        blockmix_salsa8_r16(X)
+
+
+def smix_r16(B, Bi, r, N, V, X):
+    """SMix for r = 16"""
+
+    X[0:512] = B[Bi:Bi + 512]
+    smix_fill_r16(X, r, N, V)
+    smix_mix_r16(X, r, N, V)
+    B[Bi:Bi + 512] = X[0:512]
+
+
+_smix_r = {1: smix_r1, 8: smix_r8, 16: smix_r16}
+_smix_fill_r = {1: smix_fill_r1, 8: smix_fill_r8, 16: smix_fill_r16}
+_smix_mix_r = {1: smix_mix_r1, 8: smix_mix_r8, 16: smix_mix_r16}
+
+
+def _allocate(f, size):
+    """Allocates size bytes of disk for file f, raising OSError if full"""
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        # Not supported by the file system
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    zeros = b'\0' * min(size, 2**20)
+    for _ in xrange(size // len(zeros)):
+        f.write(zeros)
+    f.write(zeros[:size % len(zeros)])
+    f.flush()
+
+
+def map_words(n, path=None):
+    """Returns a memory map of n 32-bit words and a memoryview of them
+
+    The map is of anonymous memory, or of a temporary file in directory path.
+    The file is allocated first, as writing to a map of a sparse file on a
+    full disk kills the process with SIGBUS.
+    """
+    if not hasattr(memoryview, 'cast'):
+        raise ValueError('mapping V requires Python 3')
+    size = n * array(_WORD).itemsize
+    if path is None:
+        m = mmap.mmap(-1, size)
+    else:
+        with tempfile.TemporaryFile(dir=path) as f:
+            _allocate(f, size)
+            m = mmap.mmap(f.fileno(), size)
+    return m, memoryview(m).cast(_WORD)
+
+
+def _advise(m, advice):
+    # Access pattern hint, where supported (Python 3.8+)
+    if m is not None and hasattr(m, 'madvise') and hasattr(mmap, advice):
+        m.madvise(getattr(mmap, advice))
+
+
+def smix_lane(args):
+    """Runs SMix on a single lane; used by worker processes"""
+
+    B, r, N = args
+    XY = array(_WORD, [0]) * (64 * r)
+    V  = array(_WORD, [0]) * (32 * r * N)
+    _smix_r.get(r, smix)(B, 0, r, N, V, XY)
+    return B
+
+
+_pool = None
+_pool_key = None
+# Calls using each pool, so that a replaced one is shut down once unused
+_pool_users = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """Returns the pool of worker processes, starting it if needed
+
+    Each call must be paired with _put_pool() once done with the pool.
+    """
+
+    global _pool, _pool_key, _pool_users
+    # A forked child can't use the pools of its parent
+    key = (workers, os.getpid())
+    unused = None
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool_key is not None and _pool_key[1] != key[1]:
+                _pool_users = {}
+            elif _pool is not None and not _pool_users[_pool]:
+                unused = _pool
+                del _pool_users[unused]
+            _pool = multiprocessing.Pool(workers)
+            _pool_key = key
+            _pool_users[_pool] = 0
+        pool = _pool
+        _pool_users[pool] += 1
+    if unused is not None:
+        _shut_down(unused)
+    return pool
+
+
+def _put_pool(pool):
+    """Releases a pool from _get_pool(), shutting it down if replaced"""
+
+    with _pool_lock:
+        _pool_users[pool] -= 1
+        unused = pool is not _pool and not _pool_users[pool]
+        if unused:
+            del _pool_users[pool]
+    if unused:
+        _shut_down(pool)
+
+
+def _shut_down(pool):
+    pool.close()
+    pool.join()
+
+
+def smix_lanes(B, r, N, p, workers):
+    """Runs SMix on the p lanes of B in a pool of worker processes"""
+
+    lanes = [(B[i * 32 * r:(i + 1) * 32 * r], r, N) for i in xrange(p)]
+    pool = _get_pool(workers)
+    try:
+        lanes = pool.map(smix_lane, lanes)
+    except (MemoryError, OverflowError):
+        raise ValueError("scrypt parameters don't fit in memory")
+    finally:
+        _put_pool(pool)
+
+    for i in xrange(p):
+        B[i * 32 * r:(i + 1) * 32 * r] = lanes[i]
+
+
 def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     """Returns a key derived using the scrypt key-derivarion function
 
@@ -195,23 +537,106 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     key derivation is not a problem, you could use 16 as in libscrypt or better
     yet increase N if memory is plentiful.
     """
+    if profile_hook is not None:
+        key, stages = scrypt_profile(password, salt, N, r, p, olen)
+        profile_hook(stages)
+        return key
+    return _scrypt(password, salt, N, r, p, olen)
+
+
+def scrypt_profile(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
+                   olen=64):
+    """Like scrypt(), but returns the key and the stages of the derivation
+
+    The stages are a dict of the time taken by each, see stages.py.
+    """
+    timer = StageTimer()
+    key = _scrypt(password, salt, N, r, p, olen, timer)
+    return key, timer.stages
 
+
+def _scrypt(password, salt, N, r, p, olen, timer=None):
     check_args(password, salt, N, r, p, olen)
+    mark = marker(timer)
 
-    # Everything is lists of 32-bit uints for all but pbkdf2
+    # Everything is arrays of 32-bit uints for all but pbkdf2
     try:
         B  = _pbkdf2('sha256', password, salt, 1, p * 128 * r)
-        B  = list(struct.unpack('<%dI' % (len(B) // 4), B))
-        XY = [0] * (64 * r)
-        V  = [0] * (32 * r * N)
+        mark('pbkdf2_in')
+        B  = array(_WORD, B)
     except (MemoryError, OverflowError):
         raise ValueError("scrypt parameters don't fit in memory")
-
-    for i in xrange(p):
-        smix(B, i * 32 * r, r, N, V, XY)
-
-    B = struct.pack('<%dI' % len(B), *B)
-    return _pbkdf2('sha256', password, B, 1, olen)
+    if sys.byteorder == 'big':
+        B.byteswap()
+    mark('unpack')
+
+    if workers and workers > 1 and p > 1:
+        with reserve(N, r, p, min(workers, p)):
+            smix_lanes(B, r, N, p, workers)
+        mark('lanes')
+    else:
+        path = map_v
+        # A file-backed V is written back to its file, which was allocated on
+        # disk, rather than kept in memory, so only the rest counts
+        file_backed = path is not None and path is not True
+        with reserve(N, r, p, 0 if file_backed else 1):
+            Vmap = None
+            try:
+                XY = array(_WORD, [0]) * (64 * r)
+                if path is None:
+                    V  = array(_WORD, [0]) * (32 * r * N)
+                else:
+                    Vmap, V = map_words(32 * r * N,
+                                        None if path is True else path)
+            except (MemoryError, OverflowError):
+                raise ValueError("scrypt parameters don't fit in memory")
+            except EnvironmentError as e:
+                if e.errno != errno.ENOMEM:
+                    raise
+                raise ValueError("scrypt parameters don't fit in memory")
+            mark('alloc')
+
+            if timer is None and Vmap is None:
+                smix_r = _smix_r.get(r, smix)
+                for i in xrange(p):
+                    smix_r(B, i * 32 * r, r, N, V, XY)
+            else:
+                # The loops of SMix separately, to time them or hint the
+                # access pattern
+                fill = _smix_fill_r.get(r, smix_fill)
+                mix = _smix_mix_r.get(r, smix_mix)
+                for i in xrange(p):
+                    XY[0:(0)+(32 * r)] = B[i * 32 * r:(i * 32 * r)+(32 * r)]
+                    mark('unpack')
+                    _advise(Vmap, 'MADV_SEQUENTIAL')
+                    fill(XY, r, N, V)
+                    mark('fill')
+                    _advise(Vmap, 'MADV_RANDOM')
+                    mix(XY, r, N, V)
+                    mark('mix')
+                    B[i * 32 * r:(i * 32 * r)+(32 * r)] = XY[0:(0)+(32 * r)]
+                    mark('pack')
+            if Vmap is not None:
+                V.release()
+                Vmap.close()
+            del XY, V
+            mark('alloc')
+
+    if sys.byteorder == 'big':
+        B.byteswap()
+    B = _tobytes(B)
+    mark('pack')
+    key = _pbkdf2('sha256', password, B, 1, olen)
+    mark('pbkdf2_out')
+    return key
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    scrypt_into_copy(scrypt, out, password, salt, N, r, p)
 
 
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
@@ -233,7 +658,8 @@ def scrypt_mcf_check(mcf, password):
     return mcf_mod.scrypt_mcf_check(scrypt, mcf, password)
 
 
-__all__ = ['scrypt', 'scrypt_mcf', 'scrypt_mcf_check']
+__all__ = ['scrypt', 'scrypt_into', 'scrypt_mcf', 'scrypt_mcf_check',
+           'scrypt_profile']
 
 
 if __name__ == "__main__":
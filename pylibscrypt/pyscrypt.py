@@ -23,8 +23,10 @@ except:
     raise ImportError('scrypt module failed to import')
 
 from . import mcf as mcf_mod
+from .budget import get_budget, memory_required, reserve
 from .common import (
-    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, check_args)
+    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_MCF_PREFIX_DEFAULT, check_args,
+    scrypt_into_copy)
 
 
 # scrypt < 0.6 doesn't support hash length
@@ -55,10 +57,37 @@ def scrypt(password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p, olen=64):
     """
     check_args(password, salt, N, r, p, olen)
 
-    try:
-        return _scrypt(password=password, salt=salt, N=N, r=r, p=p, buflen=olen)
-    except:
-        raise ValueError
+    with reserve(N, r, p):
+        try:
+            return _scrypt(password=password, salt=salt, N=N, r=r, p=p,
+                           buflen=olen)
+        except:
+            raise ValueError
+
+
+def _prepare(N, r, p, olen):
+    """Returns scrypt(password, salt) for parameters already checked"""
+    m = memory_required(N, r, p)
+
+    def scrypt(password, salt):
+        budget = get_budget()
+        budget.acquire(m)
+        try:
+            return _scrypt(password=password, salt=salt, N=N, r=r, p=p,
+                           buflen=olen)
+        except:
+            raise ValueError
+        finally:
+            budget.release(m)
+    return scrypt
+
+
+def scrypt_into(out, password, salt, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p):
+    """Derives a key like scrypt(), writing it into the buffer out
+
+    password and salt may be any buffers, and the key is as long as out.
+    """
+    scrypt_into_copy(scrypt, out, password, salt, N, r, p)
 
 
 def scrypt_mcf(password, salt=None, N=SCRYPT_N, r=SCRYPT_r, p=SCRYPT_p,
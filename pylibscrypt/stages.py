@@ -0,0 +1,173 @@
+# Copyright (c) 2014-2017, Jan Varho
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Time taken by the stages of the pure Python scrypt
+
+pypyscrypt and pypyscrypt_inline have scrypt_profile(), which returns the key
+along with the stages of the derivation, and profile_hook, which if set is
+called with the stages of every derivation. The stages, in order, are:
+
+    pbkdf2_in   the PBKDF2 expanding password and salt into B
+    unpack      converting B to 32-bit words and copying lanes out of it
+    alloc       allocating and freeing V and the work buffer
+    fill        the first loop of SMix, writing V
+    mix         the second loop of SMix, reading V in random order
+    lanes       SMix of all lanes, when run in worker processes
+    pack        copying lanes back and converting B to bytes
+    pbkdf2_out  the final PBKDF2
+
+Each is a dict with the seconds taken. While tracemalloc is tracing, it also
+has the change in traced memory in bytes and in the number of memory blocks,
+and on Python 3.9+ the peak of traced memory above that at the start. Tracing
+makes the pure Python code hundreds of times slower though, as most of the
+arithmetic allocates, so the times of a traced run are not comparable.
+
+Run as python -m pylibscrypt.stages to print them for given parameters, e.g.
+
+    python -m pylibscrypt.stages -N 2**12 -r 8 -p 2 --tracemalloc
+"""
+
+
+from collections import OrderedDict
+import importlib
+import sys
+
+from .common import clock, parse_int
+
+
+STAGES = ('pbkdf2_in', 'unpack', 'alloc', 'fill', 'mix', 'lanes', 'pack',
+          'pbkdf2_out')
+
+
+def _tracemalloc():
+    # Imported only when needed, as the implementations import this module
+    try:
+        import tracemalloc
+    except ImportError:
+        # Python < 3.4
+        return None
+    return tracemalloc
+
+
+class StageTimer(object):
+    """Accumulates the time, and memory use if traced, of each stage
+
+    stages maps the name of each stage to a dict of its totals, in the order
+    of their first mark.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        tracemalloc = self._tracemalloc = _tracemalloc()
+        self._trace = tracemalloc is not None and tracemalloc.is_tracing()
+        self._peak = self._trace and hasattr(tracemalloc, 'reset_peak')
+        self._memory()
+        self._last = clock()
+
+    def _memory(self):
+        if self._trace:
+            tracemalloc = self._tracemalloc
+            self._bytes = tracemalloc.get_traced_memory()[0]
+            self._blocks = len(tracemalloc.take_snapshot().traces)
+            if self._peak:
+                tracemalloc.reset_peak()
+
+    def mark(self, name):
+        """Ends stage name, which started at the previous mark"""
+        elapsed = clock() - self._last
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'seconds': 0.0}
+            if self._trace:
+                stage.update(bytes=0, blocks=0)
+                if self._peak:
+                    stage['peak'] = 0
+        stage['seconds'] += elapsed
+        if self._trace:
+            tracemalloc = self._tracemalloc
+            start = self._bytes
+            current, peak = tracemalloc.get_traced_memory()
+            blocks = len(tracemalloc.take_snapshot().traces)
+            stage['bytes'] += current - start
+            stage['blocks'] += blocks - self._blocks
+            if self._peak:
+                stage['peak'] = max(stage['peak'], peak - start)
+            self._memory()
+        self._last = clock()
+
+
+def _no_mark(name):
+    pass
+
+
+def marker(timer):
+    """Returns the mark method of timer, or a no-op if timer is None"""
+    return _no_mark if timer is None else timer.mark
+
+
+def _format(stages):
+    total = sum(s['seconds'] for s in stages.values()) or 1
+    lines = ['%-10s %10s %6s %12s %12s %8s' % (
+        'stage', 'seconds', '', 'bytes', 'peak', 'blocks')]
+    for name, s in stages.items():
+        lines.append('%-10s %10.6f %5.1f%% %12s %12s %8s' % (
+            name, s['seconds'], 100.0 * s['seconds'] / total,
+            s.get('bytes', '-'), s.get('peak', '-'), s.get('blocks', '-')))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    # Not imported above, as the implementations import this module
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m pylibscrypt.stages',
+        description='Times the stages of the pure Python scrypt.')
+    parser.add_argument('-m', '--module', default='pypyscrypt_inline',
+                        help='pypyscrypt or pypyscrypt_inline (default)')
+    parser.add_argument('-N', type=parse_int, default=2**10,
+                        help='N, default 2**10')
+    parser.add_argument('-r', type=int, default=8, help='r, default 8')
+    parser.add_argument('-p', type=int, default=1, help='p, default 1')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also trace memory allocations')
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module('.' + args.module, __package__)
+    tracemalloc = _tracemalloc()
+    if args.tracemalloc and tracemalloc is None:
+        parser.error('tracemalloc requires Python 3.4+')
+    key, stages = module.scrypt_profile(b'password', b'NaCl',
+                                        args.N, args.r, args.p)
+    if args.tracemalloc:
+        # Tracing slows the pure Python code down by orders of magnitude, so
+        # only the memory use is taken from a traced run
+        tracemalloc.start()
+        try:
+            key, traced = module.scrypt_profile(b'password', b'NaCl',
+                                                args.N, args.r, args.p)
+        finally:
+            tracemalloc.stop()
+        for name, stage in traced.items():
+            stage['seconds'] = stages[name]['seconds']
+        stages = traced
+    print(_format(stages))
+    return 0
+
+
+__all__ = ['STAGES', 'StageTimer', 'marker']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
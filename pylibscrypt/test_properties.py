@@ -159,6 +159,12 @@ if __name__ == "__main__":
     except ImportError:
         suite.addTest(load_scrypt_suite('pylibsodium_salsaTests', None, ref))
 
+    try:
+        from . import numpyscrypt
+        suite.addTest(load_scrypt_suite('numpyscryptTests', numpyscrypt, ref))
+    except ImportError:
+        suite.addTest(load_scrypt_suite('numpyscryptTests', None, ref))
+
     try:
         from . import pypyscrypt_inline as pypyscrypt
         suite.addTest(load_scrypt_suite('pypyscryptTests', pypyscrypt, ref))
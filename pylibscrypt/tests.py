@@ -15,10 +15,23 @@
 """Tests scrypt and PBKDF2 implementations"""
 
 
+from array import array
 import base64
+import errno
 import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+from . import budget
+
 
 class ScryptTests(unittest.TestCase):
     """Tests an scrypt implementation from module"""
@@ -149,6 +162,15 @@ class ScryptTests(unittest.TestCase):
             None
         ))
 
+    def test_vector9(self):
+        self._test_vector((
+            b'password', b'NaCl', 4, 16, 2,
+            b'7658da4c9309e9543f82606aa0bc3dbb6eebcd982318d4c4350aba71d581'
+            b'c6460ce4eedc44154368fea3b21fafd4f251894242cf61e8d6fa6f1fed24'
+            b'08374ab4',
+            None
+        ))
+
     def test_maxmem(self):
         """Tests hashlib maxmem, quite slow"""
         if self.fast:
@@ -170,6 +192,38 @@ class ScryptTests(unittest.TestCase):
         self.assertRaisesRegexp(TypeError, 'salt',
                                 self.module.scrypt, b'pass', None)
 
+    def test_scrypt_into(self):
+        import array
+        pw, salt = b'password', b'NaCl'
+        key = self.module.scrypt(pw, salt, 16, 2, 2, 48)
+        outs = [bytearray(48), memoryview(bytearray(48))]
+        if sys.version_info[0] > 2:
+            # Arrays only have the old buffer interface on Python 2
+            outs += [array.array('B', [0] * 48), array.array('I', [0] * 12)]
+        for out in outs:
+            self.assertEqual(
+                self.module.scrypt_into(out, bytearray(pw), salt, 16, 2, 2),
+                None)
+            self.assertEqual(bytes(memoryview(out).tobytes()), key)
+        out = bytearray(b'x' * 50)
+        self.module.scrypt_into(memoryview(out)[1:-1], memoryview(pw),
+                                memoryview(b'-' + salt)[1:], 16, 2, 2)
+        self.assertEqual(bytes(out), b'x' + key + b'x')
+
+        self.assertRaises(TypeError, self.module.scrypt_into, key, pw, salt)
+        self.assertRaises(TypeError, self.module.scrypt_into,
+                          bytearray(8), u'pass', salt)
+        self.assertRaises(TypeError, self.module.scrypt_into,
+                          bytearray(8), pw, None)
+        if sys.version_info[0] > 2:
+            # Python 2 memoryviews can't be strided
+            self.assertRaises(TypeError, self.module.scrypt_into,
+                              memoryview(bytearray(16))[::2], pw, salt)
+        self.assertRaises(ValueError, self.module.scrypt_into,
+                          bytearray(), pw, salt)
+        self.assertRaises(ValueError, self.module.scrypt_into,
+                          bytearray(8), pw, salt, 15)
+
     def test_mcf_bytes_enforced(self):
         self.assertRaisesRegexp(TypeError, 'password',
                                 self.module.scrypt_mcf, u'pass', b'salt')
@@ -331,6 +385,26 @@ class ScryptTests(unittest.TestCase):
         m2 = self.module.scrypt_mcf(p, b'NaCl', 4, 8, 1, b'$7$')
         self.assertTrue(self.module.scrypt_mcf_check(m2, p))
 
+    def test_mcf_parsed(self):
+        from .mcf import ScryptMCF, parse_mcf
+        p = b'pleaseletmein'
+        for prefix in (b'$s1$', b'$7$'):
+            m = self.module.scrypt_mcf(p, N=4, prefix=prefix)
+            rec = parse_mcf(m)
+            self.assertTrue(isinstance(rec, ScryptMCF))
+            self.assertEqual((rec.N, rec.r, rec.p), (4, 8, 1))
+            self.assertEqual(rec.olen, len(rec.hash))
+            self.assertTrue(self.module.scrypt_mcf_check(rec, p))
+            self.assertFalse(self.module.scrypt_mcf_check(rec, b'x' + p))
+            # Equal records are interchangeable as keys
+            same = parse_mcf(m)
+            self.assertEqual(hash(same), hash(rec))
+            self.assertEqual(len(set([rec, same])), 1)
+            self.assertEqual({rec: 1}[same], 1)
+            self.assertFalse(rec != same)
+        self.assertRaises(TypeError, parse_mcf, u'$s1$')
+        self.assertRaises(ValueError, parse_mcf, b'$s1$')
+
     def test_mcf_unknown(self):
         p = b'pleaseletmein'
         self.assertRaises(ValueError, self.module.scrypt_mcf, p, prefix=b'$$')
@@ -372,6 +446,31 @@ class ScryptTests(unittest.TestCase):
         self.assertTrue(self.module.scrypt_mcf_check(m1, pw))
         self.assertTrue(self.module.scrypt_mcf_check(m2, pw))
 
+    def test_budget(self):
+        # N = 16 and r = 1 take 2432 bytes
+        pw, s, N, r = b'pass', b'salt', 16, 1
+        m1 = self.module.scrypt_mcf(pw, None, N, r)
+        m7 = self.module.scrypt_mcf(pw, None, N, r, prefix=b'$7$')
+        b = budget.get_budget()
+        limit, timeout = b.limit, b.timeout
+        try:
+            budget.set_budget(2048)
+            self.assertRaises(ValueError, self.module.scrypt, pw, s, N, r)
+            self.assertRaises(ValueError, self.module.scrypt_mcf, pw, None,
+                              N, r)
+            self.assertRaises(ValueError, self.module.scrypt_mcf_check, m1, pw)
+            self.assertRaises(ValueError, self.module.scrypt_mcf_check, m7, pw)
+            budget.set_budget(4096, timeout=0)
+            self.module.scrypt(pw, s, N, r)
+            self.assertEqual(b.used, 0)
+            with b.reserve(2048):
+                self.assertRaises(MemoryError, self.module.scrypt, pw, s, N, r)
+                self.assertRaises(MemoryError, self.module.scrypt_mcf_check,
+                                  m7, pw)
+            self.assertTrue(self.module.scrypt_mcf_check(m7, pw))
+        finally:
+            budget.set_budget(limit, timeout)
+
 
 def load_scrypt_suite(name, module, fast=True):
     tests = type(name, (ScryptTests,), {'module': module, 'fast': fast})
@@ -384,6 +483,1352 @@ def run_scrypt_suite(module, fast=False):
     unittest.TextTestRunner().run(suite)
 
 
+class BatchTests(unittest.TestCase):
+    """Tests batched scrypt from module against its scrypt"""
+    module = None
+
+    def setUp(self):
+        if not self.module:
+            self.skipTest('module not tested')
+        self.tmp_lanes = self.module._min_lanes
+
+    def tearDown(self):
+        self.module._min_lanes = self.tmp_lanes
+
+    def test_scrypt_batch(self):
+        pws = [b'password', b'', b'pa\0ss', b'x' * 100]
+        salts = [b'NaCl', b'salt', b'', b'salt' * 8]
+        for lanes in (1, 100):
+            self.module._min_lanes = lanes
+            hs = self.module.scrypt_batch(pws, salts, 32, 2, 2, 42)
+            for pw, s, h in zip(pws, salts, hs):
+                self.assertEqual(h, self.module.scrypt(pw, s, 32, 2, 2, 42))
+        self.assertEqual(self.module.scrypt_batch([], [], 32, 2, 2), [])
+
+    def test_scrypt_batch_args(self):
+        self.assertRaises(ValueError, self.module.scrypt_batch,
+                          [b'pw'], [b'salt', b'salt'])
+        self.assertRaises(TypeError, self.module.scrypt_batch,
+                          [b'pw', u'pw'], [b'salt', b'salt'])
+        self.assertRaises(ValueError, self.module.scrypt_batch,
+                          [b'pw'], [b'salt'], 3)
+
+    def test_mcf_check_batch(self):
+        self.module._min_lanes = 1
+        m1 = self.module.scrypt_mcf(b'pass', N=4, prefix=b'$s1$')
+        m2 = self.module.scrypt_mcf(b'pass', N=4, prefix=b'$7$')
+        m3 = self.module.scrypt_mcf(b'word', N=8, r=2, prefix=b'$s1$')
+        self.assertEqual(
+            self.module.scrypt_mcf_check_batch([
+                (m1, b'pass'), (m2, b'pass'), (m3, b'word'),
+                (m1, b'word'), (m3, b'pass'), (m2, b'pass_'),
+            ]),
+            [True, True, True, False, False, False]
+        )
+        self.assertEqual(self.module.scrypt_mcf_check_batch([]), [])
+        self.assertRaises(ValueError, self.module.scrypt_mcf_check_batch,
+                          [(m1, b'pass'), (b'$s1$', b'pass')])
+        self.assertRaises(TypeError, self.module.scrypt_mcf_check_batch,
+                          [(m1, u'pass')])
+
+
+def load_batch_suite(name, module):
+    tests = type(name, (BatchTests,), {'module': module})
+    return unittest.defaultTestLoader.loadTestsFromTestCase(tests)
+
+
+class PackageBatchTests(unittest.TestCase):
+    """Tests the batch functions of the package with each implementation"""
+
+    def setUp(self):
+        self.package = importlib.import_module(__package__)
+        self.loaded = self.package._module, self.package._impl
+
+    def tearDown(self):
+        self.package._module, self.package._impl = self.loaded
+
+    def _check(self, name):
+        module = importlib.import_module('.' + name, __package__)
+        self.package._module = self.package._impl = module
+        scrypt_batch = self.package.scrypt_batch
+        pws = [b'password', b'', b'x' * 100]
+        salts = [b'NaCl', b'salt', b'']
+        self.assertEqual(scrypt_batch(pws, salts, 16, 2, 2, 42),
+                         [module.scrypt(pw, s, 16, 2, 2, 42)
+                          for pw, s in zip(pws, salts)])
+        self.assertEqual(scrypt_batch(iter([]), iter([])), [])
+        self.assertRaises(ValueError, scrypt_batch, [b'pw'], [b's', b's'])
+        m1 = module.scrypt_mcf(b'pass', N=4, prefix=b'$s1$')
+        m2 = module.scrypt_mcf(b'word', N=8, r=2, prefix=b'$7$')
+        self.assertEqual(
+            self.package.scrypt_mcf_check_batch([
+                (m1, b'pass'), (m2, b'word'), (m1, b'word'), (m2, b'pass')]),
+            [True, True, False, False])
+        self.assertRaises(TypeError, self.package.scrypt_mcf_check_batch,
+                          [(m1, u'pass')])
+
+    def test_loop(self):
+        self._check('pypyscrypt_inline')
+
+    def test_numpy(self):
+        try:
+            self._check('numpyscrypt')
+        except ImportError:
+            self.skipTest('numpy not available')
+
+
+class AsyncTests(unittest.TestCase):
+    """Tests the asyncio interface using module as the backend"""
+    aio = None
+    module = None
+
+    def setUp(self):
+        if not self.aio:
+            self.skipTest('asyncio not supported')
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.scrypt = self.aio.AsyncScrypt(self.module, limit=2)
+
+    def tearDown(self):
+        self.scrypt.shutdown()
+        self.loop.close()
+
+    def test_scrypt(self):
+        h = self.loop.run_until_complete(
+            self.scrypt.scrypt(b'password', b'NaCl', 4, 1, 1))
+        self.assertEqual(h, self.scrypt.module.scrypt(b'password', b'NaCl',
+                                                      4, 1, 1))
+        self.assertRaises(ValueError, self.loop.run_until_complete,
+                          self.scrypt.scrypt(b'password', b'NaCl', 3))
+
+    def test_mcf(self):
+        m = self.loop.run_until_complete(
+            self.scrypt.scrypt_mcf(b'password', N=4))
+        self.assertTrue(self.loop.run_until_complete(
+            self.scrypt.scrypt_mcf_check(m, b'password')))
+        self.assertFalse(self.loop.run_until_complete(
+            self.scrypt.scrypt_mcf_check(m, b'wordpass')))
+
+    def test_limit(self):
+        import asyncio
+        calls = [self.scrypt.scrypt(b'pw', b'salt', 16) for i in range(5)]
+        tasks = [self.loop.create_task(c) for c in calls]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.scrypt._semaphore._value, 0)
+        tasks[-1].cancel()
+        hs = self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.assertEqual(len(set(hs[:-1])), 1)
+        self.assertTrue(isinstance(hs[-1], asyncio.CancelledError))
+        self.assertEqual(self.scrypt._semaphore._value, 2)
+
+
+def load_async_suite(name, aio, module):
+    tests = type(name, (AsyncTests,), {'aio': aio, 'module': module})
+    return unittest.defaultTestLoader.loadTestsFromTestCase(tests)
+
+
+class BulkTests(unittest.TestCase):
+    """Tests the thread pool bulk interface using module as the backend"""
+    bulk = None
+    module = None
+
+    def setUp(self):
+        if not self.bulk:
+            self.skipTest('module not tested')
+        if not self.module:
+            self.module = self.bulk._default_module()
+
+    def test_scrypt_many(self):
+        pairs = [(b'pw%d' % i, b'salt') for i in range(10)]
+        pairs[3] = (u'pw', b'salt')
+        out = list(self.bulk.scrypt_many(pairs, 16, 2, 1, 32, workers=2,
+                                         module=self.module))
+        self.assertEqual(len(out), 10)
+        for i, (h, e) in enumerate(out):
+            if i == 3:
+                self.assertEqual(h, None)
+                self.assertTrue(isinstance(e, TypeError))
+                continue
+            self.assertEqual(e, None)
+            self.assertEqual(h, self.module.scrypt(b'pw%d' % i, b'salt',
+                                                   16, 2, 1, 32))
+        self.assertEqual(list(self.bulk.scrypt_many([], module=self.module)),
+                         [])
+
+    def test_mcf_check_many(self):
+        m = self.module.scrypt_mcf(b'pass', N=16)
+        pairs = [(m, b'pass'), (m, b'ssap'), (b'$s1$', b'pass'), (m, b'pass')]
+        out = list(self.bulk.scrypt_mcf_check_many(pairs, module=self.module))
+        self.assertEqual([r for r, e in out], [True, False, None, True])
+        self.assertTrue(isinstance(out[2][1], ValueError))
+
+    def test_backpressure(self):
+        read = []
+        def pairs():
+            for i in range(1000):
+                read.append(i)
+                yield b'pw', b'salt'
+        it = self.bulk.scrypt_many(pairs(), 16, 1, 1, workers=2,
+                                   module=self.module)
+        self.assertEqual(read, [])
+        next(it)
+        self.assertTrue(len(read) <= 2 * self.bulk._ahead)
+        it.close()
+        self.assertTrue(len(read) <= 2 * self.bulk._ahead)
+
+
+def load_bulk_suite(name, bulk, module):
+    tests = type(name, (BulkTests,), {'bulk': bulk, 'module': module})
+    return unittest.defaultTestLoader.loadTestsFromTestCase(tests)
+
+
+class ContextTests(unittest.TestCase):
+    """Tests ScryptContext using module as the backend"""
+    module = None
+
+    def setUp(self):
+        if not self.module:
+            self.skipTest('module not tested')
+        from .context import ScryptContext
+        self.context = lambda *a, **kw: ScryptContext(*a, module=self.module,
+                                                      **kw)
+
+    def test_scrypt(self):
+        for N, r, p, olen in ((16, 1, 1, 64), (64, 8, 1, 32), (16, 8, 2, 7)):
+            c = self.context(N, r, p, olen)
+            for pw in (b'', b'password', b'pa\0ss'):
+                for salt in (b'', b'NaCl', b'x' * 32):
+                    self.assertEqual(
+                        c.scrypt(pw, salt),
+                        self.module.scrypt(pw, salt, N, r, p, olen))
+        self.assertRaises(TypeError, c.scrypt, u'pw', b'salt')
+        self.assertRaises(TypeError, c.scrypt, b'pw', None)
+
+    def test_threads(self):
+        c = self.context(16, 1, 1, 16)
+        out = {}
+        def f(i):
+            out[i] = [c.scrypt(b'pw%d' % i, b'salt') for _ in range(5)]
+        threads = [threading.Thread(target=f, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            expected = self.module.scrypt(b'pw%d' % i, b'salt', 16, 1, 1, 16)
+            self.assertEqual(out[i], [expected] * 5)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.context, 15)
+        self.assertRaises(ValueError, self.context, 16, 0)
+        self.assertRaises(ValueError, self.context, 16, 1, 1, 0)
+        self.assertRaises(TypeError, self.context, 16.0)
+        self.assertRaises(ValueError, self.context, 16, prefix=b'$$')
+        c = self.context(16, 256)
+        self.assertRaises(ValueError, c.scrypt_mcf, b'pw')
+
+    def test_mcf(self):
+        for prefix in (b'$s1$', b'$7$', None):
+            c = self.context(16, 2, 3, prefix=prefix)
+            self.assertEqual(
+                c.scrypt_mcf(b'pw', b'NaCl'),
+                self.module.scrypt_mcf(b'pw', b'NaCl', 16, 2, 3, prefix))
+            m = c.scrypt_mcf(b'pw')
+            self.assertTrue(m.startswith(prefix or b'$7$'))
+            self.assertTrue(self.module.scrypt_mcf_check(m, b'pw'))
+            self.assertTrue(c.scrypt_mcf_check(m, b'pw'))
+            self.assertFalse(c.scrypt_mcf_check(m, b'pW'))
+            self.assertRaises(ValueError, c.scrypt_mcf, b'p\0w')
+            self.assertRaises(ValueError, c.scrypt_mcf, b'pw', b'')
+            self.assertRaises(TypeError, c.scrypt_mcf, b'pw', u'salt')
+            self.assertRaises(TypeError, c.scrypt_mcf, u'pw')
+
+    def test_mcf_check_other(self):
+        from .mcf import parse_mcf
+        c = self.context(16, 1, 1)
+        for m in (self.module.scrypt_mcf(b'pw', None, 32, 1, 1),
+                  self.module.scrypt_mcf(b'pw', None, 16, 1, 1, b'$7$')):
+            self.assertTrue(c.scrypt_mcf_check(m, b'pw'))
+            self.assertTrue(c.scrypt_mcf_check(parse_mcf(m), b'pw'))
+            self.assertFalse(c.scrypt_mcf_check(m, b'p'))
+        self.assertRaises(ValueError, c.scrypt_mcf_check,
+                          b'$7$/....../....salt$', b'pw')
+        self.assertRaises(TypeError, c.scrypt_mcf_check, u'$7$', b'pw')
+        self.assertRaises(TypeError, c.scrypt_mcf_check, m, u'pw')
+
+
+def load_context_suite(name, module):
+    tests = type(name, (ContextTests,), {'module': module})
+    return unittest.defaultTestLoader.loadTestsFromTestCase(tests)
+
+
+class CacheTests(unittest.TestCase):
+    """Tests the verification cache in front of module"""
+    cache = None
+    module = None
+
+    def setUp(self):
+        if not self.cache:
+            self.skipTest('module not tested')
+        self.calls = []
+        self.mcf = self.module.scrypt_mcf(b'pass', N=16)
+        self.mcf2 = self.module.scrypt_mcf(b'word', N=16)
+
+    def check(self, mcf, password):
+        self.calls.append(password)
+        return self.module.scrypt_mcf_check(mcf, password)
+
+    def test_hit(self):
+        c = self.cache.VerifyCache(check=self.check)
+        for i in range(3):
+            self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+            self.assertFalse(c.scrypt_mcf_check(self.mcf, b'ssap'))
+        self.assertEqual(self.calls, [b'pass'] + [b'ssap'] * 3)
+        self.assertEqual(len(c), 1)
+        for tag, (pair_tag, expires) in c._entries.items():
+            self.assertFalse(b'pass' in tag + pair_tag)
+        self.assertRaises(TypeError, c.scrypt_mcf_check, self.mcf, u'pass')
+
+    def test_parsed(self):
+        from .mcf import parse_mcf
+        c = self.cache.VerifyCache(check=self.check)
+        rec = parse_mcf(self.mcf)
+        self.assertTrue(c.scrypt_mcf_check(rec, b'pass'))
+        self.assertTrue(c.scrypt_mcf_check(rec, b'pass'))
+        self.assertFalse(c.scrypt_mcf_check(rec, b'ssap'))
+        self.assertEqual(self.calls, [b'pass', b'ssap'])
+        c.invalidate(rec)
+        self.assertEqual(len(c), 0)
+
+    def test_ttl(self):
+        c = self.cache.VerifyCache(ttl=0, check=self.check)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_lru(self):
+        c = self.cache.VerifyCache(maxsize=1, check=self.check)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertTrue(c.scrypt_mcf_check(self.mcf2, b'word'))
+        self.assertTrue(c.scrypt_mcf_check(self.mcf2, b'word'))
+        self.assertEqual(len(self.calls), 2)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(len(c), 1)
+
+    def test_invalidate(self):
+        c = self.cache.VerifyCache(check=self.check)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertTrue(c.scrypt_mcf_check(self.mcf2, b'word'))
+        c.invalidate(self.mcf)
+        self.assertEqual(len(c), 1)
+        c.invalidate()
+        self.assertEqual(len(c), 0)
+
+    def test_shared(self):
+        import os
+        if not hasattr(os, 'fork'):
+            self.skipTest('no fork')
+        c = self.cache.VerifyCache(check=self.check, shared=16)
+        def child():
+            os._exit(0 if c.scrypt_mcf_check(self.mcf, b'pass') else 1)
+        pid = os.fork()
+        if not pid:
+            child()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf, b'pass'))
+        self.assertEqual(self.calls, [])
+        self.assertEqual(len(c), 0)
+
+        # Invalidated in another process
+        self.assertTrue(c.scrypt_mcf_check(self.mcf2, b'word'))
+        pid = os.fork()
+        if not pid:
+            c.invalidate(self.mcf2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertTrue(c.scrypt_mcf_check(self.mcf2, b'word'))
+        self.assertEqual(self.calls, [b'word', b'word'])
+
+
+def load_cache_suite(name, cache, module):
+    tests = type(name, (CacheTests,), {'cache': cache, 'module': module})
+    return unittest.defaultTestLoader.loadTestsFromTestCase(tests)
+
+
+class MCFColumnsTests(unittest.TestCase):
+    """Tests bulk parsing and encoding of MCF hashes"""
+
+    def setUp(self):
+        from . import mcf
+        self.mcf = mcf
+        self.hashes = [
+            mcf._scrypt_mcf_encode_s1(2**i, 8, 1, b'salt%012d' % i, b'x' * 64)
+            for i in range(1, 11)
+        ] + [
+            mcf._scrypt_mcf_encode_7(2**i, 8, 1, b'salt%039d' % i, b'y' * 32)
+            for i in range(1, 11)
+        ] + [
+            mcf._scrypt_mcf_encode_s1(16, 1, 2, b'NaCl', b'z' * 20),
+            mcf._scrypt_mcf_encode_7(16, 1, 2, b'', b''),
+        ]
+        self.bad = [b'', b'$s1$', b'$7$', b'$s1$0e0801$abc',
+                    self.hashes[3].replace(b'$0', b'$Z'),
+                    self.hashes[13].replace(b'$7$', b'$7$!')]
+
+    def _check(self, cols, rows):
+        self.assertEqual(len(cols), len(rows))
+        for i, row in enumerate(rows):
+            if row in self.bad:
+                self.assertEqual(cols.prefix[i], None)
+                self.assertTrue(cols.error[i])
+                self.assertRaises(ValueError, cols.__getitem__, i)
+            else:
+                self.assertEqual(cols.error[i], None)
+                self.assertEqual(cols[i], self.mcf.parse_mcf(row))
+                self.assertTrue(row.startswith(cols.prefix[i]))
+
+    def test_parse(self):
+        rows = self.hashes + self.bad + self.hashes[::3]
+        for sep in (b'\n', b'\0'):
+            cols = self.mcf.parse_mcf_columns(sep.join(rows) + sep, sep)
+            self._check(cols, rows)
+        self.assertEqual(len(self.mcf.parse_mcf_columns(b'')), 0)
+
+    def test_parse_uniform(self):
+        rows = self.hashes[2:9] * 5
+        cols = self.mcf.parse_mcf_columns(bytearray(b'\n'.join(rows)))
+        self._check(cols, rows)
+        rows = self.hashes[12:19] * 5
+        cols = self.mcf.parse_mcf_columns(memoryview(b'\n'.join(rows)))
+        self._check(cols, rows)
+
+    def test_parse_chunks(self):
+        import mmap
+        rows = self.hashes * 3 + self.bad + self.hashes
+        data = b'\n'.join(rows) + b'\n'
+        chunk = self.mcf._CHUNK
+        m = mmap.mmap(-1, len(data))
+        try:
+            m.write(data)
+            # Rows split between chunks, and an empty row at the end of one
+            self.mcf._CHUNK = data.index(b'\n\n') + 1
+            self._check(self.mcf.parse_mcf_columns(m), rows)
+            self.mcf._CHUNK = 1000
+            self._check(self.mcf.parse_mcf_columns(m), rows)
+        finally:
+            self.mcf._CHUNK = chunk
+            m.close()
+
+    def test_encode(self):
+        rows = self.hashes + self.bad
+        cols = self.mcf.parse_mcf_columns(b'\0'.join(rows), b'\0')
+        out = self.mcf.encode_mcf_columns(cols, b'\0').split(b'\0')
+        self.assertEqual(out, self.hashes + [b''] * len(self.bad) + [b''])
+        self.assertEqual(
+            self.mcf.encode_mcf_columns(self.mcf.MCFColumns()), b'')
+
+    def test_iter(self):
+        import io
+        rows = self.hashes * 3 + self.bad
+        f = io.BytesIO(b'\n'.join(rows))
+        parts = list(self.mcf.iter_mcf_columns(f, size=1000))
+        self.assertTrue(len(parts) > 1)
+        for col in ('prefix', 'N', 'salt', 'hash', 'error'):
+            self.assertEqual(
+                sum((list(getattr(p, col)) for p in parts), []),
+                list(getattr(self.mcf.parse_mcf_columns(f.getvalue()), col)))
+
+    def test_cb64(self):
+        mcf = self.mcf
+        self.assertEqual(mcf._cb64enc(b''), b'.')
+        self.assertEqual(mcf._cb64enc(b'\xff'), b'z1')
+        self.assertEqual(mcf._cb64enc(bytearray(b'\x01\x02\x03')), b'/6k..')
+        for i in range(40):
+            b = bytes(bytearray(range(i * 3, i * 4)))
+            self.assertEqual(mcf._cb64dec(mcf._cb64enc(b)), b)
+        self.assertEqual(mcf._cb64dec(b'z1z'), b'\xff\xf0')
+        self.assertRaises(ValueError, mcf._cb64dec, b'ab=')
+        m = mcf._scrypt_mcf_encode_7(2**14, 8, 2**30 - 1, b'NaCl', b'x')
+        self.assertEqual(m, b'$7$C6....zzzzzNaCl$s/')
+        self.assertEqual(mcf._scrypt_mcf_decode_7(m),
+                         (2**14, 8, 2**30 - 1, b'NaCl', b'x', 1))
+        self.assertRaises(ValueError, mcf._scrypt_mcf_decode_7, b'$7$C6..../$')
+        self.assertRaises(ValueError, mcf._scrypt_mcf_decode_7, m + b'!')
+
+
+class BudgetTests(unittest.TestCase):
+    """Tests the memory budget shared by scrypt calls"""
+
+    def test_unlimited(self):
+        b = budget.MemoryBudget()
+        with b.reserve(2**62):
+            b.acquire(2**62)
+            b.release(2**62)
+        self.assertEqual(b.used, 0)
+
+    def test_limit(self):
+        b = budget.MemoryBudget(100, timeout=0)
+        self.assertRaises(ValueError, b.acquire, 101)
+        with b.reserve(60):
+            self.assertEqual(b.used, 60)
+            self.assertRaises(MemoryError, b.acquire, 41)
+            b.acquire(40)
+            b.release(40)
+        self.assertEqual(b.used, 0)
+
+    def test_wait(self):
+        b = budget.MemoryBudget(100)
+        b.acquire(100)
+        done = []
+        def f():
+            with b.reserve(50):
+                done.append(b.used)
+        t = threading.Thread(target=f)
+        t.start()
+        t.join(0.1)
+        self.assertEqual(done, [])
+        b.release(100)
+        t.join()
+        self.assertEqual(done, [50])
+        self.assertEqual(b.used, 0)
+
+    def test_timeout(self):
+        b = budget.MemoryBudget(100, timeout=0.05)
+        with b.reserve(100):
+            self.assertRaises(MemoryError, b.acquire, 1)
+
+    def test_set_limit(self):
+        b = budget.MemoryBudget(100)
+        b.acquire(100)
+        done = []
+        def f():
+            with b.reserve(50):
+                done.append(b.used)
+        t = threading.Thread(target=f)
+        t.start()
+        t.join(0.1)
+        self.assertEqual(done, [])
+        # The waiting call sees the new limit, the one in progress still counts
+        b.set_limit(150)
+        t.join()
+        self.assertEqual(done, [150])
+        self.assertRaises(ValueError, b.acquire, 151)
+        b.release(100)
+        self.assertEqual(b.used, 0)
+
+    def test_set_budget(self):
+        b = budget.get_budget()
+        limit, timeout = b.limit, b.timeout
+        try:
+            with b.reserve(100):
+                budget.set_budget(1000, timeout=0)
+                self.assertTrue(budget.get_budget() is b)
+                self.assertEqual(b.used, 100)
+                self.assertRaises(MemoryError, b.acquire, 901)
+        finally:
+            budget.set_budget(limit, timeout)
+        self.assertEqual(b.used, 0)
+
+    def test_memory_required(self):
+        self.assertEqual(budget.memory_required(2**14, 8, 1), 16780288)
+        self.assertEqual(budget.memory_required(16, 1, 4, 4), 128 * 70)
+
+    def test_cgroup(self):
+        limit = budget.cgroup_memory_limit()
+        self.assertTrue(limit is None or limit > 0)
+
+
+class AutotuneTests(unittest.TestCase):
+    """Tests choosing the fastest implementation"""
+    params = (16, 1, 1)
+
+    def setUp(self):
+        from . import autotune
+        self.autotune = autotune
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sub', 'autotune.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_probe(self):
+        times = self.autotune.probe(self.params,
+                                    ['pypyscrypt_inline', 'nonexistent'])
+        self.assertEqual(list(times), ['pypyscrypt_inline'])
+        self.assertTrue(times['pypyscrypt_inline'] > 0)
+        self.assertRaises(ImportError, self.autotune.probe, self.params,
+                          ['nonexistent'])
+
+    def test_choose(self):
+        m = self.autotune.choose(self.params, self.path)
+        self.assertEqual(
+            m.scrypt(b'password', b'NaCl', 2, 8, 1),
+            base64.b16decode(
+                b'e5ed8edc019edfef2d3ced0896faf9eec6921dcc68125ce81c10d53474ce'
+                b'1be545979159700d324e77c68d34c553636a8429c4f3c99b9566466877f9'
+                b'dca2b92b', True))
+        with open(self.path) as f:
+            results = json.load(f)
+        self.assertEqual(list(results.values()), [m.__name__.split('.')[-1]])
+        from . import libload
+        self.assertEqual(os.path.exists(os.path.join(self.dir, 'sub',
+                                                     'libraries.json')),
+                         bool(libload._found))
+
+        # Stored results are used without timing again
+        key = list(results)[0]
+        results[key] = 'pypyscrypt_inline'
+        with open(self.path, 'w') as f:
+            json.dump(results, f)
+        probe = self.autotune.probe
+        self.autotune.probe = None
+        try:
+            m = self.autotune.choose(self.params, self.path)
+        finally:
+            self.autotune.probe = probe
+        self.assertEqual(m.__name__, 'pylibscrypt.pypyscrypt_inline')
+
+        # Unknown names are timed again
+        results[key] = 'nonexistent'
+        with open(self.path, 'w') as f:
+            json.dump(results, f)
+        m = self.autotune.choose(self.params, self.path)
+        self.assertTrue(m.__name__.split('.')[-1] in self.autotune.BACKENDS)
+
+    def test_update_json(self):
+        from . import cachedir
+        cachedir.update_json(self.path, 'a', 1)
+        cachedir.update_json(self.path, cachedir.host_key('b'), [2])
+        self.assertEqual(cachedir.read_json(self.path),
+                         {'a': 1, cachedir.host_key('b'): [2]})
+        self.assertTrue(cachedir.host_key('b').endswith(' b'))
+
+    def test_params_from_env(self):
+        from .common import SCRYPT_N, SCRYPT_r, SCRYPT_p
+        f = self.autotune.params_from_env
+        self.assertEqual(f('1'), (SCRYPT_N, SCRYPT_r, SCRYPT_p))
+        self.assertEqual(f('1024,8,2'), (1024, 8, 2))
+        self.assertRaises(ValueError, f, '1024,8')
+
+
+class PreloadTests(unittest.TestCase):
+    """Tests loading the implementation on first use"""
+
+    def _run(self, code, autotune=None):
+        env = dict(os.environ)
+        env.pop('PYLIBSCRYPT_AUTOTUNE', None)
+        if autotune is not None:
+            env['PYLIBSCRYPT_AUTOTUNE'] = autotune
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root,
+                                      env=env)
+        return out.decode().split()
+
+    def test_lazy(self):
+        loaded = self._run(
+            'import sys, pylibscrypt\n'
+            'print(" ".join(sorted(sys.modules)))\n')
+        self.assertTrue('pylibscrypt' in loaded)
+        for name in ('hashlibscrypt', 'pylibscrypt', 'pylibsodium',
+                     'pypyscrypt_inline', 'numpyscrypt'):
+            self.assertFalse('pylibscrypt.' + name in loaded)
+
+    def test_autotune_off(self):
+        for value in ('', '0'):
+            out = self._run(
+                'import sys, pylibscrypt\n'
+                'pylibscrypt.preload()\n'
+                'print("pylibscrypt.autotune" in sys.modules)\n', value)
+            self.assertEqual(out, ['False'])
+
+    def test_first_call(self):
+        out = self._run(
+            'from pylibscrypt import scrypt\n'
+            'import pylibscrypt\n'
+            'k = scrypt(b"password", b"NaCl", 2, 8, 1)\n'
+            'm = pylibscrypt.preload()\n'
+            'print(m.__name__)\n'
+            'print(k == m.scrypt(b"password", b"NaCl", 2, 8, 1))\n')
+        self.assertTrue(out[0].startswith('pylibscrypt.'))
+        self.assertEqual(out[1], 'True')
+
+    def test_preload(self):
+        pylibscrypt = importlib.import_module(__package__)
+        module = pylibscrypt.preload()
+        self.assertTrue(module is pylibscrypt.preload())
+        key = module.scrypt(b'pw', b's', 16, 1, 1, 16)
+        self.assertEqual(pylibscrypt.scrypt(b'pw', b's', 16, 1, 1, 16), key)
+        out = bytearray(16)
+        pylibscrypt.scrypt_into(out, b'pw', b's', 16, 1, 1)
+        self.assertEqual(bytes(out), key)
+        mcf = pylibscrypt.scrypt_mcf(b'pw', None, 16, 1, 1)
+        self.assertTrue(module.scrypt_mcf_check(mcf, b'pw'))
+        self.assertTrue(pylibscrypt.scrypt_mcf_check(mcf, b'pw'))
+
+
+class LibloadTests(unittest.TestCase):
+    """Tests remembering where shared libraries were found"""
+
+    def setUp(self):
+        import ctypes.util
+        from . import libload
+        self.libload = libload
+        self.soname = ctypes.util.find_library('c')
+        if self.soname is None or os.name == 'nt':
+            self.skipTest('no libc')
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'libraries.json')
+        self.found = []
+        # Without the libraries other tests have searched for
+        self.loaded = libload._found
+        libload._found = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        os.environ.pop('PYLIBSCRYPT_TESTLIB', None)
+        self.libload._found = self.loaded
+
+    def _find(self):
+        import ctypes
+        self.found.append(self.soname)
+        return ctypes.CDLL(self.soname)
+
+    def _load(self):
+        return self.libload.load_library('testlib', 'printf', self._find,
+                                         self.path)
+
+    def test_cached(self):
+        lib = self._load()
+        self.assertEqual(lib._name, self.soname)
+        self.assertEqual(len(self.found), 1)
+        # Only stored when asked to
+        self.assertFalse(os.path.exists(self.path))
+        self._load()
+        self.assertEqual(len(self.found), 2)
+        self.libload.save_paths(self.path)
+        with open(self.path) as f:
+            entry = json.load(f)[self.libload._key('testlib')]
+        self.assertTrue(os.path.isabs(entry['path']))
+
+        lib = self._load()
+        self.assertEqual(lib._name, entry['path'])
+        self.assertEqual(len(self.found), 2)
+
+        # A changed file is searched for again
+        entry['inode'] += 1
+        with open(self.path, 'w') as f:
+            json.dump({self.libload._key('testlib'): entry}, f)
+        self._load()
+        self.assertEqual(len(self.found), 3)
+
+    def test_not_found(self):
+        lib = self.libload.load_library('testlib', 'printf', lambda: None,
+                                        self.path)
+        self.assertEqual(lib, None)
+        self.libload.save_paths(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_environment(self):
+        os.environ['PYLIBSCRYPT_TESTLIB'] = self.soname
+        self.assertEqual(self._load()._name, self.soname)
+        self.assertEqual(self.found, [])
+        os.environ['PYLIBSCRYPT_TESTLIB'] = os.path.join(self.dir, 'none.so')
+        self.assertRaises(ImportError, self._load)
+
+
+class BenchTests(unittest.TestCase):
+    """Tests the benchmark harness"""
+
+    def setUp(self):
+        from . import bench
+        self.bench = bench
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_percentile(self):
+        times = list(range(1, 21))
+        self.assertEqual(self.bench._percentile(times, 50), 10)
+        self.assertEqual(self.bench._percentile(times, 95), 19)
+        self.assertEqual(self.bench._percentile([3], 95), 3)
+
+    def test_measure(self):
+        from . import pypyscrypt_inline
+        res = self.bench.measure(pypyscrypt_inline, 2, 1, 1, repeat=3)
+        self.assertEqual(res['runs'], 3)
+        self.assertTrue(0 < res['median'] <= res['p95'])
+        res = self.bench.measure(pypyscrypt_inline, 2, 1, 1, 100, 0)
+        self.assertEqual(res['runs'], 1)
+
+    def test_compare(self):
+        base = {'results': [
+            {'backend': 'x', 'N': 2, 'r': 1, 'p': 1, 'median': 1.0,
+             'peak_rss': 100},
+            {'backend': 'y', 'N': 2, 'r': 1, 'p': 1, 'median': 1.0,
+             'peak_rss': None},
+        ]}
+        new = {'results': [
+            {'backend': 'x', 'N': 2, 'r': 1, 'p': 1, 'median': 1.05,
+             'peak_rss': 200},
+            {'backend': 'y', 'N': 2, 'r': 1, 'p': 1, 'median': 2.0,
+             'peak_rss': 200},
+            {'backend': 'z', 'N': 2, 'r': 1, 'p': 1, 'median': 2.0},
+        ]}
+        worse = self.bench.compare(new, base)
+        self.assertEqual(len(worse), 2)
+        self.assertTrue(worse[0].startswith('x N=2 r=1 p=1: peak RSS'))
+        self.assertTrue(worse[1].startswith('y N=2 r=1 p=1: median'))
+        self.assertEqual(self.bench.compare(new, base, 1.5, 1.5), [])
+
+    def test_main(self):
+        path = os.path.join(self.dir, 'out.json')
+        args = ['-b', 'pypyscrypt_inline,nonexistent', '-N', '2,2**2',
+                '-r', '1', '--repeat', '1', '--json', path]
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            self.assertEqual(self.bench.main(args), 0)
+            self.assertEqual(self.bench.main(
+                args[:-2] + ['--baseline', path, '--threshold', '100']), 0)
+            with open(path) as f:
+                results = json.load(f)
+            results['results'][0]['median'] /= 1e6
+            with open(path, 'w') as f:
+                json.dump(results, f)
+            self.assertEqual(self.bench.main(args[:-2] + ['--baseline', path]),
+                             1)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([(r['backend'], r['N']) for r in results['results']],
+                         [('pypyscrypt_inline', 2), ('pypyscrypt_inline', 4)])
+        self.assertTrue(all(r['peak_rss'] is None or r['peak_rss'] > 0
+                            for r in results['results']))
+
+    def test_scaling(self):
+        self.assertEqual(self.bench.worker_counts(1), [1, 2])
+        self.assertEqual(self.bench.worker_counts(6), [1, 2, 4, 6, 8, 12])
+        points = self.bench.scaling('pypyscrypt_inline', 2, 1, 1, [1, 2],
+                                    0.001)
+        self.assertEqual([pt['workers'] for pt in points], [1, 2])
+        self.assertTrue(all(pt['threads'] > 0 and pt['processes'] > 0
+                            for pt in points))
+        points = self.bench.scaling('pypyscrypt_inline', 2, 1, 1, [1], 0.001,
+                                    processes=False)
+        self.assertEqual(points[0]['processes'], None)
+        self.assertRaises(ImportError, self.bench.scaling, 'nonexistent',
+                          2, 1, 1)
+
+    def test_holds_gil(self):
+        def points(threads, processes):
+            return [{'workers': 2**i, 'threads': t, 'processes': p}
+                    for i, (t, p) in enumerate(zip(threads, processes))]
+        gil = points([10, 10, 9], [10, 19, 35])
+        self.assertTrue(self.bench.holds_gil(gil))
+        self.assertEqual(self.bench.knee(gil), 1)
+        self.assertEqual(self.bench.knee(gil, 'processes'), 4)
+        nogil = points([10, 19, 30], [10, 19, 35])
+        self.assertFalse(self.bench.holds_gil(nogil))
+        self.assertEqual(self.bench.knee(nogil), 4)
+        self.assertEqual(self.bench.holds_gil(points([10, 10], [10, 10])),
+                         None)
+        self.assertEqual(self.bench.holds_gil(points([10], [10])), None)
+        self.assertEqual(self.bench.holds_gil(
+            points([10, 10], [None, None])), None)
+
+    def test_main_scaling(self):
+        path = os.path.join(self.dir, 'out.json')
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            self.assertEqual(self.bench.main([
+                '--scaling', '-b', 'pypyscrypt_inline,nonexistent',
+                '-N', '2', '-r', '1', '--workers', '1,2', '--duration',
+                '0.001', '--no-processes', '--json', path]), 0)
+        finally:
+            sys.stdout = stdout
+        with open(path) as f:
+            results = json.load(f)
+        self.assertEqual(len(results['results']), 1)
+        res = results['results'][0]
+        self.assertEqual(res['backend'], 'pypyscrypt_inline')
+        self.assertEqual(len(res['scaling']), 2)
+        self.assertEqual(res['holds_gil'], None)
+        self.assertTrue(res['knee_threads'] in (1, 2))
+
+
+class MicrobenchTests(unittest.TestCase):
+    """Tests the kernel microbenchmarks"""
+
+    def setUp(self):
+        from . import microbench
+        self.microbench = microbench
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_interval(self):
+        mean, stdev, ci = self.microbench._interval([1.0, 2.0, 3.0])
+        self.assertEqual(mean, 2.0)
+        self.assertEqual(stdev, 1.0)
+        self.assertAlmostEqual(ci, 4.303 / 3**0.5)
+        self.assertEqual(self.microbench._interval([5.0]), (5.0, None, None))
+
+    def test_phases(self):
+        from . import pypyscrypt, pypyscrypt_inline
+        for module in (pypyscrypt, pypyscrypt_inline):
+            for r in (1, 2, 8):
+                B = array(module._WORD, range(32 * r))
+                V = array(module._WORD, [0]) * (32 * r * 4)
+                X = array(module._WORD, [0]) * (64 * r)
+                module.smix(B, 0, r, 4, V, X)
+                X[:32 * r] = array(module._WORD, range(32 * r))
+                fill = getattr(module, 'smix_fill_r%d' % r, module.smix_fill)
+                mix = getattr(module, 'smix_mix_r%d' % r, module.smix_mix)
+                fill(X, r, 4, V)
+                mix(X, r, 4, V)
+                self.assertEqual(X[:32 * r], B)
+
+    def test_compare(self):
+        base = {'results': [
+            {'kernel': 'x', 'mean': 100.0, 'ci': 1.0},
+            {'kernel': 'y', 'mean': 100.0, 'ci': 1.0},
+            {'kernel': 'z', 'mean': 100.0, 'ci': None},
+        ]}
+        new = {'results': [
+            {'kernel': 'x', 'mean': 110.0, 'ci': 1.0},
+            {'kernel': 'y', 'mean': 90.0, 'ci': 20.0},
+            {'kernel': 'z', 'mean': 90.0, 'ci': 2.0},
+            {'kernel': 'w', 'mean': 90.0, 'ci': 2.0},
+        ]}
+        slower, faster = self.microbench.compare(new, base)
+        self.assertEqual(slower, ['x: 110 ns, was 100 ns (+10.0%)'])
+        self.assertEqual(faster, ['z: 90 ns, was 100 ns (-10.0%)'])
+
+    def test_main(self):
+        path = os.path.join(self.dir, 'out.json')
+        args = ['-k', 'salsa20_8,mcf._cb64', '-r', '1', '--samples', '3',
+                '--min-time', '0.001', '--json', path]
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            self.assertEqual(self.microbench.main(args), 0)
+            with open(path) as f:
+                results = json.load(f)
+            for res in results['results']:
+                res['mean'], res['ci'] = 1.0, 0.0
+            with open(path, 'w') as f:
+                json.dump(results, f)
+            # Timed the same, as a noisy sample can make the interval wider
+            # than any slowdown
+            measure = self.microbench.measure
+            self.microbench.measure = lambda f, samples, min_time: {
+                'loops': 1, 'samples': samples, 'mean': 1000.0,
+                'stdev': 0.0, 'ci': 0.0, 'min': 1000.0}
+            try:
+                self.assertEqual(self.microbench.main(
+                    args[:-2] + ['--baseline', path]), 1)
+            finally:
+                self.microbench.measure = measure
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([r['kernel'] for r in results['results']], [
+            'pypyscrypt.salsa20_8', 'pypyscrypt_inline.salsa20_8',
+            'mcf._cb64enc', 'mcf._cb64dec'])
+        for res in results['results']:
+            self.assertEqual(res['samples'], 3)
+            self.assertTrue(res['min'] > 0 and res['ci'] >= 0)
+
+
+class PickParamsTests(unittest.TestCase):
+    """Tests the parameter picker and its cost model"""
+
+    def setUp(self):
+        from . import cachedir, pickparams
+        self.cachedir = cachedir
+        self.pickparams = pickparams
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'costmodel.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def store(self, overhead, per_block):
+        with open(self.path, 'w') as f:
+            json.dump({self.cachedir.host_key('pypyscrypt_inline'): {
+                'overhead': overhead, 'per_block': per_block}}, f)
+
+    def test_calibrate(self):
+        from . import pypyscrypt_inline
+        model = self.pickparams.calibrate(pypyscrypt_inline, 0.001)
+        self.assertTrue(model.overhead >= 0 and model.per_block > 0)
+        self.assertTrue(model.predict(2**10, 8, 2) >
+                        model.predict(2**10, 8, 1) > 0)
+
+    def test_cost_model(self):
+        model = self.pickparams.cost_model('pypyscrypt_inline', self.path)
+        with open(self.path) as f:
+            stored = json.load(f)
+        self.assertEqual(list(stored.values()), [{
+            'overhead': model.overhead, 'per_block': model.per_block}])
+        self.store(0.5, 1e-6)
+        model = self.pickparams.cost_model('pypyscrypt_inline', self.path)
+        self.assertEqual((model.overhead, model.per_block), (0.5, 1e-6))
+        self.assertEqual(self.pickparams.predict(
+            2**10, 8, 1, 'pypyscrypt_inline', self.path), 0.5 + 8192e-6)
+        model = self.pickparams.cost_model('pypyscrypt_inline', self.path,
+                                           refresh=True)
+        self.assertNotEqual(model.overhead, 0.5)
+
+    def test_pick_params(self):
+        self.store(0.001, 1e-8)
+        pick = lambda *args, **kw: self.pickparams.pick_params(
+            backend='pypyscrypt_inline', path=self.path, *args, **kw)
+        # 2**20 * 8 blocks take 0.08s
+        self.assertEqual(pick(0.1, 2**40), (2**20, 8, 1))
+        self.assertEqual(pick(0.1, 2**40, r=16), (2**19, 16, 1))
+        # 16 MiB allows 2**14, and the time is enough for p = 75
+        self.assertEqual(pick(0.1, 2**24 + 2**20), (2**14, 8, 75))
+        self.assertEqual(pick(1e6, 2**50), (2**31, 8, 255))
+        self.assertRaises(ValueError, pick, 0.0005, 2**40)
+        self.assertRaises(ValueError, pick, 1, 1024)
+
+    def test_default_mem(self):
+        self.store(0.001, 1e-8)
+        pick = lambda: self.pickparams.pick_params(
+            1e6, backend='pypyscrypt_inline', path=self.path)
+        b = budget.get_budget()
+        limit, timeout = b.limit, b.timeout
+        physical_memory = self.pickparams._physical_memory
+        try:
+            budget.set_budget(None)
+            # Half of the RAM, 16 MiB, allows 2**14
+            self.pickparams._physical_memory = lambda: 2**25 + 2**21
+            self.assertEqual(pick(), (2**14, 8, 255))
+            self.pickparams._physical_memory = lambda: None
+            self.assertEqual(pick(), (2**31, 8, 255))
+            budget.set_budget(2**24 + 2**20)
+            self.pickparams._physical_memory = lambda: 2**40
+            self.assertEqual(pick(), (2**14, 8, 255))
+        finally:
+            self.pickparams._physical_memory = physical_memory
+            budget.set_budget(limit, timeout)
+        self.assertTrue(physical_memory() is None or physical_memory() > 0)
+
+    def test_main(self):
+        self.store(0.001, 1e-8)
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        cache_dir = self.pickparams.cache_dir
+        self.pickparams.cache_dir = lambda: self.dir
+        try:
+            args = ['-b', 'pypyscrypt_inline']
+            self.assertEqual(self.pickparams.main(
+                args + ['-t', '0.1', '-m', '16.5M']), 0)
+            self.assertEqual(self.pickparams.main(
+                args + ['--predict', '2**20,8,1']), 0)
+            self.assertEqual(self.pickparams.main(
+                args + ['-t', '0.1', '-m', '1K']), 1)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            self.pickparams.cache_dir = cache_dir
+        lines = output.splitlines()
+        self.assertTrue(lines[0].startswith('N=2**14 r=8 p=75 '))
+        self.assertEqual(lines[1], '0.08489 s')
+
+
+class MetricsTests(unittest.TestCase):
+    """Tests the metrics of scrypt calls"""
+
+    def setUp(self):
+        from . import metrics
+        self.pylibscrypt = importlib.import_module(__package__)
+        self.metrics = metrics
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        self.metrics.disable()
+        self.metrics.REGISTRY.reset()
+
+    def test_render(self):
+        m = self.metrics.Metrics(buckets=(0.1, 1.0))
+        m.observe('scrypt', 'x', 16, 1, 1, 0.05)
+        m.observe('scrypt', 'x', 16, 1, 1, 0.5, error=True)
+        m.observe('scrypt', 'x', 16, 1, 1, 5.0)
+        m.observe('scrypt_mcf_check', 'x', None, None, None, 0.0, True)
+        lines = m.render().splitlines()
+        labels = '{function="scrypt",backend="x",N="16",r="1",p="1"'
+        self.assertEqual(lines[2:8], [
+            'pylibscrypt_duration_seconds_bucket' + labels + ',le="0.1"} 1',
+            'pylibscrypt_duration_seconds_bucket' + labels + ',le="1.0"} 2',
+            'pylibscrypt_duration_seconds_bucket' + labels + ',le="+Inf"} 3',
+            'pylibscrypt_duration_seconds_sum' + labels + '} 5.55',
+            'pylibscrypt_duration_seconds_count' + labels + '} 3',
+            'pylibscrypt_duration_seconds_bucket{function="scrypt_mcf_check",'
+            'backend="x",N="",r="",p="",le="0.1"} 1',
+        ])
+        self.assertTrue('pylibscrypt_errors_total' + labels + '} 1' in lines)
+        m.reset()
+        self.assertFalse('_count' in m.render())
+
+    def test_enable(self):
+        module = self.pylibscrypt.preload()
+        backend = module.__name__.rsplit('.', 1)[-1]
+        self.assertFalse(self.metrics.enabled())
+        # Imported before enabling, but recorded too
+        scrypt_mcf_check = self.pylibscrypt.scrypt_mcf_check
+        calls = []
+        hook = lambda *args: calls.append(args)
+        self.metrics.add_hook(hook)
+        try:
+            self.metrics.enable()
+            self.metrics.enable()
+            self.assertTrue(self.metrics.enabled())
+            self.assertEqual(self.pylibscrypt.scrypt(b'pw', b's', 16, 1, 1),
+                             module.scrypt(b'pw', b's', 16, 1, 1))
+            self.assertRaises(ValueError, self.pylibscrypt.scrypt,
+                              b'pw', b's', 3, 1, 1)
+            out = bytearray(16)
+            self.pylibscrypt.scrypt_into(out, b'pw', b's', 16, 1, 1)
+            mcf = self.pylibscrypt.scrypt_mcf(b'pw', None, 16, 2, 1)
+            self.assertTrue(scrypt_mcf_check(mcf, b'pw'))
+            self.assertRaises(ValueError, self.pylibscrypt.scrypt_mcf_check,
+                              b'$s1$x', b'pw')
+        finally:
+            self.metrics.remove_hook(hook)
+        self.assertEqual([c[:5] + c[6:] for c in calls], [
+            ('scrypt', backend, 16, 1, 1, False),
+            ('scrypt', backend, 3, 1, 1, True),
+            ('scrypt_into', backend, 16, 1, 1, False),
+            ('scrypt_mcf', backend, 16, 2, 1, False),
+            ('scrypt_mcf_check', backend, 16, 2, 1, False),
+            ('scrypt_mcf_check', backend, None, None, None, True),
+        ])
+        self.assertTrue(all(c[5] >= 0 for c in calls))
+        text = self.metrics.render()
+        self.assertTrue('pylibscrypt_duration_seconds_count{function="scrypt",'
+                        'backend="%s",N="16",r="1",p="1"} 1' % backend in text)
+        self.assertTrue('pylibscrypt_errors_total{function="scrypt",'
+                        'backend="%s",N="3",r="1",p="1"} 1' % backend in text)
+
+        self.metrics.disable()
+        self.assertFalse(self.metrics.enabled())
+        self.pylibscrypt.scrypt(b'pw', b's', 16, 1, 1)
+        scrypt_mcf_check(mcf, b'pw')
+        self.assertEqual(self.metrics.render(), text)
+
+    def test_mcf_unchanged(self):
+        # The implementation checks the hash given, e.g. natively in C
+        module = self.pylibscrypt.preload()
+        given = []
+
+        def check(mcf, password):
+            given.append(mcf)
+            return module.scrypt_mcf_check(mcf, password)
+
+        class Module(object):
+            __name__ = 'test'
+            scrypt = scrypt_into = scrypt_mcf = None
+            scrypt_mcf_check = staticmethod(check)
+
+        instrumented = self.metrics._instrument(Module())
+        mcf = module.scrypt_mcf(b'pw', None, 16, 2, 1)
+        self.assertTrue(instrumented.scrypt_mcf_check(mcf, b'pw'))
+        self.assertTrue(given[0] is mcf)
+        self.assertEqual(self.metrics.REGISTRY._series[
+            ('scrypt_mcf_check', 'test', 16, 2, 1)][2], 1)
+
+
+class StagesTests(unittest.TestCase):
+    """Tests the stage profiling of the pure Python implementations"""
+
+    def setUp(self):
+        from . import pypyscrypt, pypyscrypt_inline, stages
+        self.modules = (pypyscrypt, pypyscrypt_inline)
+        self.stages = stages
+
+    def test_profile(self):
+        for module in self.modules:
+            for r in (1, 3):
+                key, stages = module.scrypt_profile(b'pw', b's', 4, r, 2, 16)
+                self.assertEqual(key, module.scrypt(b'pw', b's', 4, r, 2, 16))
+                self.assertEqual(list(stages), [
+                    'pbkdf2_in', 'unpack', 'alloc', 'fill', 'mix', 'pack',
+                    'pbkdf2_out'])
+                self.assertTrue(all(set(s) == set(['seconds']) and
+                                    s['seconds'] >= 0
+                                    for s in stages.values()))
+            self.assertRaises(ValueError, module.scrypt_profile,
+                              b'pw', b's', 3)
+
+    def test_workers(self):
+        module = self.modules[1]
+        module.workers = 2
+        try:
+            key, stages = module.scrypt_profile(b'pw', b's', 4, 1, 2)
+        finally:
+            module.workers = None
+        self.assertEqual(key, module.scrypt(b'pw', b's', 4, 1, 2))
+        self.assertTrue('lanes' in stages and 'fill' not in stages)
+
+    def test_hook(self):
+        for module in self.modules:
+            calls = []
+            module.profile_hook = calls.append
+            try:
+                key = module.scrypt(b'pw', b's', 4, 1, 1)
+                mcf = module.scrypt_mcf(b'pw', None, 4, 1, 1)
+                self.assertTrue(module.scrypt_mcf_check(mcf, b'pw'))
+            finally:
+                module.profile_hook = None
+            self.assertEqual(key, module.scrypt(b'pw', b's', 4, 1, 1))
+            self.assertEqual(len(calls), 3)
+            self.assertTrue('mix' in calls[0])
+
+    def test_tracemalloc(self):
+        tracemalloc = self.stages._tracemalloc()
+        if tracemalloc is None:
+            self.skipTest('tracemalloc not available')
+        tracemalloc.start()
+        try:
+            key, stages = self.modules[1].scrypt_profile(b'pw', b's', 8, 1, 1)
+        finally:
+            tracemalloc.stop()
+        for s in stages.values():
+            self.assertTrue('bytes' in s and 'blocks' in s)
+        # V is freed at the end of the stage
+        self.assertTrue(stages['alloc']['bytes'] < 1024)
+        if 'peak' in stages['alloc']:
+            self.assertTrue(stages['alloc']['peak'] >= 128 * 8)
+
+    def test_main(self):
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            self.assertEqual(self.stages.main(['-N', '2**2', '-r', '1']), 0)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        lines = output.splitlines()
+        self.assertEqual([line.split()[0] for line in lines], [
+            'stage', 'pbkdf2_in', 'unpack', 'alloc', 'fill', 'mix', 'pack',
+            'pbkdf2_out'])
+
+
+class WorkersTests(unittest.TestCase):
+    """Tests the worker processes of the pure Python implementations"""
+
+    def setUp(self):
+        from . import pypyscrypt, pypyscrypt_inline
+        self.modules = (pypyscrypt, pypyscrypt_inline)
+
+    def tearDown(self):
+        for module in self.modules:
+            module.workers = None
+
+    def test_pools(self):
+        # Pools replaced by changing workers are shut down, not left running
+        for module in self.modules:
+            key = module.scrypt(b'pw', b's', 4, 1, 3)
+            pools = []
+            for workers in (2, 3, 2):
+                module.workers = workers
+                self.assertEqual(module.scrypt(b'pw', b's', 4, 1, 3), key)
+                pools.append(module._pool)
+            self.assertEqual(list(module._pool_users), [pools[-1]])
+            for pool in pools[:-1]:
+                self.assertFalse(any(w.is_alive() for w in pool._pool))
+
+
+class MapVTests(unittest.TestCase):
+    """Tests keeping V in a memory map in the pure Python implementations"""
+
+    def setUp(self):
+        from . import pypyscrypt, pypyscrypt_inline
+        if not hasattr(memoryview, 'cast'):
+            self.skipTest('requires Python 3')
+        self.modules = (pypyscrypt, pypyscrypt_inline)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for module in self.modules:
+            module.map_v = None
+        shutil.rmtree(self.dir)
+
+    def test_map_v(self):
+        for module in self.modules:
+            for r in (1, 3):
+                key = module.scrypt(b'pw', b's', 16, r, 2)
+                for path in (True, self.dir):
+                    module.map_v = path
+                    self.assertEqual(module.scrypt(b'pw', b's', 16, r, 2),
+                                     key)
+                    self.assertEqual(module.scrypt_profile(
+                        b'pw', b's', 16, r, 2)[0], key)
+                module.map_v = None
+            self.assertEqual(os.listdir(self.dir), [])
+
+    def test_map_words(self):
+        for path in (None, self.dir):
+            m, V = self.modules[0].map_words(2**20, path)
+            self.assertEqual(len(V), 2**20)
+            self.assertEqual((V[0], V[2**20 - 1]), (0, 0))
+            V[2**19] = 2**32 - 1
+            self.assertEqual(V[2**19], 2**32 - 1)
+            V.release()
+            m.close()
+
+    def test_allocate(self):
+        module = self.modules[0]
+        fallocate = getattr(os, 'posix_fallocate', None)
+
+        def full(fd, offset, size):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+        try:
+            os.posix_fallocate = full
+            try:
+                module.map_words(2**10, self.dir)
+            except OSError as e:
+                self.assertEqual(e.errno, errno.ENOSPC)
+            else:
+                self.fail('ENOSPC not raised')
+            # Written out where posix_fallocate is missing
+            del os.posix_fallocate
+            with tempfile.TemporaryFile(dir=self.dir) as f:
+                module._allocate(f, 2**20 + 3)
+                self.assertEqual(os.fstat(f.fileno()).st_size, 2**20 + 3)
+        finally:
+            if fallocate is not None:
+                os.posix_fallocate = fallocate
+            elif hasattr(os, 'posix_fallocate'):
+                del os.posix_fallocate
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_budget(self):
+        module = self.modules[1]
+        b = budget.get_budget()
+        limit, timeout = b.limit, b.timeout
+        try:
+            budget.set_budget(2**18 + 2**16, timeout=0)
+            key = module.scrypt(b'pw', b's', 2**8, 8, 1)
+            self.assertRaises(ValueError, module.scrypt,
+                              b'pw', b's', 2**9, 8, 1)
+            module.map_v = True
+            self.assertRaises(ValueError, module.scrypt,
+                              b'pw', b's', 2**9, 8, 1)
+            # Only the work buffers count against the budget
+            module.map_v = self.dir
+            module.scrypt(b'pw', b's', 2**9, 8, 1)
+            self.assertEqual(module.scrypt(b'pw', b's', 2**8, 8, 1), key)
+        finally:
+            budget.set_budget(limit, timeout)
+
+
 class PBKDF2Tests(unittest.TestCase):
     """Tests a PBKDF2 implementation from module"""
     module = None
@@ -484,12 +1929,86 @@ if __name__ == "__main__":
     except ImportError:
         suite.addTest(load_scrypt_suite('pylibsodium_salsaTests', None, True))
 
+    try:
+        from . import numpyscrypt
+        suite.addTest(load_scrypt_suite('numpyscryptTests', numpyscrypt, True))
+        def set_up_lanes(self):
+            self.tmp_lanes = self.module._min_lanes
+            self.module._min_lanes = 1
+        def tear_down_lanes(self):
+            self.module._min_lanes = self.tmp_lanes
+        tmp = type(
+            'numpyscryptLaneTests', (ScryptTests,),
+            {
+                'module': numpyscrypt,
+                'fast': True,
+                'set_up_lambda': set_up_lanes,
+                'tear_down_lambda': tear_down_lanes,
+            }
+        )
+        suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(tmp))
+        suite.addTest(load_batch_suite('numpyscryptBatchTests', numpyscrypt))
+    except ImportError:
+        suite.addTest(load_scrypt_suite('numpyscryptTests', None, True))
+        suite.addTest(load_batch_suite('numpyscryptBatchTests', None))
+
     try:
         from . import pypyscrypt_inline as pypyscrypt
         suite.addTest(load_scrypt_suite('pypyscryptTests', pypyscrypt, True))
+        def set_up_workers(self):
+            self.module.workers = 2
+        def tear_down_workers(self):
+            self.module.workers = None
+        tmp = type(
+            'pypyscryptWorkerTests', (ScryptTests,),
+            {
+                'module': pypyscrypt,
+                'fast': True,
+                'set_up_lambda': set_up_workers,
+                'tear_down_lambda': tear_down_workers,
+            }
+        )
+        suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(tmp))
     except ImportError:
         suite.addTest(load_scrypt_suite('pypyscryptTests', None, True))
 
+    try:
+        from . import aio
+        suite.addTest(load_async_suite('asyncTests', aio, None))
+        from . import pypyscrypt_inline as pypyscrypt
+        suite.addTest(load_async_suite('asyncProcessTests', aio, pypyscrypt))
+    except (ImportError, SyntaxError):
+        suite.addTest(load_async_suite('asyncTests', None, None))
+
+    try:
+        from . import bulk
+        from . import pypyscrypt_inline as pypyscrypt
+        suite.addTest(load_bulk_suite('bulkTests', bulk, None))
+        suite.addTest(load_bulk_suite('bulkPythonTests', bulk, pypyscrypt))
+    except ImportError:
+        suite.addTest(load_bulk_suite('bulkTests', None, None))
+
+    try:
+        from . import cache
+        from . import pypyscrypt_inline as pypyscrypt
+        suite.addTest(load_cache_suite('cacheTests', cache, pypyscrypt))
+    except ImportError:
+        suite.addTest(load_cache_suite('cacheTests', None, None))
+
+    for name in ('hashlibscrypt', 'pylibscrypt', 'pyscrypt', 'pylibsodium',
+                 'pypyscrypt_inline'):
+        try:
+            module = importlib.import_module('.' + name, __package__)
+        except ImportError:
+            module = None
+        suite.addTest(load_context_suite(name + 'ContextTests', module))
+
+    for tests in (PackageBatchTests, MCFColumnsTests, BudgetTests,
+                  AutotuneTests, PreloadTests, LibloadTests, BenchTests,
+                  MicrobenchTests, PickParamsTests, MetricsTests, StagesTests,
+                  WorkersTests, MapVTests):
+        suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(tests))
+
     try:
         from . import pbkdf2
         suite.addTest(load_pbkdf2_suite('pbkdf2', pbkdf2))
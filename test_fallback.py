@@ -16,10 +16,21 @@
 
 import ctypes.util
 import hashlib
+import importlib
+import os
 import platform
+import shutil
 import sys
+import tempfile
+
+# Implementations are tried in order, and libraries searched for, rather than
+# using what an earlier run stored
+os.environ.pop('PYLIBSCRYPT_AUTOTUNE', None)
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
 
 if '-p' in sys.argv:
+    # Detected like this by pylibscrypt, and by pylibsodium as below
+    sys.pypy_version_info = (5, 0, 0, 'final', 0)
     platform.python_implementation = lambda:'PyPy'
 
 def raises(e):
@@ -35,6 +46,24 @@ def unimport(mod=None):
     if mod is not None:
         sys.modules.pop(mod, None)
 
+def check():
+    """Loads an implementation, checking that none preferred to it loads"""
+    module = pylibscrypt.preload()
+    name = module.__name__.rsplit('.', 1)[-1]
+    backends = pylibscrypt._BACKENDS
+    if name not in backends:
+        raise AssertionError('%s is not an implementation' % name)
+    if '-p' in sys.argv and 'numpyscrypt' in backends:
+        raise AssertionError('numpyscrypt preferred on PyPy')
+    for earlier in backends[:backends.index(name)]:
+        try:
+            importlib.import_module('pylibscrypt.' + earlier)
+        except ImportError:
+            continue
+        raise AssertionError('%s loaded, but %s is preferred' %
+                             (name, earlier))
+    print(name)
+
 import pylibscrypt
 sys.modules['pylibscrypt.hashlibscrypt'] = None
 
@@ -46,37 +75,58 @@ if '-e' in sys.argv:
     ctypes.util.find_library = lambda *args, **kw: None
     ctypes.cdll.LoadLibrary = lambda *args, **kw: None
     import pylibscrypt
+    check()
     ctypes.util.find_library = tmp1
     ctypes.cdll.LoadLibrary = tmp2
     unimport('pylibscrypt.pylibscrypt')
     ctypes.CDLL = lambda *args, **kw: None
     import pylibscrypt
+    check()
     unimport('pylibscrypt.pylibscrypt')
     ctypes.CDLL = raises(OSError)
     import pylibscrypt
+    check()
     ctypes.CDLL = tmp3
 
     unimport('pylibscrypt.pylibscrypt')
     ctypes.CDLL = lambda *args, **kw: None
     import pylibscrypt
+    check()
 
 unimport()
 sys.modules['pylibscrypt.pylibscrypt'] = None
 import pylibscrypt
+check()
 
 unimport('pylibscrypt.pyscrypt')
 sys.modules['scrypt'] = None
 import pylibscrypt
+check()
 
 unimport()
 sys.modules['pylibscrypt.pyscrypt'] = None
 import pylibscrypt
+check()
 
 unimport()
 sys.modules['pylibscrypt.pylibsodium'] = None
 import pylibscrypt
+check()
 
 unimport()
 sys.modules['pylibscrypt.pylibsodium_salsa'] = None
 import pylibscrypt
+check()
+
+
+unimport('pylibscrypt.numpyscrypt')
+sys.modules['numpy'] = None
+import pylibscrypt
+check()
+
+unimport()
+sys.modules['pylibscrypt.numpyscrypt'] = None
+import pylibscrypt
+check()
 
+shutil.rmtree(os.environ['XDG_CACHE_HOME'])